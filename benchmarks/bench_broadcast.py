@@ -0,0 +1,171 @@
+"""
+Рассылка через очередь outbox против старого цикла "по одному сообщению". Бот ходит в поддельный
+Bot API (aiohttp на localhost), который отвечает с задержкой --latency и на каждый --flood-every
+запрос отдает 429 "retry after 1". Замеряются сообщения в секунду, максимум за одну секунду
+по часам, минимальный интервал между сообщениями в один чат и число повторов после 429.
+Каждый режим - в отдельном процессе на своей временной БД (движки создаются при импорте).
+
+    python benchmarks/bench_broadcast.py [--messages 500] [--chats 250] [--latency 0.08] [--flood-every 100]
+
+--chats - сколько разных получателей: сообщения раздаются по кругу, в один чат уходит несколько.
+--flood-every 0 - без 429.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ["sequential", "outbox"]
+TOKEN = "123456:bench"
+
+
+class FakeBotApi:
+    """sendMessage с задержкой ответа; каждый flood_every-й запрос получает 429"""
+
+    def __init__(self, latency: float, flood_every: int):
+        self.latency = latency
+        self.flood_every = flood_every
+        self.requests = 0
+        self.floods = 0
+        self.delivered = []  # (time.monotonic(), chat_id)
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        data = await request.post()
+        self.requests += 1
+        number = self.requests
+        await asyncio.sleep(self.latency)
+        chat_id = int(data["chat_id"])
+        if self.flood_every and number % self.flood_every == 0:
+            self.floods += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+        self.delivered.append((time.monotonic(), chat_id))
+        return web.json_response({"ok": True, "result": {
+            "message_id": len(self.delivered), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", ""),
+        }})
+
+
+async def sequential(bot, chat_ids):
+    # Старый цикл рассылки: одно сообщение за раз, после 429 - ждать и повторить
+    from aiogram.exceptions import TelegramRetryAfter
+
+    for chat_id in chat_ids:
+        while True:
+            try:
+                await bot.send_message(chat_id, "Напоминание")
+                break
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+
+
+async def through_outbox(bot, chat_ids):
+    import database.requests as db
+    from database.models import async_session
+    from utils import outbox
+
+    outbox.start(bot)
+    async with async_session() as session:
+        batch_id = await db.create_outbox_batch(session, "Бенчмарк")
+        await db.enqueue_messages(session, [outbox.text_message(c, "Напоминание") for c in chat_ids], batch_id)
+        await session.commit()
+    while True:
+        await asyncio.sleep(0.1)
+        async with async_session() as session:
+            progress = await db.get_outbox_batch_progress(session, batch_id)
+        if not progress.remaining:
+            break
+    await outbox.stop()
+
+
+async def workload(mode: str, messages: int, chats: int, latency: float, flood_every: int) -> dict:
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiohttp import web
+
+    from database.migrations import init_db
+
+    await init_db()
+    api = FakeBotApi(latency, flood_every)
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")))
+    chat_ids = [1000 + i % chats for i in range(messages)]
+    started = time.monotonic()
+    await (sequential if mode == "sequential" else through_outbox)(bot, chat_ids)
+    elapsed = time.monotonic() - started
+    await bot.session.close()
+    await runner.cleanup()
+
+    per_second = Counter(int(at - started) for at, _ in api.delivered)
+    by_chat = defaultdict(list)
+    for at, chat_id in api.delivered:
+        by_chat[chat_id].append(at)
+    gaps = [b - a for times in by_chat.values() for a, b in zip(times, times[1:])]
+    return {
+        "delivered": len(api.delivered),
+        "elapsed": elapsed,
+        "rate": len(api.delivered) / elapsed,
+        "max_per_second": max(per_second.values()),
+        "min_chat_gap": min(gaps) if gaps else None,
+        "floods": api.floods,
+    }
+
+
+def child(args):
+    sys.path.insert(0, ROOT)
+    result = asyncio.run(workload(args.mode, args.messages, args.chats, args.latency, args.flood_every))
+    print(json.dumps(result))
+
+
+def main(args):
+    flood = f"429 на каждый {args.flood_every}-й запрос" if args.flood_every else "без 429"
+    print(f"{args.messages} сообщений в {args.chats} чатов, ответ API {args.latency * 1000:g} мс, {flood}")
+    print(f"{'режим':<12}{'доставлено':>11}{'время, с':>10}{'сообщ./с':>10}{'max за 1 с':>12}{'мин. в чат, с':>15}{'429':>5}")
+    for mode in MODES:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, DATABASE_URL=f"sqlite+aiosqlite:///{tmp}/bench.db", BOT_TOKEN=TOKEN)
+            output = subprocess.run(
+                [
+                    sys.executable, __file__, "--child", "--mode", mode,
+                    "--messages", str(args.messages), "--chats", str(args.chats),
+                    "--latency", str(args.latency), "--flood-every", str(args.flood_every),
+                ],
+                env=env, cwd=tmp, check=True, capture_output=True, text=True,
+            ).stdout
+            r = json.loads(output.strip().splitlines()[-1])
+        gap = "-" if r["min_chat_gap"] is None else f"{r['min_chat_gap']:.2f}"
+        print(
+            f"{mode:<12}{r['delivered']:>11}{r['elapsed']:>10.2f}{r['rate']:>10.1f}"
+            f"{r['max_per_second']:>12}{gap:>15}{r['floods']:>5}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--chats", type=int, default=250)
+    parser.add_argument("--latency", type=float, default=0.08)
+    parser.add_argument("--flood-every", type=int, default=100)
+    parser.add_argument("--mode", choices=MODES)
+    parser.add_argument("--child", action="store_true")
+    args = parser.parse_args()
+    child(args) if args.child else main(args)
@@ -0,0 +1,116 @@
+"""
+Нагрузка месяца инвентаризации: параллельные save_report + create_ticket вперемешку с чтениями
+(счетчики /admin, список тикетов). Сравнивает WAL/NORMAL (по умолчанию) со старыми DELETE/FULL.
+Каждый режим - в отдельном процессе на своей временной БД (движки создаются при импорте).
+
+    python benchmarks/bench_db.py [--writes 300] [--reads 600] [--rate 100 400]
+
+--rate - сколько записей в секунду поступает (чтения распределены по тому же времени).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+random.seed(1)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = [("WAL", "NORMAL"), ("DELETE", "FULL")]
+
+
+async def workload(writes: int, reads: int, rate: float) -> dict:
+    import database.requests as db
+    from database.migrations import init_db
+    from database.models import async_session
+
+    await init_db()
+    async with async_session() as session:
+        await db.load_settings(session)
+        await db.load_branch_progress(session)
+        branch = await db.add_branch(session, "Филиал")
+        items = [await db.add_item(session, f"Товар {i}") for i in range(20)]
+        for user_id in range(1, writes + 1):
+            await db.add_user(session, user_id)
+            await db.update_user_branch(session, user_id, branch.id)
+        await session.commit()
+
+    async def write(user_id: int):
+        await asyncio.sleep(user_id / rate)
+        async with async_session() as session:
+            if user_id % 3:
+                lines = {item.id: random.randint(0, 100) for item in items}
+                await db.save_report(session, user_id, "Филиал", "", lines=lines)
+            else:
+                await db.create_ticket(session, user_id, "User", "Филиал", "Не пришла поставка")
+            await session.commit()
+
+    latencies = []
+
+    async def read(n: int):
+        await asyncio.sleep(n * writes / rate / reads)
+        started = time.perf_counter()
+        async with async_session() as session:
+            db.invalidate_dashboard_stats()
+            await db.get_dashboard_stats(session)
+            await db.get_open_tickets_page(session, "problem")
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(write(u) for u in range(1, writes + 1)), *(read(n) for n in range(reads)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "elapsed": elapsed,
+        "read_p50_ms": statistics.median(latencies) * 1000,
+        "read_p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "read_max_ms": latencies[-1] * 1000,
+    }
+
+
+def child(args):
+    sys.path.insert(0, ROOT)
+    result = asyncio.run(workload(args.writes, args.reads, args.rate[0]))
+    print(json.dumps(result))
+
+
+def main(args):
+    print(f"{args.writes} записей (2/3 отчеты, 1/3 тикеты) + {args.reads} чтений параллельно")
+    print(f"{'записей/с':<11}{'режим':<14}{'время, с':>10}{'чтение p50':>12}{'p95':>9}{'max, мс':>10}")
+    for rate, (journal_mode, synchronous) in ((r, m) for r in args.rate for m in MODES):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(
+                os.environ,
+                DATABASE_URL=f"sqlite+aiosqlite:///{tmp}/bench.db",
+                SQLITE_JOURNAL_MODE=journal_mode,
+                SQLITE_SYNCHRONOUS=synchronous,
+            )
+            output = subprocess.run(
+                [
+                    sys.executable, __file__, "--child",
+                    "--writes", str(args.writes), "--reads", str(args.reads), "--rate", str(rate),
+                ],
+                env=env, cwd=tmp, check=True, capture_output=True, text=True,
+            ).stdout
+            r = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{rate:<11g}{journal_mode + '/' + synchronous:<14}{r['elapsed']:>10.2f}"
+            f"{r['read_p50_ms']:>12.1f}{r['read_p95_ms']:>9.1f}{r['read_max_ms']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writes", type=int, default=300)
+    parser.add_argument("--reads", type=int, default=600)
+    parser.add_argument("--rate", type=float, nargs="+", default=[100, 400])
+    parser.add_argument("--child", action="store_true")
+    args = parser.parse_args()
+    child(args) if args.child else main(args)
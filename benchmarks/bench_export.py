@@ -0,0 +1,125 @@
+"""
+Выгрузка в Excel на больших объемах: время и пиковая память процесса-воркера.
+Для каждого объема - временная БД с N отчетами (по строке остатков на отчет) и N/5 тикетами,
+затем build_report_sync(0) ("все время") в отдельном процессе, как в пуле выгрузок.
+
+Пик кучи Python (tracemalloc, отдельный прогон) за вычетом готового файла (байты для передачи боту)
+не должен расти вместе с числом строк: книга write_only, строки идут пачками. В RSS кроме этого входят
+страницы SQLite - кэш (SQLITE_CACHE_SIZE_KB) и mmap (SQLITE_MMAP_SIZE), они ограничены настройками.
+
+    python benchmarks/bench_export.py [--rows 50000 500000]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHUNK = 10000
+
+
+async def fill(rows: int):
+    from sqlalchemy import insert
+
+    from database.migrations import init_db
+    from database.models import FeedbackTicket, InventoryReport, Item, ReportLine, engine
+
+    await init_db()
+    start = datetime.utcnow() - timedelta(days=365)
+    async with engine.begin() as conn:
+        await conn.execute(insert(Item), [{"id": i, "name": f"Товар {i}"} for i in range(1, 21)])
+        for first in range(1, rows + 1, CHUNK):
+            ids = range(first, min(first + CHUNK, rows + 1))
+            await conn.execute(insert(InventoryReport), [
+                {
+                    "id": i, "branch_name": f"Филиал {i % 50}", "user_id": i % 3000, "user_name": "User",
+                    "report_data": "Товар 1: 10, Товар 2: 20, Товар 3: 30", "sector": "full",
+                    "timestamp": start + timedelta(seconds=i * 30),
+                }
+                for i in ids
+            ])
+            await conn.execute(insert(ReportLine), [
+                {"report_id": i, "item_id": i % 20 + 1, "qty": i % 100, "delta": i % 7 - 3} for i in ids
+            ])
+        for first in range(1, rows // 5 + 1, CHUNK):
+            await conn.execute(insert(FeedbackTicket), [
+                {
+                    "id": i, "user_id": i % 3000, "user_name": "User", "branch_name": f"Филиал {i % 50}",
+                    "message": "Не пришла поставка", "ticket_type": ("problem", "question", "order")[i % 3],
+                    "status": "closed", "created_at": start + timedelta(seconds=i * 150),
+                }
+                for i in range(first, min(first + CHUNK, rows // 5 + 1))
+            ])
+    await engine.dispose()
+
+
+def export(heap: bool) -> dict:
+    from utils.export import build_report_sync
+
+    if heap:
+        tracemalloc.start()
+        build_report_sync(0)
+        return {"heap_peak_mb": tracemalloc.get_traced_memory()[1] / 2**20}
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    data = build_report_sync(0)
+    elapsed = time.perf_counter() - started
+    return {
+        "elapsed": elapsed,
+        "size_mb": len(data) / 2**20,
+        # ru_maxrss в Linux - в КБ
+        "rss_before_mb": rss_before / 1024,
+        "rss_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def child(args):
+    import asyncio
+
+    sys.path.insert(0, ROOT)
+    if args.child == "fill":
+        asyncio.run(fill(args.rows[0]))
+    else:
+        print(json.dumps(export(args.child == "heap")))
+
+
+def main(args):
+    print(
+        f"{'отчетов':>9}{'тикетов':>9}{'время, с':>10}{'файл, МБ':>10}"
+        f"{'RSS до':>9}{'пик RSS':>9}{'пик кучи, МБ':>14}"
+    )
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(
+                os.environ,
+                DATABASE_URL=f"sqlite+aiosqlite:///{tmp}/bench.db",
+                ARCHIVE_DATABASE_URL=f"sqlite+aiosqlite:///{tmp}/bench_archive.db",
+            )
+            r = {}
+            for mode in ("fill", "export", "heap"):
+                output = subprocess.run(
+                    [sys.executable, __file__, "--child", mode, "--rows", str(rows)],
+                    env=env, cwd=tmp, check=True, capture_output=True, text=True,
+                ).stdout
+                if mode != "fill":
+                    r.update(json.loads(output.strip().splitlines()[-1]))
+        print(
+            f"{rows:>9}{rows // 5:>9}{r['elapsed']:>10.1f}{r['size_mb']:>10.1f}"
+            f"{r['rss_before_mb']:>9.0f}{r['rss_peak_mb']:>9.0f}{r['heap_peak_mb']:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[50000, 500000])
+    parser.add_argument("--child", choices=["fill", "export", "heap"])
+    args = parser.parse_args()
+    child(args) if args.child else main(args)
@@ -0,0 +1,155 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, event, func, insert, inspect, select, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import config
+from database.models import (
+    Base, engine, read_engine, _apply_sqlite_pragmas,
+    FeedbackTicket, Order, OrderLine, InventoryReport, ReportLine,
+)
+
+# Холодный архив: закрытые тикеты и отчеты старше ARCHIVE_AFTER_DAYS переезжают
+# в отдельную БД (по умолчанию файл SQLite) с той же схемой, чтобы рабочие таблицы оставались маленькими.
+# Каждая пачка сначала копируется в архив и коммитится, и только потом удаляется из рабочей БД.
+# Строки, уже лежащие в архиве в том же виде (прерванный перенос), пропускаются, поэтому перенос
+# безопасно повторить. Та же строка с другим содержимым - ArchiveConflict: пачка не удаляется.
+# id в рабочей БД не переиспользуются (AUTOINCREMENT, счетчик не ниже максимального id архива).
+
+ARCHIVE_TABLES = [t.__table__ for t in (FeedbackTicket, Order, OrderLine, InventoryReport, ReportLine)]
+
+class ArchiveConflict(Exception):
+    """В архиве уже есть строка с тем же ключом, но другим содержимым"""
+
+archive_engine = create_async_engine(config.ARCHIVE_DATABASE_URL, echo=False, pool_size=1, max_overflow=0)
+
+def _on_archive_connect(dbapi_connection, connection_record):
+    _apply_sqlite_pragmas(dbapi_connection, read_only=False)
+
+if archive_engine.dialect.name == "sqlite":
+    event.listen(archive_engine.sync_engine, "connect", _on_archive_connect)
+
+_schema_ready = False
+
+def _sync_schema(connection):
+    Base.metadata.create_all(connection, tables=ARCHIVE_TABLES)
+    # create_all не трогает существующие таблицы: колонки, добавленные миграциями рабочей БД, дописываем
+    inspector = inspect(connection)
+    for table in ARCHIVE_TABLES:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                print(f"Archive: Adding {column.name} column to {table.name}...")
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+async def _reserve_archived_ids():
+    """
+    SQLite: счетчик AUTOINCREMENT рабочей БД не ниже максимального id в архиве -
+    иначе новая строка получит id, который уже занят в архиве (например, после переноса последних строк
+    до перехода на AUTOINCREMENT). В PostgreSQL последовательности назад не ходят.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    async with archive_engine.connect() as conn:
+        archived = {table.name: await conn.scalar(select(func.max(table.c.id))) for table in (
+            FeedbackTicket.__table__, InventoryReport.__table__,
+        )}
+    async with engine.begin() as conn:
+        for name, max_id in archived.items():
+            if max_id is None:
+                continue
+            seq = await conn.scalar(text("SELECT seq FROM sqlite_sequence WHERE name = :name"), {"name": name})
+            if seq is None:
+                await conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"), {"name": name, "seq": max_id})
+            elif seq < max_id:
+                await conn.execute(text("UPDATE sqlite_sequence SET seq = :seq WHERE name = :name"), {"name": name, "seq": max_id})
+
+async def ensure_schema():
+    """
+    Создает/дополняет схему архива и резервирует его id в рабочей БД.
+    Вызывается при старте (после init_db), чтобы выгрузка читала архив той же моделью
+    """
+    global _schema_ready
+    if not _schema_ready:
+        async with archive_engine.begin() as conn:
+            await conn.run_sync(_sync_schema)
+        await _reserve_archived_ids()
+        _schema_ready = True
+
+async def _rows_to_copy(conn, table, key, parent_ids, rows):
+    """
+    Строки rows, которых еще нет в архиве. Совпадающие (повтор прерванного переноса) пропускаются,
+    отличающиеся - ArchiveConflict: удалять такую строку из рабочей БД нельзя.
+    """
+    pk = table.primary_key.columns.values()
+    archived = {
+        tuple(r[c.name] for c in pk): dict(r)
+        for r in (await conn.execute(select(table).where(key.in_(parent_ids)))).mappings()
+    }
+    new_rows = []
+    for row in rows:
+        existing = archived.get(tuple(row[c.name] for c in pk))
+        if existing is None:
+            new_rows.append(row)
+        elif existing != row:
+            raise ArchiveConflict(f"{table.name}: строка {[row[c.name] for c in pk]} уже есть в архиве и отличается")
+    return new_rows
+
+async def _move_chunk(parent, parent_ids, children):
+    """
+    Переносит строки parent с ключами parent_ids и их дочерние строки.
+    children: [(table, fk column)] - в порядке удаления (сначала самые глубокие).
+    """
+    async with read_engine.connect() as conn:
+        rows = {}
+        for table, fk in children:
+            result = await conn.execute(select(table).where(fk.in_(parent_ids)))
+            rows[table] = [dict(r._mapping) for r in result]
+        pk = parent.primary_key.columns.values()[0]
+        result = await conn.execute(select(parent).where(pk.in_(parent_ids)))
+        rows[parent] = [dict(r._mapping) for r in result]
+
+    # 1. Копия в архив (родители раньше детей). Исключение откатывает всю пачку, до удаления дело не доходит
+    async with archive_engine.begin() as conn:
+        for table, key in [(parent, pk)] + list(reversed(children)):
+            new_rows = await _rows_to_copy(conn, table, key, parent_ids, rows[table])
+            if new_rows:
+                await conn.execute(insert(table), new_rows)
+
+    # 2. Удаление из рабочей БД (дети раньше родителей)
+    async with engine.begin() as conn:
+        for table, fk in children:
+            await conn.execute(delete(table).where(fk.in_(parent_ids)))
+        await conn.execute(delete(parent).where(pk.in_(parent_ids)))
+
+async def _archive(id_query, parent, children) -> int:
+    moved = 0
+    while True:
+        async with read_engine.connect() as conn:
+            ids = list(await conn.scalars(id_query.limit(config.ARCHIVE_CHUNK_SIZE)))
+        if not ids:
+            return moved
+        await _move_chunk(parent, ids, children)
+        moved += len(ids)
+
+async def archive_old_records(days: int = None):
+    """Переносит в архив закрытые тикеты (с заказами) и отчеты старше days дней. Возвращает (тикетов, отчетов)"""
+    await ensure_schema()
+    cutoff = datetime.utcnow() - timedelta(days=days or config.ARCHIVE_AFTER_DAYS)
+
+    tickets = await _archive(
+        select(FeedbackTicket.id)
+        .where(FeedbackTicket.status == "closed", FeedbackTicket.created_at < cutoff)
+        .order_by(FeedbackTicket.id),
+        FeedbackTicket.__table__,
+        [(OrderLine.__table__, OrderLine.order_id), (Order.__table__, Order.ticket_id)],
+    )
+    reports = await _archive(
+        select(InventoryReport.id)
+        .where(InventoryReport.timestamp < cutoff)
+        .order_by(InventoryReport.id),
+        InventoryReport.__table__,
+        [(ReportLine.__table__, ReportLine.report_id)],
+    )
+    return tickets, reports
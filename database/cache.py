@@ -0,0 +1,206 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import config
+
+# In-process кэши поверх БД.
+# Запись помечает кэш "грязным" в своей сессии (mark_dirty): кэш сбрасывается сразу
+# и еще раз после коммита этой сессии, так что никто не закэширует старые данные надолго.
+# Изменения настроек и счетчиков копятся в session.info и применяются только после коммита;
+# транзакция, закончившаяся без коммита (откат, закрытие сессии, исключение в хендлере),
+# их просто забывает (after_transaction_end).
+
+DIRTY_KEY = "dirty_caches"
+SETTINGS_PENDING_KEY = "settings_pending"
+PROGRESS_KEY = "progress_ops"
+
+class CatalogCache:
+    """
+    Read-through кэш небольшого справочника (товары, филиалы, контакты).
+    Хранит неизменяемые снимки строк с индексами по id и (опционально) по имени.
+    """
+    def __init__(self, name: str, name_attr: Optional[str] = "name"):
+        self.name = name
+        self.name_attr = name_attr
+        self.hits = 0
+        self.misses = 0
+        self.rows = None
+        self.by_id = {}
+        self.by_name = {}
+        # Растет при каждой инвалидации: загрузка, начатая до сброса, не попадет в кэш
+        self.generation = 0
+
+    def lookup(self):
+        """Возвращает себя, если данные загружены, иначе None (и считает промах)"""
+        if self.rows is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self
+
+    def fill(self, rows: Iterable, generation: Optional[int] = None):
+        if generation is not None and generation != self.generation:
+            return CatalogCache(self.name, self.name_attr).fill(rows)
+        self.rows = tuple(rows)
+        self.by_id = {r.id: r for r in self.rows}
+        if self.name_attr:
+            self.by_name = {getattr(r, self.name_attr): r for r in self.rows}
+        return self
+
+    def invalidate(self):
+        self.rows = None
+        self.by_id = {}
+        self.by_name = {}
+        self.generation += 1
+
+class ProfileCache:
+    """
+    LRU-кэш снимков по ключу с TTL (профили пользователей).
+    TTL - страховка: даже пропущенная инвалидация живет не дольше ttl секунд.
+    """
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._data = OrderedDict()  # key -> (момент истечения, снимок)
+
+    def get(self, key: Hashable):
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, value, generation: Optional[int] = None):
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable = None):
+        self.generation += 1
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+class SettingsStore:
+    """
+    Вся таблица settings в памяти: загружается один раз при старте.
+    Записанное set_setting значение до коммита видит только своя сессия (get(..., session)),
+    в общий снимок оно попадает после коммита.
+    """
+    def __init__(self):
+        self._values: Dict[str, str] = {}
+        self.loaded = False
+
+    def load(self, rows: Iterable):
+        self._values = dict(rows)
+        self.loaded = True
+
+    def get(self, key: str, default: Optional[str] = None, session=None):
+        if session is not None:
+            pending = session.info.get(SETTINGS_PENDING_KEY)
+            if pending and key in pending:
+                return pending[key]
+        return self._values.get(key, default)
+
+    def write(self, session, key: str, value: str):
+        session.info.setdefault(SETTINGS_PENDING_KEY, {})[key] = value
+
+    def _apply(self, pending: Dict[str, str]):
+        self._values.update(pending)
+
+class ProgressCounters:
+    """
+    Прогресс сдачи по филиалам в памяти: branch_id -> (total, submitted).
+    Копия таблицы branch_progress; изменения сессии применяются только после ее коммита.
+    """
+    def __init__(self):
+        self.counts: Dict[int, tuple] = {}
+
+    def load(self, rows: Iterable):
+        self.counts = {branch_id: (total, submitted) for branch_id, total, submitted in rows}
+
+    def stage(self, session, op: tuple):
+        session.info.setdefault(PROGRESS_KEY, []).append(op)
+
+    def _apply(self, ops):
+        for op in ops:
+            if op[0] == "reset":
+                self.load(op[1])
+            elif op[0] == "drop":
+                self.counts.pop(op[1], None)
+            else:  # ("add", branch_id, d_total, d_submitted)
+                _, branch_id, d_total, d_submitted = op
+                total, submitted = self.counts.get(branch_id, (0, 0))
+                self.counts[branch_id] = (total + d_total, submitted + d_submitted)
+
+items = CatalogCache("items")
+branches = CatalogCache("branches")
+contacts = CatalogCache("contacts", name_attr=None)
+settings = SettingsStore()
+progress = ProgressCounters()
+users = ProfileCache("users", maxsize=config.USER_CACHE_SIZE, ttl=config.USER_CACHE_TTL)
+# Счетчики главного меню админа (одна запись) - короткий TTL, сбрасываются записью, как справочники
+dashboard = ProfileCache("dashboard", maxsize=1, ttl=config.DASHBOARD_CACHE_TTL)
+
+_caches: Dict[str, object] = {c.name: c for c in (items, branches, contacts, users, dashboard)}
+
+def _drop(entry):
+    # entry - имя кэша целиком или (имя, ключ) для одной записи
+    if isinstance(entry, tuple):
+        _caches[entry[0]].invalidate(entry[1])
+    else:
+        _caches[entry].invalidate()
+
+def mark_dirty(session, *names: str):
+    """Вызывается из функций записи: сбросить кэши сейчас и после коммита сессии"""
+    session.info.setdefault(DIRTY_KEY, set()).update(names)
+    for name in names:
+        _drop(name)
+
+def mark_key_dirty(session, name: str, key: Hashable):
+    """То же для одной записи ключевого кэша"""
+    session.info.setdefault(DIRTY_KEY, set()).add((name, key))
+    _drop((name, key))
+
+def is_dirty(session, name: str, key: Hashable = None) -> bool:
+    """Есть ли в сессии незакоммиченные изменения этого кэша (или его записи key)"""
+    dirty = session.info.get(DIRTY_KEY, ())
+    return name in dirty or (key is not None and (name, key) in dirty)
+
+def catalog_stats():
+    """(hits, misses) по всем справочникам - для админ-панели"""
+    catalog = (items, branches, contacts)
+    return sum(c.hits for c in catalog), sum(c.misses for c in catalog)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    for entry in session.info.pop(DIRTY_KEY, ()):
+        _drop(entry)
+    settings._apply(session.info.pop(SETTINGS_PENDING_KEY, {}))
+    progress._apply(session.info.pop(PROGRESS_KEY, ()))
+
+@event.listens_for(Session, "after_transaction_end")
+def _forget_uncommitted(session, transaction):
+    # Срабатывает и после коммита - но after_commit уже забрал все из session.info.
+    # В отличие от after_rollback, вызывается и при закрытии сессии без коммита
+    if transaction.parent is not None:
+        return
+    session.info.pop(DIRTY_KEY, None)
+    session.info.pop(PROGRESS_KEY, None)
+    session.info.pop(SETTINGS_PENDING_KEY, None)
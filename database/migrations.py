@@ -0,0 +1,313 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, func, inspect, select, text
+from sqlalchemy.exc import DBAPIError
+
+from database.models import (
+    engine, Base, Branch, Item, User, InventoryCycle, InventoryReport, ReportLine,
+    GlobalSettings, FeedbackTicket, Order, OrderLine, StockLevel, OutboxBatch, OutboxMessage,
+)
+from database.search import create_search_index
+
+# Версионные миграции схемы.
+# Номер версии хранится в таблице schema_version; при старте на актуальной схеме - один SELECT.
+# Каждый шаг идемпотентен (проверяет колонки/индексы/маркеры), поэтому его можно безопасно
+# прогнать и на базе, которую уже мигрировал старый check_and_migrate.
+
+def _add_column(connection, table: str, column: str, ddl: str):
+    columns = [c['name'] for c in inspect(connection).get_columns(table)]
+    if column not in columns:
+        print(f"Migrating DB: Adding {column} column to {table}...")
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+def _create_indexes(connection, table: str, *names: str):
+    """Создает объявленные в моделях индексы, которых еще нет (create_all не трогает существующие таблицы)"""
+    existing = {ix['name'] for ix in inspect(connection).get_indexes(table)}
+    for index in Base.metadata.tables[table].indexes:
+        if index.name in names and index.name not in existing:
+            print(f"Migrating DB: Creating index {index.name}...")
+            index.create(connection)
+
+def parse_report_data(report_data: str) -> dict:
+    """Разбирает старый текстовый формат отчета "Товар: 10\\n..." в {название: количество}"""
+    result = {}
+    for line in (report_data or "").splitlines():
+        name, sep, qty = line.rpartition(":")
+        name, qty = name.strip(), qty.strip()
+        if sep and name and qty.isdigit():
+            result[name] = int(qty)
+    return result
+
+def _migration_done(connection, key: str) -> bool:
+    marker = connection.execute(select(GlobalSettings.value).where(GlobalSettings.key == key)).scalar()
+    return marker == "1"
+
+def _mark_migration(connection, key: str):
+    connection.execute(GlobalSettings.__table__.insert(), {"key": key, "value": "1"})
+
+def backfill_report_lines(connection):
+    """Переносит строки из report_data старых отчетов в report_lines (один раз)"""
+    if _migration_done(connection, "migration_report_lines"):
+        return
+
+    item_ids = {name: item_id for item_id, name in connection.execute(select(Item.id, Item.name))}
+
+    rows = []
+    reports = connection.execute(select(InventoryReport.id, InventoryReport.report_data))
+    for report_id, report_data in reports:
+        for name, qty in parse_report_data(report_data).items():
+            # Переименованные/удаленные позиции сопоставить уже нельзя - пропускаем
+            if name in item_ids:
+                rows.append({"report_id": report_id, "item_id": item_ids[name], "qty": qty})
+
+    if rows:
+        print(f"Migrating DB: Backfilling {len(rows)} report lines...")
+        connection.execute(ReportLine.__table__.insert(), rows)
+    _mark_migration(connection, "migration_report_lines")
+
+def backfill_last_report_at(connection):
+    """Заполняет users.last_report_at по уже сданным отчетам (один раз)"""
+    if _migration_done(connection, "migration_last_report_at"):
+        return
+
+    last_report = (
+        select(func.max(InventoryReport.timestamp))
+        .where(InventoryReport.user_id == User.telegram_id)
+        .scalar_subquery()
+    )
+    connection.execute(User.__table__.update().values(last_report_at=last_report))
+    _mark_migration(connection, "migration_last_report_at")
+
+def migrate_open_cycle(connection):
+    """
+    Если сбор был открыт до появления циклов - заводим для него цикл (один раз).
+    Отчеты последних суток (старое окно "сдал") привязываются к нему.
+    """
+    if _migration_done(connection, "migration_cycles"):
+        return
+
+    is_open = connection.execute(select(GlobalSettings.value).where(GlobalSettings.key == "inventory_open")).scalar()
+    if is_open == "1":
+        opened_at = datetime.utcnow() - timedelta(hours=24)
+        cycle_id = connection.execute(
+            InventoryCycle.__table__.insert().values(opened_at=opened_at)
+        ).inserted_primary_key[0]
+        connection.execute(
+            InventoryReport.__table__.update()
+            .where(InventoryReport.timestamp >= opened_at)
+            .values(cycle_id=cycle_id)
+        )
+        connection.execute(GlobalSettings.__table__.insert(), {"key": "current_cycle_id", "value": str(cycle_id)})
+        print(f"Migrating DB: Open inventory attached to cycle #{cycle_id}")
+    _mark_migration(connection, "migration_cycles")
+
+LEGACY_ORDER_PREFIX = "[ЗАКАЗ МАТЕРИАЛОВ]"
+
+def migrate_order_tickets(connection):
+    """Старые заказы (тикеты с префиксом) -> ticket_type="order" + orders/order_lines (один раз)"""
+    if _migration_done(connection, "migration_orders"):
+        return
+
+    item_ids = {name: item_id for item_id, name in connection.execute(select(Item.id, Item.name))}
+    branch_ids = {name: branch_id for branch_id, name in connection.execute(select(Branch.id, Branch.name))}
+
+    tickets = connection.execute(
+        select(FeedbackTicket.id, FeedbackTicket.branch_name, FeedbackTicket.message)
+        .where(FeedbackTicket.message.like(LEGACY_ORDER_PREFIX + "%"))
+    ).all()
+
+    if tickets:
+        print(f"Migrating DB: Moving {len(tickets)} legacy orders to orders table...")
+
+    for ticket_id, branch_name, message in tickets:
+        items_str = message[len(LEGACY_ORDER_PREFIX):].strip()
+
+        lines = []
+        for line in items_str.splitlines():
+            # Формат строки: "▫️ Товар: 5 шт."
+            name, sep, qty = line.rpartition(":")
+            name = name.strip().lstrip("▫️").strip()
+            qty = qty.split()[0] if qty.split() else ""
+            if sep and name in item_ids and qty.isdigit():
+                lines.append({"order_id": ticket_id, "item_id": item_ids[name], "qty": int(qty)})
+
+        connection.execute(
+            FeedbackTicket.__table__.update()
+            .where(FeedbackTicket.id == ticket_id)
+            .values(ticket_type="order", message=items_str)
+        )
+        connection.execute(Order.__table__.insert(), {"ticket_id": ticket_id, "branch_id": branch_ids.get(branch_name)})
+        if lines:
+            connection.execute(OrderLine.__table__.insert(), lines)
+
+    _mark_migration(connection, "migration_orders")
+
+
+def backfill_stock_history(connection):
+    """
+    Проставляет branch_id старым отчетам (по названию филиала), считает delta для report_lines
+    и заполняет stock_levels последними остатками (один раз).
+    """
+    if _migration_done(connection, "migration_stock_history"):
+        return
+
+    branch_id = select(Branch.id).where(Branch.name == InventoryReport.branch_name).scalar_subquery()
+    connection.execute(
+        InventoryReport.__table__.update().where(InventoryReport.branch_id.is_(None)).values(branch_id=branch_id)
+    )
+
+    lines = connection.execute(
+        select(
+            InventoryReport.id, InventoryReport.branch_id, InventoryReport.sector, InventoryReport.timestamp,
+            ReportLine.item_id, ReportLine.qty,
+        )
+        .join(ReportLine, ReportLine.report_id == InventoryReport.id)
+        .where(InventoryReport.branch_id.is_not(None))
+        .order_by(InventoryReport.timestamp, InventoryReport.id)
+    ).all()
+
+    latest = {}
+    deltas = []
+    for report_id, report_branch_id, sector, timestamp, item_id, qty in lines:
+        key = (report_branch_id, sector or "full", item_id)
+        previous = latest.get(key)
+        delta = qty - previous["qty"] if previous else None
+        if delta is not None:
+            deltas.append({"r": report_id, "i": item_id, "d": delta})
+        latest[key] = {"qty": qty, "delta": delta, "report_id": report_id, "updated_at": timestamp}
+
+    if deltas:
+        print(f"Migrating DB: Computing {len(deltas)} stock deltas...")
+        connection.execute(
+            ReportLine.__table__.update()
+            .where(ReportLine.report_id == bindparam("r"), ReportLine.item_id == bindparam("i"))
+            .values(delta=bindparam("d")),
+            deltas
+        )
+    if latest:
+        connection.execute(
+            StockLevel.__table__.insert(),
+            [{"branch_id": b, "sector": sector, "item_id": i, **level} for (b, sector, i), level in latest.items()]
+        )
+    _mark_migration(connection, "migration_stock_history")
+
+# --- Шаги ---
+
+def _v1_base_schema(connection):
+    """Недостающие таблицы + колонки первых версий бота"""
+    Base.metadata.create_all(connection)
+    _add_column(connection, "tickets", "ticket_type", "VARCHAR DEFAULT 'problem'")
+    _add_column(connection, "users", "sector", "VARCHAR DEFAULT 'full'")
+    _add_column(connection, "inventory_reports", "sector", "VARCHAR DEFAULT 'full'")
+
+def _v2_indexes(connection):
+    _create_indexes(connection, "inventory_reports", "ix_inventory_reports_timestamp_user")
+    _create_indexes(connection, "tickets", "ix_tickets_status_type_created", "ix_tickets_created_at")
+    _create_indexes(connection, "users", "ix_users_selected_branch_id")
+
+def _v5_last_report_at(connection):
+    _add_column(connection, "users", "last_report_at", "TIMESTAMP")
+    backfill_last_report_at(connection)
+
+def _v6_cycles(connection):
+    _add_column(connection, "inventory_reports", "cycle_id", "INTEGER REFERENCES inventory_cycles(id)")
+    _create_indexes(connection, "inventory_reports", "ix_inventory_reports_cycle_user")
+    migrate_open_cycle(connection)
+
+def _v8_stock_history(connection):
+    Base.metadata.create_all(connection, tables=[StockLevel.__table__])
+    _add_column(connection, "inventory_reports", "branch_id", "INTEGER")
+    _add_column(connection, "report_lines", "delta", "INTEGER")
+    _create_indexes(connection, "inventory_reports", "ix_inventory_reports_branch_sector_timestamp")
+    backfill_stock_history(connection)
+
+def _v9_outbox(connection):
+    Base.metadata.create_all(connection, tables=[OutboxBatch.__table__, OutboxMessage.__table__])
+
+def _v10_unreachable_users(connection):
+    _add_column(connection, "users", "unreachable_since", "TIMESTAMP")
+
+def _v11_audience_index(connection):
+    _create_indexes(connection, "users", "ix_users_sector_branch")
+
+def _rebuild_with_autoincrement(connection, table):
+    """
+    SQLite: пересоздает таблицу с AUTOINCREMENT (ALTER TABLE так не умеет). Без него новая строка
+    получает max(id) + 1, и id строк, перенесенных в архив последними, достаются новым записям.
+    """
+    sql = connection.scalar(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table.name})
+    if sql is None or "AUTOINCREMENT" in sql.upper():
+        return
+    print(f"Migrating DB: Rebuilding {table.name} with AUTOINCREMENT...")
+    old = f"{table.name}_old"
+    # legacy_alter_table: внешние ключи других таблиц (orders, report_lines) продолжают ссылаться на table.name
+    connection.execute(text("PRAGMA legacy_alter_table = ON"))
+    connection.execute(text(f"ALTER TABLE {table.name} RENAME TO {old}"))
+    connection.execute(text("PRAGMA legacy_alter_table = OFF"))
+    inspector = inspect(connection)
+    for index in inspector.get_indexes(old):
+        connection.execute(text(f"DROP INDEX {index['name']}"))
+    columns = ", ".join(c["name"] for c in inspector.get_columns(old) if c["name"] in table.columns)
+    table.create(connection)
+    connection.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old}"))
+    connection.execute(text(f"DROP TABLE {old}"))
+
+def _v12_autoincrement(connection):
+    if connection.dialect.name != "sqlite":
+        return
+    _rebuild_with_autoincrement(connection, FeedbackTicket.__table__)
+    _rebuild_with_autoincrement(connection, InventoryReport.__table__)
+
+def _v13_outbox_purge_indexes(connection):
+    _create_indexes(connection, "outbox", "ix_outbox_status_created")
+    _create_indexes(connection, "outbox_batches", "ix_outbox_batches_created_at")
+
+def _v14_outbox_claimed_at(connection):
+    _add_column(connection, "outbox", "claimed_at", "TIMESTAMP")
+
+# Порядок важен: новые шаги - только в конец списка, номера не переиспользуются
+MIGRATIONS = [
+    (1, _v1_base_schema),
+    (2, _v2_indexes),
+    (3, backfill_report_lines),
+    (4, migrate_order_tickets),
+    (5, _v5_last_report_at),
+    (6, _v6_cycles),
+    (7, create_search_index),
+    (8, _v8_stock_history),
+    (9, _v9_outbox),
+    (10, _v10_unreachable_users),
+    (11, _v11_audience_index),
+    (12, _v12_autoincrement),
+    (13, _v13_outbox_purge_indexes),
+    (14, _v14_outbox_claimed_at),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def migrate(connection, current: int):
+    connection.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+    if current == 0:
+        connection.execute(text("DELETE FROM schema_version"))
+        connection.execute(text("INSERT INTO schema_version (version) VALUES (0)"))
+
+    for version, step in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"Migrating DB: schema v{version} ({step.__name__})...")
+        step(connection)
+        connection.execute(text("UPDATE schema_version SET version = :v"), {"v": version})
+
+async def get_schema_version() -> int:
+    """Версия схемы; 0 - таблицы schema_version еще нет (новая или старая база)"""
+    async with engine.connect() as conn:
+        try:
+            return (await conn.scalar(text("SELECT version FROM schema_version"))) or 0
+        except DBAPIError:
+            return 0
+
+async def init_db():
+    current = await get_schema_version()
+    if current >= SCHEMA_VERSION:
+        return
+    async with engine.begin() as conn:
+        await conn.run_sync(migrate, current)
@@ -1,14 +1,105 @@
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import List, Optional
 
-from sqlalchemy import BigInteger, ForeignKey, String, Boolean, Text, DateTime, text
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
+from sqlalchemy import BigInteger, ForeignKey, Integer, String, Boolean, Text, DateTime, Index, event
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column, relationship
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncSession, async_sessionmaker, create_async_engine
+
+import config
 
 # Вынесем Engine сюда, так как он нужен и моделям (для миграций/метадаты) и запросам
-DATABASE_URL = "sqlite+aiosqlite:///./warehouse.db"
-engine = create_async_engine(DATABASE_URL, echo=False)
-async_session = async_sessionmaker(engine, expire_on_commit=False)
+DATABASE_URL = config.DATABASE_URL
+IS_SQLITE = make_url(DATABASE_URL).get_backend_name() == "sqlite"
+
+if IS_SQLITE:
+    # Запись в SQLite все равно сериализуется, поэтому писатель один (очередь ждет в пуле,
+    # а не в busy-loop SQLite). Читатели идут через отдельный пул и в режиме WAL не ждут писателя.
+    engine = create_async_engine(DATABASE_URL, echo=False, pool_size=1, max_overflow=0)
+    read_engine = create_async_engine(DATABASE_URL, echo=False, pool_size=config.DB_READ_POOL_SIZE, max_overflow=0)
+else:
+    # PostgreSQL сам справляется с параллельной записью: один общий пул
+    engine = create_async_engine(
+        DATABASE_URL,
+        echo=False,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_timeout=config.DB_POOL_TIMEOUT,
+        pool_recycle=config.DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+    read_engine = engine
+
+def _apply_sqlite_pragmas(dbapi_connection, read_only: bool):
+    cursor = dbapi_connection.cursor()
+    if not read_only:
+        # journal_mode хранится в самом файле БД, достаточно выставлять его писателем
+        cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size=-{config.SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    if read_only:
+        # Страховка: случайная запись через читателя упадет сразу, а не заблокирует БД
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+def _on_writer_connect(dbapi_connection, connection_record):
+    _apply_sqlite_pragmas(dbapi_connection, read_only=False)
+
+def _on_reader_connect(dbapi_connection, connection_record):
+    _apply_sqlite_pragmas(dbapi_connection, read_only=True)
+
+if IS_SQLITE:
+    event.listen(engine.sync_engine, "connect", _on_writer_connect)
+    event.listen(read_engine.sync_engine, "connect", _on_reader_connect)
+
+def dialect_insert(target_engine, table):
+    """INSERT с ON CONFLICT (on_conflict_do_update / do_nothing) под диалект движка"""
+    if target_engine.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+class WriterSession(Session):
+    """
+    Сессия апдейта (middlewares/db.py), планировщика и воркера очереди. Все ее запросы идут через писателя,
+    поэтому проверки перед записью (занято ли название, сдавал ли пользователь отчет) видят последние коммиты.
+    Функции только для чтения выполняют запросы в reading(session) и соединение писателя не занимают.
+    """
+
+@event.listens_for(WriterSession, "do_orm_execute")
+def _mark_dml(state):
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info["wrote"] = True
+
+@event.listens_for(WriterSession, "before_flush")
+def _mark_flush(session, flush_context, instances):
+    session.info["wrote"] = True
+
+@event.listens_for(WriterSession, "after_transaction_end")
+def _reset_wrote(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("wrote", None)
+
+async_session = async_sessionmaker(engine, sync_session_class=WriterSession, expire_on_commit=False)
+# Короткие сессии для чтения: пул читателей SQLite в режиме WAL не ждет писателя
+read_session = async_sessionmaker(read_engine, expire_on_commit=False)
+
+@asynccontextmanager
+async def reading(session: AsyncSession):
+    """
+    Сессия для запросов только на чтение. Обычно - своя короткая сессия читателя: она закрывается сразу
+    после запроса и не держит соединение, пока апдейт ждет писателя, а снимок у нее всегда свежий.
+    Если в session уже есть незакоммиченные изменения (или на PostgreSQL, где пул общий) - сама session
+    """
+    if read_engine is engine or session.info.get("wrote") or session.new or session.dirty or session.deleted:
+        yield session
+        return
+    async with read_session() as reader:
+        yield reader
 
 class Base(AsyncAttrs, DeclarativeBase):
     pass
@@ -32,22 +123,93 @@ class User(Base):
     __tablename__ = "users"
 
     telegram_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
-    selected_branch_id: Mapped[Optional[int]] = mapped_column(ForeignKey("branches.id"), nullable=True)
+    selected_branch_id: Mapped[Optional[int]] = mapped_column(ForeignKey("branches.id"), nullable=True, index=True)
     language: Mapped[str] = mapped_column(String, default="ru")
     sector: Mapped[str] = mapped_column(String, default="full") # oil, ap, full
+    # Время последнего отчета - чтобы счетчик прогресса учитывал пользователя один раз за сбор
+    last_report_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    # С какого момента бот заблокирован пользователем (Forbidden при отправке). Сбрасывается при /start
+    unreachable_since: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
     
     branch: Mapped[Optional["Branch"]] = relationship(back_populates="users")
 
+    __table_args__ = (
+        # Сегменты рассылок: сектор + филиалы
+        Index("ix_users_sector_branch", "sector", "selected_branch_id"),
+    )
+
+class InventoryCycle(Base):
+    """Сбор отчетов (кампания): от открытия до закрытия. Отчеты привязаны к своему сбору"""
+    __tablename__ = "inventory_cycles"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    opened_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    closed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
 class InventoryReport(Base):
     __tablename__ = "inventory_reports"
 
     id: Mapped[int] = mapped_column(primary_key=True)
     branch_name: Mapped[str] = mapped_column(String)
+    # ID филиала на момент сдачи (без FK: история остается и после удаления филиала)
+    branch_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     user_id: Mapped[int] = mapped_column(BigInteger)
     user_name: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     report_data: Mapped[str] = mapped_column(Text)
     timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     sector: Mapped[str] = mapped_column(String, default="full")
+    cycle_id: Mapped[Optional[int]] = mapped_column(ForeignKey("inventory_cycles.id"), nullable=True)
+
+    lines: Mapped[List["ReportLine"]] = relationship(back_populates="report")
+
+    __table_args__ = (
+        # Диапазонные выборки по дате
+        Index("ix_inventory_reports_timestamp_user", "timestamp", "user_id"),
+        # "Кто сдал в этом сборе" - anti-join должников по (cycle_id, user_id)
+        Index("ix_inventory_reports_cycle_user", "cycle_id", "user_id"),
+        # Ряд остатков филиала по сектору во времени
+        Index("ix_inventory_reports_branch_sector_timestamp", "branch_id", "sector", "timestamp"),
+        # id не переиспользуются после переноса последних строк в архив (database/archive.py)
+        {"sqlite_autoincrement": True},
+    )
+
+class ReportLine(Base):
+    """Строка отчета: количество по конкретному товару (ссылка по ID, переживает переименование)"""
+    __tablename__ = "report_lines"
+
+    report_id: Mapped[int] = mapped_column(ForeignKey("inventory_reports.id"), primary_key=True)
+    item_id: Mapped[int] = mapped_column(ForeignKey("items.id"), primary_key=True, index=True)
+    qty: Mapped[int] = mapped_column(Integer)
+    # Изменение относительно предыдущего отчета по тому же (филиал, сектор, товар); None - первый отчет
+    delta: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    report: Mapped["InventoryReport"] = relationship(back_populates="lines")
+
+class StockLevel(Base):
+    """
+    Последний известный остаток по (филиал, сектор, товар) и его изменение в последнем отчете.
+    По нему save_report считает delta без чтения истории, а админка показывает крупнейшие движения.
+    """
+    __tablename__ = "stock_levels"
+
+    branch_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    sector: Mapped[str] = mapped_column(String, primary_key=True)
+    item_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    qty: Mapped[int] = mapped_column(Integer)
+    delta: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    report_id: Mapped[int] = mapped_column(Integer)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class BranchProgress(Base):
+    """
+    Прогресс текущего сбора по филиалу: сколько пользователей и сколько из них уже сдали.
+    Поддерживается инкрементально (save_report, смена филиала), пересчитывается при открытии сбора.
+    """
+    __tablename__ = "branch_progress"
+
+    branch_id: Mapped[int] = mapped_column(ForeignKey("branches.id"), primary_key=True)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    submitted: Mapped[int] = mapped_column(Integer, default=0)
 
 class GlobalSettings(Base):
     __tablename__ = "settings"
@@ -63,7 +225,7 @@ class FeedbackTicket(Base):
     user_name: Mapped[str] = mapped_column(String)
     branch_name: Mapped[str] = mapped_column(String)
     message: Mapped[str] = mapped_column(Text) # Текст обращения
-    ticket_type: Mapped[str] = mapped_column(String, default="problem") # problem, question
+    ticket_type: Mapped[str] = mapped_column(String, default="problem") # problem, question, order
     status: Mapped[str] = mapped_column(String, default="open") # open, closed
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     
@@ -72,44 +234,89 @@ class FeedbackTicket(Base):
     responder_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
     responder_name: Mapped[Optional[str]] = mapped_column(String, nullable=True)
 
+    order: Mapped[Optional["Order"]] = relationship(back_populates="ticket")
+
+    __table_args__ = (
+        # Открытые тикеты по типу (списки, счетчики) с сортировкой по дате
+        Index("ix_tickets_status_type_created", "status", "ticket_type", "created_at"),
+        # Выгрузка за период
+        Index("ix_tickets_created_at", "created_at"),
+        # id не переиспользуются после переноса последних строк в архив (database/archive.py)
+        {"sqlite_autoincrement": True},
+    )
+
+class Order(Base):
+    """
+    Заказ материалов. Статус и ответ живут в тикете (ticket_type="order"),
+    чтобы работал общий механизм ответа по ID тикета.
+    """
+    __tablename__ = "orders"
+
+    ticket_id: Mapped[int] = mapped_column(ForeignKey("tickets.id"), primary_key=True)
+    branch_id: Mapped[Optional[int]] = mapped_column(ForeignKey("branches.id"), nullable=True, index=True)
+
+    ticket: Mapped["FeedbackTicket"] = relationship(back_populates="order")
+    lines: Mapped[List["OrderLine"]] = relationship(back_populates="order")
+
+class OrderLine(Base):
+    __tablename__ = "order_lines"
+
+    order_id: Mapped[int] = mapped_column(ForeignKey("orders.ticket_id"), primary_key=True)
+    item_id: Mapped[int] = mapped_column(ForeignKey("items.id"), primary_key=True, index=True)
+    qty: Mapped[int] = mapped_column(Integer)
+
+    order: Mapped["Order"] = relationship(back_populates="lines")
+
+class OutboxBatch(Base):
+    """Группа исходящих сообщений одной рассылки. Итог пишется в chat_id (правкой message_id, если задан)"""
+    __tablename__ = "outbox_batches"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    title: Mapped[str] = mapped_column(String)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    chat_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    message_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # Очистка старых рассылок (purge_outbox)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+class OutboxMessage(Base):
+    """
+    Исходящее сообщение. Пишется в той же транзакции, что и действие, которое его вызвало,
+    доставляется фоновым воркером (utils/outbox.py) - переживает перезапуск бота.
+    """
+    __tablename__ = "outbox"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    batch_id: Mapped[Optional[int]] = mapped_column(ForeignKey("outbox_batches.id"), nullable=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    method: Mapped[str] = mapped_column(String) # send_message, copy_message
+    payload: Mapped[str] = mapped_column(Text) # JSON с аргументами метода
+    # Повторная постановка с тем же ключом игнорируется (повтор апдейта, двойной запуск задачи)
+    dedup_key: Mapped[Optional[str]] = mapped_column(String, unique=True, nullable=True)
+    status: Mapped[str] = mapped_column(String, default="pending") # pending, sending, sent, failed, cancelled
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    # Когда воркер забрал сообщение (status = sending): по истечении OUTBOX_CLAIM_TIMEOUT оно снова в очереди
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    __table_args__ = (
+        # Очередь: ожидающие по порядку постановки
+        Index("ix_outbox_status_id", "status", "id"),
+        # Порядок сообщений в одном чате
+        Index("ix_outbox_chat_status", "chat_id", "status"),
+        # Итоги рассылки
+        Index("ix_outbox_batch_status", "batch_id", "status"),
+        # Очистка обработанных сообщений по дате (purge_outbox)
+        Index("ix_outbox_status_created", "status", "created_at"),
+    )
+
 class DepartmentContact(Base):
     __tablename__ = "department_contacts"
     
     id: Mapped[int] = mapped_column(primary_key=True)
     department: Mapped[str] = mapped_column(String) # IT, Logistics
     info: Mapped[str] = mapped_column(String) # +777 111... - Alex
-
-from sqlalchemy import inspect
-
-def check_and_migrate(connection):
-    inspector = inspect(connection)
-    
-    # 1. Tickets (ticket_type)
-    if inspector.has_table("tickets"):
-        columns = [c['name'] for c in inspector.get_columns('tickets')]
-        if 'ticket_type' not in columns:
-            print("Migrating DB: Adding ticket_type column to tickets...")
-            connection.execute(text("ALTER TABLE tickets ADD COLUMN ticket_type VARCHAR DEFAULT 'problem'"))
-
-    # 2. Users (sector)
-    if inspector.has_table("users"):
-        columns = [c['name'] for c in inspector.get_columns('users')]
-        if 'sector' not in columns:
-            print("Migrating DB: Adding sector column to users...")
-            connection.execute(text("ALTER TABLE users ADD COLUMN sector VARCHAR DEFAULT 'full'"))
-
-    # 3. InventoryReports (sector)
-    if inspector.has_table("inventory_reports"):
-        columns = [c['name'] for c in inspector.get_columns('inventory_reports')]
-        if 'sector' not in columns:
-            print("Migrating DB: Adding sector column to inventory_reports...")
-            connection.execute(text("ALTER TABLE inventory_reports ADD COLUMN sector VARCHAR DEFAULT 'full'"))
-            
-    # 4. Settings table check (handled by create_all, but good to know)
-    if not inspector.has_table("settings"):
-        print("Migrating DB: Creating settings table via create_all...")
-
-async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-        await conn.run_sync(check_and_migrate)
@@ -1,334 +1,1047 @@
+from array import array
 from datetime import datetime, timedelta
-from sqlalchemy import select, func
-from sqlalchemy.orm import selectinload
-from database.models import async_session, User, Branch, Item, InventoryReport, FeedbackTicket, DepartmentContact
+from typing import List, NamedTuple, Optional, Tuple
+from sqlalchemy import select, func, insert, update, delete, tuple_, and_, or_, false
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased, selectinload
+from database.models import User, Branch, Item, InventoryCycle, InventoryReport, ReportLine, FeedbackTicket, Order, OrderLine, DepartmentContact, GlobalSettings, BranchProgress, StockLevel, OutboxBatch, OutboxMessage, engine, read_engine, dialect_insert, reading
+from database import cache
+from database.search import index_ticket
 import config
 
-async def get_branches():
-    async with async_session() as session:
-        result = await session.execute(select(Branch))
-        return result.scalars().all()
-
-async def get_branch_by_id(branch_id: int):
-    async with async_session() as session:
-        return await session.get(Branch, branch_id)
-
-async def add_branch(name: str):
-    async with async_session() as session:
-        branch = Branch(name=name)
-        session.add(branch)
-        await session.commit()
-        return branch
-
-async def get_active_items():
-    async with async_session() as session:
-        result = await session.execute(select(Item).where(Item.is_active == True))
-        return result.scalars().all()
-
-async def add_item(name: str):
-    async with async_session() as session:
-        item = Item(name=name, is_active=True)
-        session.add(item)
-        await session.commit()
-        return item
-
-async def get_item(item_id: int):
-    async with async_session() as session:
-        return await session.get(Item, item_id)
-
-async def rename_item(item_id: int, new_name: str):
-    async with async_session() as session:
-        item = await session.get(Item, item_id)
-        if item:
-            item.name = new_name
-            await session.commit()
-            return True
+# Все функции работают в сессии текущего апдейта (см. middlewares/db.py) и не коммитят сами:
+# коммит делает middleware (или вызывающий код) один раз в конце.
+
+# --- Catalog cache ---
+# Товары, филиалы и контакты читаются почти на каждом шаге инвентаризации и заказа,
+# а меняются редко - отдаем их из кэша (database/cache.py) в виде неизменяемых снимков.
+
+class ItemInfo(NamedTuple):
+    id: int
+    name: str
+    is_active: bool
+
+class BranchInfo(NamedTuple):
+    id: int
+    name: str
+
+class ContactInfo(NamedTuple):
+    id: int
+    department: str
+    info: str
+
+_CATALOG = {
+    "items": (select(Item.id, Item.name, Item.is_active).order_by(Item.id), ItemInfo),
+    "branches": (select(Branch.id, Branch.name).order_by(Branch.id), BranchInfo),
+    "contacts": (select(DepartmentContact.id, DepartmentContact.department, DepartmentContact.info).order_by(DepartmentContact.id), ContactInfo),
+}
+
+async def _catalog(session: AsyncSession, catalog: cache.CatalogCache):
+    stmt, row_type = _CATALOG[catalog.name]
+    if cache.is_dirty(session, catalog.name):
+        # В этой сессии справочник уже изменен, но еще не закоммичен - читаем свои изменения мимо кэша
+        result = await session.execute(stmt)
+        return cache.CatalogCache(catalog.name, catalog.name_attr).fill(row_type(*r) for r in result)
+    if catalog.lookup() is None:
+        generation = catalog.generation
+        # Отдельное короткое соединение: снимок сессии апдейта может быть старше последнего коммита
+        async with read_engine.connect() as conn:
+            result = await conn.execute(stmt)
+            return catalog.fill((row_type(*r) for r in result), generation)
+    return catalog
+
+async def get_branches(session: AsyncSession):
+    return list((await _catalog(session, cache.branches)).rows)
+
+async def get_branch_by_id(session: AsyncSession, branch_id: int):
+    return (await _catalog(session, cache.branches)).by_id.get(branch_id)
+
+async def add_branch(session: AsyncSession, name: str):
+    """Возвращает None, если филиал с таким названием уже есть"""
+    if await session.scalar(select(Branch.id).where(Branch.name == name)):
+        return None
+    branch = Branch(name=name)
+    session.add(branch)
+    await session.flush()
+    session.add(BranchProgress(branch_id=branch.id, total=0, submitted=0))
+    cache.progress.stage(session, ("add", branch.id, 0, 0))
+    cache.mark_dirty(session, "branches", "dashboard")
+    return branch
+
+async def get_active_items(session: AsyncSession):
+    return [i for i in (await _catalog(session, cache.items)).rows if i.is_active]
+
+async def add_item(session: AsyncSession, name: str):
+    """Возвращает None, если товар с таким названием уже есть"""
+    if await session.scalar(select(Item.id).where(Item.name == name)):
+        return None
+    item = Item(name=name, is_active=True)
+    session.add(item)
+    await session.flush()
+    cache.mark_dirty(session, "items", "dashboard")
+    return item
+
+class ImportSummary(NamedTuple):
+    inserted: int
+    renamed: int
+    skipped: List[str]
+
+async def import_catalog(session: AsyncSession, rows) -> ImportSummary:
+    """
+    Массовый импорт товаров и филиалов (строки из utils/catalog_import.py) в одной транзакции.
+    Строка без id - добавление (удаленный товар с тем же названием восстанавливается),
+    с id - переименование. Все, что нарушило бы уникальность названий, пропускается,
+    как и повторное изменение уже затронутой файлом записи: каждая запись учитывается в итогах один раз.
+    """
+    inserted = renamed = 0
+    skipped = []
+    for model, kind in ((Item, "item"), (Branch, "branch")):
+        by_name = {name: id_ for id_, name in await session.execute(select(model.id, model.name))}
+        ids = set(by_name.values())
+        inactive = set(await session.scalars(select(Item.id).where(Item.is_active == False))) if model is Item else set()
+
+        new_rows, updates, seen, touched = [], [], set(), set()
+        for row in rows:
+            if row.kind != kind:
+                continue
+            if row.name in seen:
+                skipped.append(f"стр. {row.line}: '{row.name}' повторяется в файле")
+                continue
+            seen.add(row.name)
+            existing_id = by_name.get(row.name)
+            target_id = existing_id if row.id is None else row.id
+            if target_id in touched:
+                # Например, восстановление удаленного товара и его же переименование
+                skipped.append(f"стр. {row.line}: запись id {target_id} уже изменена строкой выше")
+            elif row.id is None:
+                if existing_id is None:
+                    new_rows.append({"name": row.name})
+                elif existing_id in inactive:
+                    updates.append({"id": existing_id, "is_active": True})
+                    touched.add(existing_id)
+                    inserted += 1
+                else:
+                    skipped.append(f"стр. {row.line}: '{row.name}' уже существует")
+            elif row.id not in ids:
+                skipped.append(f"стр. {row.line}: id {row.id} не найден")
+            elif existing_id == row.id:
+                skipped.append(f"стр. {row.line}: '{row.name}' без изменений")
+            elif existing_id is not None:
+                skipped.append(f"стр. {row.line}: название '{row.name}' уже занято")
+            else:
+                updates.append({"id": row.id, "name": row.name})
+                touched.add(row.id)
+                renamed += 1
+
+        # Пачками (executemany), а не по одной записи
+        if new_rows and model is Item:
+            await session.execute(insert(Item), [dict(r, is_active=True) for r in new_rows])
+        elif new_rows:
+            branch_ids = list(await session.scalars(insert(Branch).returning(Branch.id), new_rows))
+            await session.execute(insert(BranchProgress), [{"branch_id": b, "total": 0, "submitted": 0} for b in branch_ids])
+            for branch_id in branch_ids:
+                cache.progress.stage(session, ("add", branch_id, 0, 0))
+        if updates:
+            await session.execute(update(model), updates)
+        inserted += len(new_rows)
+
+        if not (new_rows or updates):
+            continue
+        if model is Item:
+            cache.mark_dirty(session, "items")
+        else:
+            # Название филиала лежит в профилях пользователей
+            cache.mark_dirty(session, "branches", "users")
+
+    if inserted:
+        cache.mark_dirty(session, "dashboard")
+    return ImportSummary(inserted, renamed, skipped)
+
+async def get_item(session: AsyncSession, item_id: int):
+    """Снимок товара (в т.ч. удаленного) или None"""
+    return (await _catalog(session, cache.items)).by_id.get(item_id)
+
+async def rename_item(session: AsyncSession, item_id: int, new_name: str):
+    if await session.scalar(select(Item.id).where(Item.name == new_name, Item.id != item_id)):
         return False
+    item = await session.get(Item, item_id)
+    if item:
+        item.name = new_name
+        cache.mark_dirty(session, "items")
+        return True
+    return False
 
-async def delete_item(item_id: int):
+async def delete_item(session: AsyncSession, item_id: int):
     """Soft delete"""
-    async with async_session() as session:
-        item = await session.get(Item, item_id)
-        if item:
-            item.is_active = False
-            await session.commit()
-            return True
-        return False
+    item = await session.get(Item, item_id)
+    if item:
+        item.is_active = False
+        cache.mark_dirty(session, "items", "dashboard")
+        return True
+    return False
 
-async def rename_branch(branch_id: int, new_name: str):
-    async with async_session() as session:
-        branch = await session.get(Branch, branch_id)
-        if branch:
-            branch.name = new_name
-            await session.commit()
-            return True
+async def rename_branch(session: AsyncSession, branch_id: int, new_name: str):
+    if await session.scalar(select(Branch.id).where(Branch.name == new_name, Branch.id != branch_id)):
         return False
+    branch = await session.get(Branch, branch_id)
+    if branch:
+        branch.name = new_name
+        # Название филиала лежит в профилях пользователей
+        cache.mark_dirty(session, "branches", "users")
+        return True
+    return False
 
-async def delete_branch(branch_id: int):
-    async with async_session() as session:
-        branch = await session.get(Branch, branch_id)
-        if branch:
-            # TODO: Handle users linked to this branch?
-            # For now simply delete.
-            await session.delete(branch)
-            await session.commit()
-            return True
-        return False
+async def delete_branch(session: AsyncSession, branch_id: int):
+    branch = await session.get(Branch, branch_id)
+    if branch:
+        # Заказы остаются в истории с названием филиала в тикете, ссылка на удаленный филиал обнуляется
+        # (иначе PostgreSQL не даст удалить строку branches). Пользователи выберут филиал заново
+        await session.execute(update(Order).where(Order.branch_id == branch_id).values(branch_id=None))
+        await session.execute(update(User).where(User.selected_branch_id == branch_id).values(selected_branch_id=None))
+        await session.execute(delete(BranchProgress).where(BranchProgress.branch_id == branch_id))
+        await session.execute(delete(StockLevel).where(StockLevel.branch_id == branch_id))
+        cache.progress.stage(session, ("drop", branch_id))
+        await session.delete(branch)
+        cache.mark_dirty(session, "branches", "users", "dashboard")
+        return True
+    return False
 
-async def get_user(telegram_id: int):
-    async with async_session() as session:
-        # Используем selectinload для подгрузки связанного branch, чтобы не было ошибок Lazy load
-        stmt = select(User).where(User.telegram_id == telegram_id).options(selectinload(User.branch))
-        result = await session.execute(stmt)
-        return result.scalar_one_or_none()
+class UserProfile(NamedTuple):
+    telegram_id: int
+    language: str
+    sector: Optional[str]
+    selected_branch_id: Optional[int]
+    branch_name: Optional[str]
 
-async def add_user(telegram_id: int):
-    async with async_session() as session:
-        user = await session.get(User, telegram_id)
-        if not user:
-            user = User(telegram_id=telegram_id)
-            session.add(user)
-            await session.commit()
-        return user
-
-async def update_user_branch(telegram_id: int, branch_id: int):
-    async with async_session() as session:
-        user = await session.get(User, telegram_id)
-        if user:
-            user.selected_branch_id = branch_id
-            await session.commit()
+async def get_user(session: AsyncSession, telegram_id: int) -> Optional[UserProfile]:
+    """Снимок профиля (язык, филиал, сектор) - из кэша, в БД только при промахе"""
+    stmt = (
+        select(User.telegram_id, User.language, User.sector, User.selected_branch_id, Branch.name)
+        .outerjoin(Branch, Branch.id == User.selected_branch_id)
+        .where(User.telegram_id == telegram_id)
+    )
+    if cache.is_dirty(session, "users", telegram_id):
+        # Профиль изменен в этой сессии - читаем свои незакоммиченные изменения
+        row = (await session.execute(stmt)).one_or_none()
+        return UserProfile(*row) if row else None
+
+    profile = cache.users.get(telegram_id)
+    if profile is None:
+        generation = cache.users.generation
+        async with read_engine.connect() as conn:
+            row = (await conn.execute(stmt)).one_or_none()
+        if row is None:
+            return None
+        profile = UserProfile(*row)
+        cache.users.put(telegram_id, profile, generation)
+    return profile
 
-async def update_user_language(telegram_id: int, language: str):
-    async with async_session() as session:
+async def add_user(session: AsyncSession, telegram_id: int):
+    user = await session.get(User, telegram_id)
+    if not user:
+        # Два одновременных /start от нового пользователя не должны падать на первичном ключе
+        result = await session.execute(
+            dialect_insert(engine, User)
+            .values(telegram_id=telegram_id)
+            .on_conflict_do_nothing(index_elements=[User.telegram_id])
+        )
+        if result.rowcount:
+            cache.mark_key_dirty(session, "users", telegram_id)
+            cache.mark_dirty(session, "dashboard")
         user = await session.get(User, telegram_id)
-        if user:
-            user.language = language
-            await session.commit()
+    elif user.unreachable_since is not None:
+        # Пользователь разблокировал бота и нажал /start - снова получает рассылки
+        user.unreachable_since = None
+    return user
 
+async def update_user_branch(session: AsyncSession, telegram_id: int, branch_id: int):
+    user = await session.get(User, telegram_id)
+    if user:
+        if user.selected_branch_id != branch_id:
+            # Пользователь (и его отчет в текущем сборе, если есть) переходит в другой филиал
+            submitted = int(_reported_this_period(session, user))
+            if user.selected_branch_id:
+                await _bump_progress(session, user.selected_branch_id, -1, -submitted)
+            await _bump_progress(session, branch_id, 1, submitted)
+        user.selected_branch_id = branch_id
+        cache.mark_key_dirty(session, "users", telegram_id)
 
+async def update_user_language(session: AsyncSession, telegram_id: int, language: str):
+    user = await session.get(User, telegram_id)
+    if user:
+        user.language = language
+        cache.mark_key_dirty(session, "users", telegram_id)
 
-async def get_last_reports(limit: int = 5):
-    async with async_session() as session:
-        result = await session.execute(
+async def get_last_reports(session: AsyncSession, limit: int = 5):
+    async with reading(session) as reader:
+        result = await reader.execute(
             select(InventoryReport).order_by(InventoryReport.timestamp.desc()).limit(limit)
         )
-        return result.scalars().all()
+    return result.scalars().all()
 
 # --- Tickets ---
-async def create_ticket(user_id: int, user_name: str, branch_name: str, message: str, ticket_type: str = "problem"):
-    async with async_session() as session:
-        ticket = FeedbackTicket(
-            user_id=user_id, 
-            user_name=user_name, 
-            branch_name=branch_name, 
-            message=message,
-            ticket_type=ticket_type,
-            status="open"
-        )
-        session.add(ticket)
-        await session.commit()
-        return ticket.id
-
-async def get_open_tickets(ticket_type: str = None):
-    async with async_session() as session:
-        stmt = select(FeedbackTicket).where(FeedbackTicket.status == "open")
-        if ticket_type:
-            stmt = stmt.where(FeedbackTicket.ticket_type == ticket_type)
-        stmt = stmt.order_by(FeedbackTicket.created_at)
-        result = await session.execute(stmt)
-        return result.scalars().all()
-
-async def get_ticket(ticket_id: int):
-    async with async_session() as session:
-        return await session.get(FeedbackTicket, ticket_id)
-
-async def close_ticket(ticket_id: int, reply_text: str = None, responder_id: int = None, responder_name: str = None):
-    async with async_session() as session:
-        ticket = await session.get(FeedbackTicket, ticket_id)
-        if ticket:
-            ticket.status = "closed"
-            if reply_text:
-                ticket.reply_message = reply_text
-                ticket.reply_at = datetime.utcnow()
-            if responder_id:
-                ticket.responder_id = responder_id
-            if responder_name:
-                ticket.responder_name = responder_name
-            await session.commit()
+async def create_ticket(session: AsyncSession, user_id: int, user_name: str, branch_name: str, message: str, ticket_type: str = "problem"):
+    ticket = FeedbackTicket(
+        user_id=user_id, 
+        user_name=user_name, 
+        branch_name=branch_name, 
+        message=message,
+        ticket_type=ticket_type,
+        status="open"
+    )
+    session.add(ticket)
+    await session.flush()
+    await index_ticket(session, ticket)
+    cache.mark_dirty(session, "dashboard")
+    return ticket.id
+
+async def create_order(session: AsyncSession, user_id: int, user_name: str, branch_id: int, branch_name: str, lines: dict, items_text: str):
+    """
+    Заказ материалов: тикет типа "order" (для ответов) + структурированные строки.
+    lines: {item_id: qty}. Возвращает ID тикета.
+    """
+    ticket = FeedbackTicket(
+        user_id=user_id,
+        user_name=user_name,
+        branch_name=branch_name,
+        message=items_text,
+        ticket_type="order",
+        status="open"
+    )
+    ticket.order = Order(branch_id=branch_id)
+    session.add(ticket)
+    await session.flush()
+    await index_ticket(session, ticket)
+    cache.mark_dirty(session, "dashboard")
+
+    await session.execute(
+        insert(OrderLine),
+        [{"order_id": ticket.id, "item_id": int(item_id), "qty": qty} for item_id, qty in lines.items()]
+    )
+    return ticket.id
+
+async def get_open_tickets(session: AsyncSession, ticket_type: str = None):
+    stmt = select(FeedbackTicket).where(FeedbackTicket.status == "open")
+    if ticket_type:
+        stmt = stmt.where(FeedbackTicket.ticket_type == ticket_type)
+    stmt = stmt.order_by(FeedbackTicket.created_at)
+    async with reading(session) as reader:
+        result = await reader.execute(stmt)
+    return result.scalars().all()
+
+class TicketPage(NamedTuple):
+    tickets: list
+    has_prev: bool
+    has_next: bool
+
+async def get_open_tickets_page(session: AsyncSession, ticket_type: str, cursor: Tuple[datetime, int] = None, backward: bool = False, limit: int = config.TICKETS_PAGE_SIZE) -> TicketPage:
+    """
+    Страница открытых тикетов по ключу (created_at, id), от старых к новым.
+    cursor - ключ последнего тикета предыдущей страницы (для backward=True - первого тикета следующей).
+    Читается только limit + 1 строк по индексу, сколько бы тикетов ни накопилось.
+    """
+    key = tuple_(FeedbackTicket.created_at, FeedbackTicket.id)
+    stmt = select(FeedbackTicket).where(FeedbackTicket.status == "open", FeedbackTicket.ticket_type == ticket_type)
+    if cursor:
+        stmt = stmt.where(key < tuple_(*cursor) if backward else key > tuple_(*cursor))
+    if backward:
+        stmt = stmt.order_by(FeedbackTicket.created_at.desc(), FeedbackTicket.id.desc())
+    else:
+        stmt = stmt.order_by(FeedbackTicket.created_at, FeedbackTicket.id)
+
+    async with reading(session) as reader:
+        tickets = list((await reader.execute(stmt.limit(limit + 1))).scalars())
+    more = len(tickets) > limit
+    tickets = tickets[:limit]
+    if backward:
+        tickets.reverse()
+        return TicketPage(tickets, has_prev=more, has_next=True)
+    return TicketPage(tickets, has_prev=cursor is not None, has_next=more)
+
+async def get_ticket(session: AsyncSession, ticket_id: int):
+    async with reading(session) as reader:
+        return await reader.get(FeedbackTicket, ticket_id)
+
+async def close_ticket(session: AsyncSession, ticket_id: int, reply_text: str = None, responder_id: int = None, responder_name: str = None):
+    ticket = await session.get(FeedbackTicket, ticket_id)
+    if ticket:
+        ticket.status = "closed"
+        cache.mark_dirty(session, "dashboard")
+        if reply_text:
+            ticket.reply_message = reply_text
+            ticket.reply_at = datetime.utcnow()
+        if responder_id:
+            ticket.responder_id = responder_id
+        if responder_name:
+            ticket.responder_name = responder_name
+        await index_ticket(session, ticket)
+
 # --- Admin / Panel ---
+# Выборки получателей рассылок пропускают пользователей, заблокировавших бота
 
-async def get_all_users():
-    async with async_session() as session:
-        result = await session.execute(select(User).options(selectinload(User.branch)))
-        return result.scalars().all()
-
-async def get_users_by_branch(branch_id: int):
-    async with async_session() as session:
-        result = await session.execute(select(User).where(User.selected_branch_id == branch_id))
-        return result.scalars().all()
-
-async def get_reports_by_range(days: int = 7):
-    async with async_session() as session:
-        query = select(InventoryReport).order_by(InventoryReport.timestamp.desc())
-        
-        if days and days > 0:
-            cutoff = datetime.utcnow() - timedelta(days=days)
-            query = query.where(InventoryReport.timestamp >= cutoff)
-            
-        result = await session.execute(query)
-        return result.scalars().all()
-
-async def get_tickets_by_range(days: int = 7):
-    async with async_session() as session:
-        query = select(FeedbackTicket).order_by(FeedbackTicket.created_at.desc())
-        
-        if days and days > 0:
-            cutoff = datetime.utcnow() - timedelta(days=days)
-            query = query.where(FeedbackTicket.created_at >= cutoff)
-            
-        result = await session.execute(query)
-        return result.scalars().all()
+async def get_all_users(session: AsyncSession):
+    async with reading(session) as reader:
+        result = await reader.execute(
+            select(User).options(selectinload(User.branch)).where(User.unreachable_since.is_(None))
+        )
+    return result.scalars().all()
 
-# --- Contacts ---
-async def get_contacts():
-    async with async_session() as session:
-        result = await session.execute(select(DepartmentContact))
-        return result.scalars().all()
-
-async def add_contact(department: str, info: str):
-    async with async_session() as session:
-        contact = DepartmentContact(department=department, info=info)
-        session.add(contact)
-        await session.commit()
-        return contact
-
-async def delete_contact(contact_id: int):
-    async with async_session() as session:
-        contact = await session.get(DepartmentContact, contact_id)
-        if contact:
-            await session.delete(contact)
-            await session.commit()
-            return True
-        return False
+class Audience(NamedTuple):
+    """Сегмент получателей рассылки. Пустой кортеж - без ограничения по этому признаку"""
+    sectors: Tuple[str, ...] = ()
+    branch_ids: Tuple[int, ...] = ()
+    languages: Tuple[str, ...] = ()
+    # Только не сдавшие отчет в текущем сборе (как get_users_pending_report)
+    pending_only: bool = False
+
+def _audience_query(column, audience: Audience):
+    stmt = select(column).select_from(User).where(User.unreachable_since.is_(None))
+    if audience.sectors:
+        # Пользователи всего склада работают с обоими секторами
+        stmt = stmt.where(User.sector.in_(sorted({*audience.sectors, config.SECTOR_FULL})))
+    if audience.branch_ids:
+        stmt = stmt.where(User.selected_branch_id.in_(audience.branch_ids))
+    if audience.languages:
+        language = User.language.in_(audience.languages)
+        # Язык не выбран - пользователю пишем по-русски
+        stmt = stmt.where(or_(language, User.language.is_(None)) if "ru" in audience.languages else language)
+    if audience.pending_only:
+        cycle_id = get_current_cycle_id()
+        if cycle_id is None:
+            return stmt.where(false())
+        submitted = and_(InventoryReport.cycle_id == cycle_id, InventoryReport.user_id == User.telegram_id)
+        stmt = (
+            stmt.join(Branch, Branch.id == User.selected_branch_id)
+            .outerjoin(InventoryReport, submitted)
+            .where(InventoryReport.id.is_(None), Branch.name != config.HEAD_OFFICE_NAME)
+        )
+    return stmt
+
+async def count_audience(session: AsyncSession, audience: Audience) -> int:
+    async with reading(session) as reader:
+        return await reader.scalar(_audience_query(func.count(User.telegram_id), audience))
 
-async def get_contact(contact_id: int):
-    async with async_session() as session:
-        return await session.get(DepartmentContact, contact_id)
-
-async def update_contact(contact_id: int, department: str, info: str):
-    async with async_session() as session:
-        contact = await session.get(DepartmentContact, contact_id)
-        if contact:
-            contact.department = department
-            contact.info = info
-            await session.commit()
-            return True
+async def get_audience_ids(session: AsyncSession, audience: Audience) -> array:
+    """ID получателей одним запросом, без загрузки ORM-объектов"""
+    async with reading(session) as reader:
+        return array("q", await reader.scalars(_audience_query(User.telegram_id, audience)))
+
+async def mark_user_unreachable(session: AsyncSession, telegram_id: int, error: str) -> bool:
+    """
+    Пользователь заблокировал бота: исключается из рассылок до следующего /start,
+    а его сообщения, еще ждущие в очереди, снимаются. False - это не пользователь (чат группы) или уже отмечен
+    """
+    result = await session.execute(
+        update(User)
+        .where(User.telegram_id == telegram_id, User.unreachable_since.is_(None))
+        .values(unreachable_since=datetime.utcnow())
+    )
+    if not result.rowcount:
         return False
+    await session.execute(
+        update(OutboxMessage)
+        .where(OutboxMessage.chat_id == telegram_id, OutboxMessage.status == "pending")
+        .values(status="failed", last_error=error)
+    )
+    return True
+
+# Запросы выгрузки в Excel: выполняются синхронно в процессе-воркере (utils/export.py)
+
+def reports_by_range_query(days: int = 7):
+    query = select(InventoryReport).order_by(InventoryReport.timestamp.desc())
+
+    if days and days > 0:
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        query = query.where(InventoryReport.timestamp >= cutoff)
+    return query.execution_options(yield_per=config.EXPORT_BATCH_SIZE)
+
+def tickets_by_range_query(ticket_type: str, days: int = 7):
+    query = (
+        select(FeedbackTicket)
+        .where(FeedbackTicket.ticket_type == ticket_type)
+        .order_by(FeedbackTicket.created_at.desc())
+    )
+
+    if days and days > 0:
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        query = query.where(FeedbackTicket.created_at >= cutoff)
+    return query.execution_options(yield_per=config.EXPORT_BATCH_SIZE)
+
+# --- Contacts ---
+async def get_contacts(session: AsyncSession):
+    return list((await _catalog(session, cache.contacts)).rows)
+
+async def add_contact(session: AsyncSession, department: str, info: str):
+    contact = DepartmentContact(department=department, info=info)
+    session.add(contact)
+    cache.mark_dirty(session, "contacts", "dashboard")
+    return contact
+
+async def delete_contact(session: AsyncSession, contact_id: int):
+    contact = await session.get(DepartmentContact, contact_id)
+    if contact:
+        await session.delete(contact)
+        cache.mark_dirty(session, "contacts", "dashboard")
+        return True
+    return False
+
+async def get_contact(session: AsyncSession, contact_id: int):
+    return (await _catalog(session, cache.contacts)).by_id.get(contact_id)
+
+async def update_contact(session: AsyncSession, contact_id: int, department: str, info: str):
+    contact = await session.get(DepartmentContact, contact_id)
+    if contact:
+        contact.department = department
+        contact.info = info
+        cache.mark_dirty(session, "contacts")
+        return True
+    return False
 
 # --- Statistics ---
 
-async def count_users():
-    async with async_session() as session:
-        result = await session.execute(select(func.count(User.telegram_id)))
-        return result.scalar()
-
-async def count_reports(days: int = 0):
-    async with async_session() as session:
-        result = await session.execute(select(func.count(InventoryReport.id)))
-        # Simple count for now, no filtering implemented in this quick add
-        # If we need days filtering, we should add simple logic
-        stmt = select(func.count(InventoryReport.id))
-        if days > 0:
-            cutoff = datetime.utcnow() - timedelta(days=days)
-            stmt = stmt.where(InventoryReport.timestamp >= cutoff)
-        result = await session.execute(stmt)
-        return result.scalar()
-
-async def count_tickets(ticket_type: str = None, status: str = None):
-    async with async_session() as session:
-        stmt = select(func.count(FeedbackTicket.id))
-        if ticket_type:
-             stmt = stmt.where(FeedbackTicket.ticket_type == ticket_type)
-        if status:
-             stmt = stmt.where(FeedbackTicket.status == status)
-        result = await session.execute(stmt)
-        return result.scalar()
+class DashboardStats(NamedTuple):
+    users: int
+    reports_today: int
+    problems: int
+    orders: int
+    questions: int
+    branches: int
+    items: int
+    contacts: int
 
-async def count_orders():
-    async with async_session() as session:
-        stmt = select(func.count(FeedbackTicket.id)).where(FeedbackTicket.message.like("[ЗАКАЗ МАТЕРИАЛОВ]%"))
-        result = await session.execute(stmt)
-        return result.scalar()
-
-async def count_branches():
-    async with async_session() as session:
-        result = await session.execute(select(func.count(Branch.id)))
-        return result.scalar()
-
-async def count_active_items():
-    async with async_session() as session:
-        result = await session.execute(select(func.count(Item.id)).where(Item.is_active == True))
-        return result.scalar()
-
-async def count_contacts():
-    async with async_session() as session:
-        result = await session.execute(select(func.count(DepartmentContact.id)))
-        return result.scalar()
-
-async def get_users_pending_report():
-    """Возвращает пользователей, которые не сдали отчет за последние 24 часа (кроме Головного офиса)"""
-    async with async_session() as session:
-        cutoff = datetime.utcnow() - timedelta(hours=24)
-        # Subquery: ID пользователей, сдавших отчет
-        subquery = select(InventoryReport.user_id).where(InventoryReport.timestamp >= cutoff)
-        
-        # Select users NOT IN subquery AND Branch != Головной офис
-        # Используем join для фильтрации по Branch.name
-        stmt = select(User).join(Branch).options(selectinload(User.branch)).where(
-            User.telegram_id.not_in(subquery),
-            Branch.name != config.HEAD_OFFICE_NAME
+def invalidate_dashboard_stats():
+    cache.dashboard.invalidate()
+
+def _count_open_tickets(ticket_type: str):
+    return (
+        select(func.count(FeedbackTicket.id))
+        .where(FeedbackTicket.status == "open", FeedbackTicket.ticket_type == ticket_type)
+        .scalar_subquery()
+    )
+
+async def get_dashboard_stats(session: AsyncSession) -> DashboardStats:
+    """Все счетчики главного меню админа одним запросом (каждый - по индексу)"""
+    dirty = cache.is_dirty(session, "dashboard")
+    if not dirty:
+        stats = cache.dashboard.get(None)
+        if stats is not None:
+            return stats
+    generation = cache.dashboard.generation
+
+    cutoff = datetime.utcnow() - timedelta(days=1)
+    stmt = select(
+        select(func.count(User.telegram_id)).scalar_subquery(),
+        select(func.count(InventoryReport.id)).where(InventoryReport.timestamp >= cutoff).scalar_subquery(),
+        _count_open_tickets("problem"),
+        _count_open_tickets("order"),
+        _count_open_tickets("question"),
+        select(func.count(Branch.id)).scalar_subquery(),
+        select(func.count(Item.id)).where(Item.is_active == True).scalar_subquery(),
+        select(func.count(DepartmentContact.id)).scalar_subquery(),
+    )
+    async with reading(session) as reader:
+        row = (await reader.execute(stmt)).one()
+    stats = DashboardStats(*row)
+
+    if not dirty:
+        # Счетчики с незакоммиченными изменениями этой сессии в кэш не попадают
+        cache.dashboard.put(None, stats, generation)
+    return stats
+
+async def get_users_pending_report(session: AsyncSession):
+    """Возвращает пользователей, которые не сдали отчет в текущем сборе (кроме Головного офиса)"""
+    cycle_id = get_current_cycle_id(session)
+    if cycle_id is None:
+        return []
+
+    # Anti-join: пользователи без отчета в этом цикле (поиск по индексу (cycle_id, user_id))
+    submitted = and_(InventoryReport.cycle_id == cycle_id, InventoryReport.user_id == User.telegram_id)
+    stmt = (
+        select(User)
+        .join(Branch)
+        .outerjoin(InventoryReport, submitted)
+        .options(selectinload(User.branch))
+        .where(
+            InventoryReport.id.is_(None),
+            Branch.name != config.HEAD_OFFICE_NAME,
+            User.unreachable_since.is_(None),
         )
-        result = await session.execute(stmt)
-        return result.scalars().all()
+    )
+    async with reading(session) as reader:
+        result = await reader.execute(stmt)
+    return result.scalars().all()
 
 # --- Settings & Inventory Control ---
 
-from database.models import GlobalSettings
+# Настройки читаются из памяти (cache.settings), в БД ходит только запись.
+# Функции записи передают session: так они видят свои еще не закоммиченные значения.
 
-async def set_setting(key: str, value: str):
-    async with async_session() as session:
-        setting = await session.get(GlobalSettings, key)
-        if not setting:
-            setting = GlobalSettings(key=key, value=value)
-            session.add(setting)
-        else:
-            setting.value = value
-        await session.commit()
+class InventorySchedule(NamedTuple):
+    auto_mode: bool
+    start_day: Optional[int]  # None - в настройке не число
+    end_day: Optional[int]
 
-async def get_setting(key: str, default: str = None):
-    async with async_session() as session:
-        setting = await session.get(GlobalSettings, key)
-        return setting.value if setting else default
+async def load_settings(session: AsyncSession):
+    """Загружает все настройки в память. Вызывается один раз при старте"""
+    result = await session.execute(select(GlobalSettings.key, GlobalSettings.value))
+    cache.settings.load(result.all())
 
-async def is_inventory_open():
-    val = await get_setting("inventory_open", "0")
-    return val == "1"
+async def set_setting(session: AsyncSession, key: str, value: str):
+    stmt = dialect_insert(engine, GlobalSettings).values(key=key, value=value)
+    await session.execute(
+        stmt.on_conflict_do_update(index_elements=[GlobalSettings.key], set_={"value": stmt.excluded.value})
+    )
+    cache.settings.write(session, key, value)
 
-async def update_user_sector(telegram_id: int, sector: str):
-    async with async_session() as session:
-        user = await session.get(User, telegram_id)
-        if user:
-            user.sector = sector
-            await session.commit()
+def get_setting(key: str, default: str = None, session: AsyncSession = None):
+    return cache.settings.get(key, default, session)
+
+def is_inventory_open(session: AsyncSession = None):
+    return get_setting("inventory_open", "0", session) == "1"
+
+# --- Inventory cycles ---
+
+CURRENT_CYCLE_KEY = "current_cycle_id"
+
+def get_current_cycle_id(session: AsyncSession = None) -> Optional[int]:
+    """Текущий (или последний закрытый) сбор"""
+    value = get_setting(CURRENT_CYCLE_KEY, session=session)
+    return int(value) if value else None
+
+async def open_inventory_cycle(session: AsyncSession):
+    """Открывает новый сбор: цикл, флаг inventory_open и счетчики прогресса с нуля"""
+    cycle = InventoryCycle()
+    session.add(cycle)
+    await session.flush()
+    await set_setting(session, "inventory_open", "1")
+    await set_setting(session, CURRENT_CYCLE_KEY, str(cycle.id))
+    await rebuild_branch_progress(session, cycle.opened_at)
+    return cycle
+
+async def close_inventory_cycle(session: AsyncSession):
+    cycle_id = get_current_cycle_id(session)
+    if cycle_id:
+        await session.execute(
+            update(InventoryCycle)
+            .where(InventoryCycle.id == cycle_id, InventoryCycle.closed_at.is_(None))
+            .values(closed_at=datetime.utcnow())
+        )
+    await set_setting(session, "inventory_open", "0")
+
+def _day(value: str):
+    return int(value) if value.isdigit() else None
+
+def get_inventory_schedule() -> InventorySchedule:
+    return InventorySchedule(
+        auto_mode=get_setting("inventory_auto_mode", "0") == "1",
+        start_day=_day(get_setting("inventory_start_day", "25")),
+        end_day=_day(get_setting("inventory_end_day", "1")),
+    )
+
+async def update_user_sector(session: AsyncSession, telegram_id: int, sector: str):
+    user = await session.get(User, telegram_id)
+    if user:
+        user.sector = sector
+        cache.mark_key_dirty(session, "users", telegram_id)
             
-async def save_report(user_id: int, branch_name: str, report_data: str, user_name: str = None, sector: str = "full"):
-    async with async_session() as session:
-        report = InventoryReport(
-            user_id=user_id, 
-            branch_name=branch_name, 
-            report_data=report_data,
-            user_name=user_name,
-            sector=sector
+async def save_report(session: AsyncSession, user_id: int, branch_name: str, report_data: str, user_name: str = None, sector: str = "full", lines: dict = None):
+    """
+    lines: {item_id: qty} - пишутся в report_lines одним bulk insert.
+    Для каждой строки сразу считается delta к предыдущему отчету филиала по этому сектору (из stock_levels).
+    """
+    user = await session.get(User, user_id)
+    branch_id = user.selected_branch_id if user else None
+
+    report = InventoryReport(
+        user_id=user_id, 
+        branch_name=branch_name, 
+        branch_id=branch_id,
+        report_data=report_data,
+        user_name=user_name,
+        sector=sector,
+        cycle_id=get_current_cycle_id(session)
+    )
+    session.add(report)
+
+    if user:
+        if user.selected_branch_id and not _reported_this_period(session, user):
+            await _bump_progress(session, user.selected_branch_id, submitted=1)
+        user.last_report_at = datetime.utcnow()
+
+    await session.flush()
+    cache.mark_dirty(session, "dashboard")
+
+    if lines:
+        lines = {int(item_id): qty for item_id, qty in lines.items()}
+        previous = await _stock_levels(session, branch_id, sector, lines) if branch_id else {}
+        rows = [
+            {
+                "report_id": report.id, "item_id": item_id, "qty": qty,
+                "delta": qty - previous[item_id] if item_id in previous else None,
+            }
+            for item_id, qty in lines.items()
+        ]
+        await session.execute(insert(ReportLine), rows)
+        if branch_id:
+            await _update_stock_levels(session, branch_id, sector, report, rows)
+
+def item_totals_query(days: int = 0, by_branch: bool = False):
+    """
+    Суммы по товарам за период (агрегат в SQL по report_lines).
+    Строки (item_name, qty) или (branch_name, item_name, qty) при by_branch=True.
+    """
+    columns = [Item.name, func.sum(ReportLine.qty)]
+    group_by = [Item.id]
+    if by_branch:
+        columns.insert(0, InventoryReport.branch_name)
+        group_by.insert(0, InventoryReport.branch_name)
+
+    stmt = (
+        select(*columns)
+        .select_from(InventoryReport)
+        .join(ReportLine, ReportLine.report_id == InventoryReport.id)
+        .join(Item, Item.id == ReportLine.item_id)
+        .group_by(*group_by)
+        .order_by(*group_by)
+    )
+    if days and days > 0:
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        # Отчеты периода - по индексу даты, их строки - по ключу report_id. Условие на timestamp
+        # в самом JOIN SQLite выполняет полным проходом по report_lines
+        recent = select(InventoryReport.id).where(InventoryReport.timestamp >= cutoff)
+        stmt = stmt.where(ReportLine.report_id.in_(recent))
+    return stmt
+
+# --- Stock history ---
+# Ряд остатков по (филиал, сектор, товар) - это report_lines отчетов филиала по времени,
+# delta к предыдущему отчету пишется в строку при сохранении. stock_levels хранит последнюю точку ряда.
+
+class StockMovement(NamedTuple):
+    branch_id: int
+    branch_name: str
+    sector: str
+    item_name: str
+    qty: int
+    delta: int
+
+async def _stock_levels(session: AsyncSession, branch_id: int, sector: str, item_ids) -> dict:
+    """{item_id: последний остаток}"""
+    result = await session.execute(
+        select(StockLevel.item_id, StockLevel.qty)
+        .where(StockLevel.branch_id == branch_id, StockLevel.sector == sector, StockLevel.item_id.in_(item_ids))
+    )
+    return dict(result.all())
+
+async def _update_stock_levels(session: AsyncSession, branch_id: int, sector: str, report: InventoryReport, rows: list):
+    stmt = dialect_insert(engine, StockLevel)
+    await session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[StockLevel.branch_id, StockLevel.sector, StockLevel.item_id],
+            set_={
+                "qty": stmt.excluded.qty,
+                "delta": stmt.excluded.delta,
+                "report_id": stmt.excluded.report_id,
+                "updated_at": stmt.excluded.updated_at,
+            },
+        ),
+        [
+            {
+                "branch_id": branch_id, "sector": sector, "item_id": r["item_id"], "qty": r["qty"],
+                "delta": r["delta"], "report_id": report.id, "updated_at": report.timestamp,
+            }
+            for r in rows
+        ]
+    )
+
+def stock_history_query(days: int = 0):
+    """Строки ряда остатков (время, филиал, сектор, item_id, остаток, delta) в хронологическом порядке"""
+    stmt = (
+        select(
+            InventoryReport.timestamp, InventoryReport.branch_name, InventoryReport.sector,
+            ReportLine.item_id, ReportLine.qty, ReportLine.delta,
         )
-        session.add(report)
-        await session.commit()
+        .join(ReportLine, ReportLine.report_id == InventoryReport.id)
+        .order_by(InventoryReport.timestamp, InventoryReport.id, ReportLine.item_id)
+        .execution_options(yield_per=config.EXPORT_BATCH_SIZE)
+    )
+    if days and days > 0:
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        stmt = stmt.where(InventoryReport.timestamp >= cutoff)
+    return stmt
+
+async def get_largest_movements(session: AsyncSession, per_branch: int = 5) -> List[StockMovement]:
+    """Крупнейшие по модулю изменения последнего отчета - top per_branch на филиал (только stock_levels)"""
+    ranked = (
+        select(
+            StockLevel.branch_id, StockLevel.sector, StockLevel.item_id, StockLevel.qty, StockLevel.delta,
+            func.row_number().over(
+                partition_by=StockLevel.branch_id,
+                order_by=(func.abs(StockLevel.delta).desc(), StockLevel.item_id),
+            ).label("rank"),
+        )
+        .where(StockLevel.delta.is_not(None), StockLevel.delta != 0)
+        .subquery()
+    )
+    async with reading(session) as reader:
+        result = await reader.execute(
+            select(ranked.c.branch_id, ranked.c.sector, ranked.c.item_id, ranked.c.qty, ranked.c.delta)
+            .where(ranked.c.rank <= per_branch)
+            .order_by(ranked.c.branch_id, ranked.c.rank)
+        )
+
+    branches = (await _catalog(session, cache.branches)).by_id
+    items = (await _catalog(session, cache.items)).by_id
+    movements = []
+    for branch_id, sector, item_id, qty, delta in result:
+        if branch_id not in branches:
+            continue
+        item = items.get(item_id)
+        movements.append(StockMovement(
+            branch_id, branches[branch_id].name, sector, item.name if item else f"#{item_id}", qty, delta
+        ))
+    return movements
+
+# --- Branch progress ---
+# Счетчики "сдали / всего" по филиалам за текущий сбор: таблица branch_progress + копия в памяти
+# (cache.progress). Период сбора начинается с момента в настройке progress_since.
+
+PROGRESS_SINCE_KEY = "progress_since"
+
+def get_progress_since(session: AsyncSession = None) -> Optional[datetime]:
+    value = get_setting(PROGRESS_SINCE_KEY, session=session)
+    return datetime.fromisoformat(value) if value else None
+
+def _reported_this_period(session: AsyncSession, user: User) -> bool:
+    since = get_progress_since(session)
+    return user.last_report_at is not None and (since is None or user.last_report_at >= since)
+
+async def _bump_progress(session: AsyncSession, branch_id: int, total: int = 0, submitted: int = 0):
+    result = await session.execute(
+        update(BranchProgress)
+        .where(BranchProgress.branch_id == branch_id)
+        .values(total=BranchProgress.total + total, submitted=BranchProgress.submitted + submitted)
+    )
+    if result.rowcount:
+        cache.progress.stage(session, ("add", branch_id, total, submitted))
+
+async def rebuild_branch_progress(session: AsyncSession, since: datetime):
+    """
+    Пересчитывает счетчики с нуля для периода, начинающегося в since.
+    При открытии сбора since = сейчас, и все филиалы начинают с 0 сдавших.
+    """
+    has_branch = User.selected_branch_id.is_not(None)
+    totals = dict((await session.execute(
+        select(User.selected_branch_id, func.count()).where(has_branch).group_by(User.selected_branch_id)
+    )).all())
+    submitted = dict((await session.execute(
+        select(User.selected_branch_id, func.count())
+        .where(has_branch, User.last_report_at >= since)
+        .group_by(User.selected_branch_id)
+    )).all())
+    rows = [(b.id, totals.get(b.id, 0), submitted.get(b.id, 0)) for b in await get_branches(session)]
+
+    await session.execute(delete(BranchProgress))
+    if rows:
+        await session.execute(
+            insert(BranchProgress),
+            [{"branch_id": branch_id, "total": total, "submitted": sub} for branch_id, total, sub in rows]
+        )
+    await set_setting(session, PROGRESS_SINCE_KEY, since.isoformat())
+    cache.progress.stage(session, ("reset", rows))
+
+async def load_branch_progress(session: AsyncSession):
+    """Загружает счетчики в память при старте (настройки уже должны быть загружены)"""
+    if get_progress_since() is None:
+        # Первый запуск: как и раньше, считаем сдавших за последние 24 часа
+        await rebuild_branch_progress(session, datetime.utcnow() - timedelta(hours=24))
+        return
+    result = await session.execute(select(BranchProgress.branch_id, BranchProgress.total, BranchProgress.submitted))
+    cache.progress.load(result.all())
+
+async def get_branch_progress(session: AsyncSession):
+    """[(название филиала, всего, сдали)] - без запросов к отчетам и пользователям"""
+    return [(b.name, *cache.progress.counts.get(b.id, (0, 0))) for b in await get_branches(session)]
+
+# --- Outbox ---
+# Исходящие сообщения ставятся в очередь в той же транзакции, что и действие (закрытие тикета,
+# открытие сбора), и доставляются воркером utils/outbox.py.
+# Статусы: pending -> sending -> sent / failed; cancelled - рассылку остановили.
+# sending без результата дольше OUTBOX_CLAIM_TIMEOUT (результат не записался, воркер упал) снова pending:
+# чат не стоит до перезапуска, а сообщение может уйти повторно - доставка "хотя бы один раз".
+
+OUTBOX_ACTIVE = ("pending", "sending")
+
+async def create_outbox_batch(session: AsyncSession, title: str, chat_id: Optional[int] = None, message_id: Optional[int] = None) -> int:
+    batch = OutboxBatch(title=title, chat_id=chat_id, message_id=message_id)
+    session.add(batch)
+    await session.flush()
+    return batch.id
+
+async def enqueue_messages(session: AsyncSession, messages: List[dict], batch_id: Optional[int] = None) -> int:
+    """
+    Ставит сообщения (utils.outbox.text_message / copy_message) в очередь.
+    Сообщения с уже известным dedup_key пропускаются. Возвращает размер рассылки (или число новых без batch_id).
+    """
+    if not messages:
+        return 0
+    table = OutboxMessage.__table__
+    stmt = dialect_insert(engine, table).on_conflict_do_nothing(index_elements=[table.c.dedup_key])
+    result = await session.execute(stmt, [{**m, "batch_id": batch_id} for m in messages])
+    # Воркер проснется сразу после коммита, а не по таймеру
+    session.info["outbox"] = True
+    if batch_id is None:
+        return result.rowcount
+    total = await session.scalar(select(func.count()).where(OutboxMessage.batch_id == batch_id))
+    await session.execute(update(OutboxBatch).where(OutboxBatch.id == batch_id).values(total=total))
+    return total
+
+def _outbox_next_in_chat():
+    # Сообщение в чат не берется, пока в тот же чат ждет более раннее - порядок внутри чата сохраняется
+    earlier = aliased(OutboxMessage)
+    blocked = (
+        select(earlier.id)
+        .where(earlier.chat_id == OutboxMessage.chat_id, earlier.id < OutboxMessage.id, earlier.status.in_(OUTBOX_ACTIVE))
+        .exists()
+    )
+    return and_(OutboxMessage.status == "pending", ~blocked)
+
+async def claim_outbox(session: AsyncSession, limit: int) -> List[OutboxMessage]:
+    """Забирает до limit готовых к отправке сообщений (pending -> sending)"""
+    now = datetime.utcnow()
+    # Просроченные захваты - в очередь: иначе они держат свой чат (см. _outbox_next_in_chat)
+    await session.execute(
+        update(OutboxMessage)
+        .where(OutboxMessage.status == "sending",
+               OutboxMessage.claimed_at < now - timedelta(seconds=config.OUTBOX_CLAIM_TIMEOUT))
+        .values(status="pending")
+    )
+    ids = (await session.scalars(
+        select(OutboxMessage.id)
+        .where(_outbox_next_in_chat(), OutboxMessage.next_attempt_at <= now)
+        .order_by(OutboxMessage.id)
+        .limit(limit)
+    )).all()
+    if not ids:
+        return []
+    await session.execute(
+        update(OutboxMessage)
+        .where(OutboxMessage.id.in_(ids), OutboxMessage.status == "pending")
+        .values(status="sending", claimed_at=now)
+    )
+    return list(await session.scalars(select(OutboxMessage).where(OutboxMessage.id.in_(ids)).order_by(OutboxMessage.id)))
+
+async def get_next_outbox_attempt(session: AsyncSession) -> Optional[datetime]:
+    """Когда станет готово следующее отложенное сообщение"""
+    async with reading(session) as reader:
+        return await reader.scalar(select(func.min(OutboxMessage.next_attempt_at)).where(_outbox_next_in_chat()))
+
+async def mark_outbox_sent(session: AsyncSession, message_id: int):
+    await session.execute(
+        update(OutboxMessage)
+        .where(OutboxMessage.id == message_id)
+        .values(status="sent", sent_at=datetime.utcnow(), attempts=OutboxMessage.attempts + 1, last_error=None)
+    )
+
+async def retry_outbox_message(session: AsyncSession, message_id: int, next_attempt_at: datetime, error: str, count_attempt: bool = True):
+    """Возвращает сообщение в очередь. count_attempt=False - ожидание по требованию Telegram (RetryAfter), а не ошибка"""
+    values = {"status": "pending", "next_attempt_at": next_attempt_at, "last_error": error}
+    if count_attempt:
+        values["attempts"] = OutboxMessage.attempts + 1
+    await session.execute(update(OutboxMessage).where(OutboxMessage.id == message_id).values(**values))
+
+async def mark_outbox_failed(session: AsyncSession, message_id: int, error: str):
+    await session.execute(
+        update(OutboxMessage)
+        .where(OutboxMessage.id == message_id)
+        .values(status="failed", attempts=OutboxMessage.attempts + 1, last_error=error)
+    )
+
+async def release_outbox_claims(session: AsyncSession, ids: Optional[List[int]] = None) -> int:
+    """
+    Забранные сообщения снова в очередь. Без ids - все (при старте: забраны до падения/перезапуска),
+    с ids - только эти (воркер их так и не начал отправлять).
+    """
+    stmt = update(OutboxMessage).where(OutboxMessage.status == "sending")
+    if ids is not None:
+        stmt = stmt.where(OutboxMessage.id.in_(ids))
+    result = await session.execute(stmt.values(status="pending"))
+    return result.rowcount
+
+class BatchProgress(NamedTuple):
+    batch: OutboxBatch
+    sent: int
+    failed: int
+    cancelled: int
+    remaining: int
+
+async def _batch_progress(session: AsyncSession, batch_ids) -> dict:
+    counts = {}
+    rows = await session.execute(
+        select(OutboxMessage.batch_id, OutboxMessage.status, func.count())
+        .where(OutboxMessage.batch_id.in_(batch_ids))
+        .group_by(OutboxMessage.batch_id, OutboxMessage.status)
+    )
+    for batch_id, status, count in rows:
+        counts.setdefault(batch_id, {})[status] = count
+
+    progress = {}
+    for batch_id, by_status in counts.items():
+        batch = await session.get(OutboxBatch, batch_id)
+        progress[batch_id] = BatchProgress(
+            batch, by_status.get("sent", 0), by_status.get("failed", 0), by_status.get("cancelled", 0),
+            sum(by_status.get(s, 0) for s in OUTBOX_ACTIVE),
+        )
+    return progress
+
+async def get_outbox_batch_progress(session: AsyncSession, batch_id: int) -> Optional[BatchProgress]:
+    async with reading(session) as reader:
+        return (await _batch_progress(reader, [batch_id])).get(batch_id)
+
+async def finish_outbox_batches(session: AsyncSession, batch_ids) -> List[BatchProgress]:
+    """Отмечает завершенными рассылки без ожидающих сообщений и возвращает их итоги"""
+    if not batch_ids:
+        return []
+    finished = []
+    now = datetime.utcnow()
+    for progress in (await _batch_progress(session, batch_ids)).values():
+        if progress.remaining:
+            continue
+        result = await session.execute(
+            update(OutboxBatch)
+            .where(OutboxBatch.id == progress.batch.id, OutboxBatch.finished_at.is_(None))
+            .values(finished_at=now)
+        )
+        if result.rowcount:
+            finished.append(progress)
+    return finished
+
+async def cancel_outbox_batch(session: AsyncSession, batch_id: int, chat_id: int) -> Optional[int]:
+    """
+    Останавливает рассылку: неотправленные сообщения -> cancelled. Возвращает, сколько снято;
+    None - рассылка запущена не из этого чата. Уже забранные воркером сообщения он тоже пропустит (outbox.cancel)
+    """
+    batch = await session.get(OutboxBatch, batch_id)
+    if batch is None or batch.chat_id != chat_id:
+        return None
+    result = await session.execute(
+        update(OutboxMessage)
+        .where(OutboxMessage.batch_id == batch_id, OutboxMessage.status.in_(OUTBOX_ACTIVE))
+        .values(status="cancelled")
+    )
+    return result.rowcount
+
+async def mark_outbox_cancelled(session: AsyncSession, message_id: int):
+    await session.execute(
+        update(OutboxMessage).where(OutboxMessage.id == message_id).values(status="cancelled")
+    )
+
+async def purge_outbox(session: AsyncSession, days: int) -> int:
+    """Удаляет обработанные (доставленные, недоставленные, отмененные) сообщения старше days дней"""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    result = await session.execute(
+        delete(OutboxMessage)
+        .where(OutboxMessage.status.in_(("sent", "failed", "cancelled")), OutboxMessage.created_at < cutoff)
+    )
+    has_messages = select(OutboxMessage.id).where(OutboxMessage.batch_id == OutboxBatch.id).exists()
+    await session.execute(delete(OutboxBatch).where(OutboxBatch.created_at < cutoff, ~has_messages))
+    return result.rowcount
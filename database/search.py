@@ -0,0 +1,157 @@
+import re
+from datetime import datetime
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import (
+    Column, DateTime, Integer, MetaData, String, Table, Text,
+    delete, func, insert, literal_column, or_, select, text,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+from database.archive import archive_engine
+from database.models import IS_SQLITE, FeedbackTicket, reading
+
+# Полнотекстовый поиск по тикетам и заказам.
+# SQLite: таблица FTS5 tickets_fts (rowid = id тикета), обновляется в create_ticket / create_order /
+# close_ticket. Строки индекса хранят все, что нужно для выдачи, поэтому тикеты, уехавшие
+# в архив, продолжают находиться. id тикетов не переиспользуются (AUTOINCREMENT, счетчик выше id архива -
+# см. database/archive.py), так что новый тикет не перезапишет строку архивного. На других СУБД -
+# ILIKE по таблице tickets рабочей БД и архива.
+
+# Отдельная MetaData: виртуальную таблицу создает миграция, а не create_all
+tickets_fts = Table(
+    "tickets_fts", MetaData(),
+    Column("rowid", Integer, primary_key=True),
+    Column("message", Text),
+    Column("reply", Text),
+    Column("user_name", String),
+    Column("branch_name", String),
+    Column("ticket_type", String),
+    Column("status", String),
+    Column("created_at", DateTime),
+)
+
+FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS tickets_fts USING fts5("
+    "message, reply, user_name, branch_name, "
+    "ticket_type UNINDEXED, status UNINDEXED, created_at UNINDEXED, "
+    "tokenize = 'unicode61 remove_diacritics 2')"
+)
+
+class SearchHit(NamedTuple):
+    id: int
+    ticket_type: str
+    status: str
+    created_at: datetime
+    user_name: str
+    branch_name: str
+    snippet: str
+
+class SearchPage(NamedTuple):
+    hits: List[SearchHit]
+    page: int
+    has_next: bool
+
+def create_search_index(connection):
+    """Миграция: создает tickets_fts и индексирует уже существующие тикеты"""
+    if not IS_SQLITE:
+        return
+    connection.execute(text(FTS_DDL))
+    if connection.scalar(select(func.count()).select_from(tickets_fts)):
+        return
+    t = FeedbackTicket.__table__
+    connection.execute(
+        insert(tickets_fts).from_select(
+            ["rowid", "message", "reply", "user_name", "branch_name", "ticket_type", "status", "created_at"],
+            select(t.c.id, t.c.message, t.c.reply_message, t.c.user_name, t.c.branch_name,
+                   t.c.ticket_type, t.c.status, t.c.created_at),
+        )
+    )
+
+async def index_ticket(session: AsyncSession, ticket: FeedbackTicket):
+    """Добавляет/обновляет тикет в индексе (в той же транзакции, что и сам тикет). Ключ - id тикета, он уникален и с учетом архива"""
+    if not IS_SQLITE:
+        return
+    await session.execute(delete(tickets_fts).where(tickets_fts.c.rowid == ticket.id))
+    await session.execute(insert(tickets_fts).values(
+        rowid=ticket.id,
+        message=ticket.message,
+        reply=ticket.reply_message,
+        user_name=ticket.user_name,
+        branch_name=ticket.branch_name,
+        ticket_type=ticket.ticket_type,
+        status=ticket.status,
+        created_at=ticket.created_at,
+    ))
+
+# Окончания, которые отбрасываются перед префиксным поиском: "доставка" -> "доставк*" находит и "доставке"
+ENDINGS = "аеёиоуыэюяйь"
+
+def _stem(word: str) -> str:
+    stem = word.rstrip(ENDINGS)
+    return stem if len(stem) >= 4 else word
+
+def _match_query(query: str) -> Optional[str]:
+    # Каждое слово - префиксный поиск в кавычках: операторы FTS5 из ввода не интерпретируются,
+    # а "фильтр" находит и "фильтра", и "фильтры"
+    words = re.findall(r"\w+", query.lower())
+    if not words:
+        return None
+    return " ".join(f'"{_stem(w)}"*' for w in words)
+
+def _preview(message: str, limit: int = 100) -> str:
+    message = " ".join((message or "").split())
+    return message if len(message) <= limit else message[:limit] + "…"
+
+async def search_tickets(session: AsyncSession, query: str, page: int = 0, limit: int = config.TICKETS_PAGE_SIZE) -> SearchPage:
+    """
+    Страница результатов: на SQLite - по релевантности (bm25), иначе - сначала новые.
+    Без FTS5 тикеты ищутся в рабочей БД и в архиве отдельно, выдачи сливаются по дате
+    """
+    if IS_SQLITE:
+        match = _match_query(query)
+        if match is None:
+            return SearchPage([], page, False)
+        stmt = (
+            select(
+                tickets_fts.c.rowid, tickets_fts.c.ticket_type, tickets_fts.c.status, tickets_fts.c.created_at,
+                tickets_fts.c.user_name, tickets_fts.c.branch_name,
+                func.snippet(literal_column("tickets_fts"), -1, "«", "»", "…", 12),
+            )
+            .where(literal_column("tickets_fts").op("MATCH")(match))
+            .order_by(literal_column("rank"), tickets_fts.c.rowid.desc())
+        )
+        async with reading(session) as reader:
+            rows = (await reader.execute(stmt.offset(page * limit).limit(limit + 1))).all()
+    else:
+        words = [_stem(w) for w in re.findall(r"\w+", query.lower())]
+        if not words:
+            return SearchPage([], page, False)
+        t = FeedbackTicket
+        # Все слова должны встретиться хотя бы в одном из полей
+        conditions = [
+            or_(*(col.ilike(f"%{w}%") for col in (t.message, t.reply_message, t.user_name, t.branch_name)))
+            for w in words
+        ]
+        stmt = (
+            select(t.id, t.ticket_type, t.status, t.created_at, t.user_name, t.branch_name, t.message)
+            .where(*conditions)
+            .order_by(t.created_at.desc(), t.id.desc())
+            # Страница общей выдачи может целиком лежать в любой из двух БД: из каждой - все строки до ее конца
+            .limit((page + 1) * limit + 1)
+        )
+        async with reading(session) as reader:
+            found = {row[0]: row for row in (await reader.execute(stmt)).all()}
+        async with archive_engine.connect() as conn:
+            # Тикет из прерванного переноса лежит в обеих БД - остается одна строка
+            for row in (await conn.execute(stmt)).all():
+                found.setdefault(row[0], row)
+        rows = sorted(found.values(), key=lambda row: (row[3], row[0]), reverse=True)
+        rows = rows[page * limit:(page + 1) * limit + 1]
+
+    hits = [
+        SearchHit(row[0], row[1], row[2], row[3], row[4], row[5], _preview(row[6]))
+        for row in rows[:limit]
+    ]
+    return SearchPage(hits, page, len(rows) > limit)
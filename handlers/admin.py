@@ -1,9 +1,11 @@
 from aiogram import Router, types
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import config
 import database.requests as db
+from utils import outbox
 from utils.locales import get_text
 
 router = Router()
@@ -13,7 +15,7 @@ def is_admin(user_id):
     return user_id in config.ADMIN_IDS
 
 @router.message(Command("add_branch"))
-async def add_branch(message: types.Message):
+async def add_branch(message: types.Message, session: AsyncSession):
     if not is_admin(message.from_user.id): return
     
     args = message.text.split(maxsplit=1)
@@ -22,13 +24,18 @@ async def add_branch(message: types.Message):
         return
         
     try:
-        await db.add_branch(args[1])
-        await message.answer(f"Филиал {args[1]} создан.")
+        created = await db.add_branch(session, args[1])
+        # Фиксируем до ответа: единственное соединение-писатель не ждет запросов к Telegram
+        await session.commit()
+        if created:
+            await message.answer(f"Филиал {args[1]} создан.")
+        else:
+            await message.answer(f"Филиал {args[1]} уже существует.")
     except Exception as e:
         await message.answer(f"Ошибка: {e}")
 
 @router.message(Command("add_item"))
-async def add_item(message: types.Message):
+async def add_item(message: types.Message, session: AsyncSession):
     if not is_admin(message.from_user.id): return
     
     args = message.text.split(maxsplit=1)
@@ -37,17 +44,21 @@ async def add_item(message: types.Message):
         return
 
     try:
-        await db.add_item(args[1])
-        await message.answer(f"Товар {args[1]} создан.")
+        created = await db.add_item(session, args[1])
+        await session.commit()
+        if created:
+            await message.answer(f"Товар {args[1]} создан.")
+        else:
+            await message.answer(f"Товар {args[1]} уже существует.")
     except Exception as e:
         await message.answer(f"Ошибка: {e}")
 
 # --- Контакты ---
 @router.message(Command("contacts_admin"))
-async def cmd_list_contacts(message: types.Message):
+async def cmd_list_contacts(message: types.Message, session: AsyncSession):
     if not is_admin(message.from_user.id): return
     
-    contacts = await db.get_contacts()
+    contacts = await db.get_contacts(session)
     if not contacts:
         await message.answer("Контактов нет.")
         return
@@ -60,7 +71,7 @@ async def cmd_list_contacts(message: types.Message):
     await message.answer(text, parse_mode="Markdown")
 
 @router.message(Command("add_contact"))
-async def cmd_add_contact(message: types.Message):
+async def cmd_add_contact(message: types.Message, session: AsyncSession):
     if not is_admin(message.from_user.id): return
     
     args = message.text.split(maxsplit=2)
@@ -71,11 +82,12 @@ async def cmd_add_contact(message: types.Message):
     dept = args[1]
     info = args[2]
     
-    await db.add_contact(dept, info)
+    await db.add_contact(session, dept, info)
+    await session.commit()
     await message.answer(f"✅ Добавлено: {dept} - {info}")
 
 @router.message(Command("del_contact"))
-async def cmd_del_contact(message: types.Message):
+async def cmd_del_contact(message: types.Message, session: AsyncSession):
     if not is_admin(message.from_user.id): return
     
     args = message.text.split(maxsplit=1)
@@ -85,7 +97,9 @@ async def cmd_del_contact(message: types.Message):
         
     try:
         cid = int(args[1])
-        if await db.delete_contact(cid):
+        deleted = await db.delete_contact(session, cid)
+        await session.commit()
+        if deleted:
             await message.answer(f"✅ Контакт {cid} удален.")
         else:
             await message.answer("❌ Контакт не найден.")
@@ -93,7 +107,7 @@ async def cmd_del_contact(message: types.Message):
         await message.answer("ID должен быть числом.")
 
 @router.message(Command("remind"))
-async def cmd_remind_report(message: types.Message):
+async def cmd_remind_report(message: types.Message, session: AsyncSession):
     """
     Отправляет напоминание всем пользователям о сдаче отчета.
     Использование: /remind 17:00 Пятницы
@@ -106,15 +120,15 @@ async def cmd_remind_report(message: types.Message):
         return
         
     deadline_text = args[1]
-    users = await db.get_all_users()
+    users = await db.get_all_users(session)
     
     if not users:
         await message.answer("Пользователей не найдено.")
         return
         
-    await message.answer(f"⏳ Рассылка напоминания для {len(users)} пользователей...")
+    status = await message.answer(f"⏳ Рассылка напоминания для {len(users)} пользователей...")
     
-    count = 0
+    messages = []
     for u in users:
         lang = u.language
         text = f"{get_text(lang, 'reminder_header')}\n\n{get_text(lang, 'reminder_body').format(date=deadline_text)}"
@@ -122,10 +136,11 @@ async def cmd_remind_report(message: types.Message):
         builder = InlineKeyboardBuilder()
         builder.button(text=get_text(lang, "btn_inventory"), callback_data="start_inventory")
         
-        try:
-            await message.bot.send_message(u.telegram_id, text, parse_mode="Markdown", reply_markup=builder.as_markup())
-            count += 1
-        except Exception:
-            pass
-            
-    await message.answer(f"✅ Напоминание отправлено {count} из {len(users)} пользователей.")
+        messages.append(outbox.text_message(
+            u.telegram_id, text, parse_mode="Markdown", reply_markup=builder.as_markup(),
+            dedup_key=f"remind:{message.chat.id}:{message.message_id}:{u.telegram_id}",
+        ))
+
+    # Прогресс (с кнопкой "Остановить") и итог - в сообщении о начале рассылки
+    batch_id = await db.create_outbox_batch(session, "Напоминание", status.chat.id, status.message_id)
+    await db.enqueue_messages(session, messages, batch_id)
@@ -2,22 +2,24 @@ from aiogram import Router, F, types
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import Command, StateFilter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import config
 import database.requests as db
 from states import AdminReplyState
+from utils import outbox
 
 router = Router()
 
 # --- Просмотр списка тикетов ---
 @router.message(Command("tickets"))
-async def cmd_tickets_list(message: types.Message):
+async def cmd_tickets_list(message: types.Message, session: AsyncSession):
     # Доступ только из группы или админам
     allowed_chats = [config.SUPPORT_GROUP_ID, config.QUESTIONS_GROUP_ID]
     if message.chat.id not in allowed_chats and message.from_user.id not in config.ADMIN_IDS:
         return
 
-    tickets = await db.get_open_tickets()
+    tickets = await db.get_open_tickets(session)
     if not tickets:
         await message.reply("🎉 Нет открытых заявок!")
         return
@@ -37,7 +39,7 @@ async def cmd_tickets_list(message: types.Message):
 # --- Ответ на тикет (ввод ID) ---
 
 @router.message(F.text.regexp(r"^\d+$"), StateFilter(None))
-async def ticket_id_reply_start(message: types.Message, state: FSMContext):
+async def ticket_id_reply_start(message: types.Message, state: FSMContext, session: AsyncSession):
     # Доступ только из группы или админам
     allowed_chats = [config.SUPPORT_GROUP_ID, config.QUESTIONS_GROUP_ID]
     if message.chat.id not in allowed_chats and message.from_user.id not in config.ADMIN_IDS:
@@ -48,10 +50,10 @@ async def ticket_id_reply_start(message: types.Message, state: FSMContext):
     except ValueError:
         return
 
-    await start_reply_process(message, state, ticket_id)
+    await start_reply_process(message, state, ticket_id, session)
 
 @router.callback_query(F.data.startswith("reply_ticket_"))
-async def ticket_reply_callback(callback: types.CallbackQuery, state: FSMContext):
+async def ticket_reply_callback(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     # Доступ только из группы или админам
     allowed_chats = [config.SUPPORT_GROUP_ID, config.QUESTIONS_GROUP_ID]
     if callback.message.chat.id not in allowed_chats and callback.from_user.id not in config.ADMIN_IDS:
@@ -59,11 +61,11 @@ async def ticket_reply_callback(callback: types.CallbackQuery, state: FSMContext
         return
 
     ticket_id = int(callback.data.split("_")[2])
-    await start_reply_process(callback.message, state, ticket_id)
+    await start_reply_process(callback.message, state, ticket_id, session)
     await callback.answer()
 
-async def start_reply_process(message: types.Message, state: FSMContext, ticket_id: int):
-    ticket = await db.get_ticket(ticket_id)
+async def start_reply_process(message: types.Message, state: FSMContext, ticket_id: int, session: AsyncSession):
+    ticket = await db.get_ticket(session, ticket_id)
     if not ticket:
         # Если тикет не найден, сообщаем
         await message.reply("❌ Тикет не найден.")
@@ -87,7 +89,7 @@ async def start_reply_process(message: types.Message, state: FSMContext, ticket_
     )
 
 @router.message(AdminReplyState.write_reply)
-async def send_reply_to_user(message: types.Message, state: FSMContext):
+async def send_reply_to_user(message: types.Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     target_user_id = data.get("reply_to_user_id")
     ticket_id = data.get("ticket_id")
@@ -97,35 +99,36 @@ async def send_reply_to_user(message: types.Message, state: FSMContext):
         await state.clear()
         return
 
-    try:
-        # Отправляем сообщение пользователю
-        await message.bot.send_message(
-            target_user_id,
-            f"Менеджер {message.from_user.full_name} ответил на вашу заявку #{ticket_id}:\n{message.text}",
-            parse_mode="Markdown"
-        )
-        
-        # Закрываем тикет в БД и сохраняем ответ
-        await db.close_ticket(
-            ticket_id, 
-            message.text, 
-            responder_id=message.from_user.id, 
-            responder_name=message.from_user.full_name
-        )
-        
-        await message.reply(f"✅ Ответ отправлен. Тикет #{ticket_id} закрыт.")
-    except Exception as e:
-        await message.reply(f"❌ Не удалось отправить: {e}")
+    # Итог доставки заменит это сообщение
+    status = await message.reply(f"⏳ Тикет #{ticket_id} закрыт, ответ отправляется...")
+
+    # Закрываем тикет в БД и сохраняем ответ
+    await db.close_ticket(
+        session,
+        ticket_id, 
+        message.text, 
+        responder_id=message.from_user.id, 
+        responder_name=message.from_user.full_name
+    )
+
+    # Ответ пользователю - через очередь, в одной транзакции с закрытием тикета
+    batch_id = await db.create_outbox_batch(session, f"Ответ на заявку #{ticket_id}", status.chat.id, status.message_id)
+    await db.enqueue_messages(session, [outbox.text_message(
+        target_user_id,
+        f"Менеджер {message.from_user.full_name} ответил на вашу заявку #{ticket_id}:\n{message.text}",
+        parse_mode="Markdown",
+        dedup_key=f"reply:{message.chat.id}:{ticket_id}:{message.message_id}",
+    )], batch_id)
     
     await state.clear()
 
 # --- Отчеты ---
 @router.message(Command("report"))
-async def cmd_report_group(message: types.Message):
+async def cmd_report_group(message: types.Message, session: AsyncSession):
     if message.chat.id != config.SUPPORT_GROUP_ID and message.from_user.id not in config.ADMIN_IDS:
         return
 
-    reports = await db.get_last_reports(limit=5)
+    reports = await db.get_last_reports(session, limit=5)
     if not reports:
         await message.reply("Нет свежих отчетов.")
         return
@@ -1,6 +1,7 @@
 from aiogram import Router, F, types
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import database.requests as db
 import keyboards.reply as kb_reply
@@ -34,6 +35,7 @@ async def cmd_help(message: types.Message):
             "🔸 **/remind <Text>** - Рассылка напоминания (устар. лучше через меню)\n"
             "   Настройте авто-открытие в меню `/admin` -> Авто-расписание.\n"
             "   Или открывайте вручную.\n\n"
+            "🔸 `/search <текст>` - Поиск по всем тикетам и заказам (включая закрытые)\n\n"
             "🔸 **Тикеты и Заказы (Группы):**\n"
             "   Отвечайте на них прямо из меню `/admin` кнопкой 'Ответить'.\n"
             "   Так же можно отвечать в Группах Поддержки, нажав кнопку под сообщением."
@@ -42,9 +44,11 @@ async def cmd_help(message: types.Message):
     await message.answer(text, parse_mode="Markdown")
 
 @router.message(CommandStart())
-async def cmd_start(message: types.Message):
+async def cmd_start(message: types.Message, session: AsyncSession):
     user_id = message.from_user.id
-    user = await db.add_user(user_id)
+    user = await db.add_user(session, user_id)
+    # Фиксируем до ответов: единственное соединение-писатель не ждет запросов к Telegram
+    await session.commit()
     
     # Если пользователь уже настроен (выбрал филиал), сразу открываем меню
     if user.selected_branch_id:
@@ -68,17 +72,18 @@ async def cmd_start(message: types.Message):
     )
 
 @router.callback_query(F.data.startswith("lang_"))
-async def cb_language_select(callback: types.CallbackQuery):
+async def cb_language_select(callback: types.CallbackQuery, session: AsyncSession):
     lang_code = callback.data.split("_")[1]
-    await db.update_user_language(callback.from_user.id, lang_code)
+    await db.update_user_language(session, callback.from_user.id, lang_code)
+    await session.commit()
     
     text = get_text(lang_code, "lang_selected")
     await callback.message.answer(text)
     
     # Теперь проверяем филиал
-    user = await db.get_user(callback.from_user.id)
+    user = await db.get_user(session, callback.from_user.id)
     if not user.selected_branch_id:
-        branches = await db.get_branches()
+        branches = await db.get_branches(session)
         if not branches:
             await callback.message.answer("No branches found.")
         else:
@@ -91,23 +96,25 @@ async def cb_language_select(callback: types.CallbackQuery):
 from states import RegistrationState
 
 @router.callback_query(F.data.startswith("branch_"))
-async def cb_branch_select(callback: types.CallbackQuery, state: FSMContext):
+async def cb_branch_select(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     branch_id = int(callback.data.split("_")[1])
-    await db.update_user_branch(callback.from_user.id, branch_id)
+    await db.update_user_branch(session, callback.from_user.id, branch_id)
     
-    user = await db.get_user(callback.from_user.id)
+    user = await db.get_user(session, callback.from_user.id)
     lang = user.language if user else "ru"
     
     # Если Головной офис - пропускаем выбор сектора
     # Если Головной офис - пропускаем выбор сектора
-    if user.branch and user.branch.name == config.HEAD_OFFICE_NAME:
-        await db.update_user_sector(callback.from_user.id, config.SECTOR_FULL)
+    if user.branch_name == config.HEAD_OFFICE_NAME:
+        await db.update_user_sector(session, callback.from_user.id, config.SECTOR_FULL)
+        await session.commit()
         await callback.message.answer(get_text(lang, "branch_saved"), reply_markup=kb_reply.main_menu(lang))
         await state.clear()
         await callback.answer()
         return
 
     # Теперь спрашиваем сектор
+    await session.commit()
     await callback.message.answer(
         get_text(lang, "select_sector_header"), 
         reply_markup=kb_reply.select_sector_kb()
@@ -116,8 +123,8 @@ async def cb_branch_select(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(RegistrationState.select_sector)
-async def cb_sector_select(message: types.Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
+async def cb_sector_select(message: types.Message, state: FSMContext, session: AsyncSession):
+    user = await db.get_user(session, message.from_user.id)
     lang = user.language if user else "ru"
     
     # Определяем код сектора по тексту
@@ -129,7 +136,8 @@ async def cb_sector_select(message: types.Message, state: FSMContext):
         sector_code = config.SECTOR_AP
     # иначе full (Весь склад)
     
-    await db.update_user_sector(message.from_user.id, sector_code)
+    await db.update_user_sector(session, message.from_user.id, sector_code)
+    await session.commit()
     
     await message.answer(get_text(lang, "branch_saved"), reply_markup=kb_reply.main_menu(lang))
     await state.clear()
@@ -137,10 +145,10 @@ async def cb_sector_select(message: types.Message, state: FSMContext):
 # --- Настройки ---
 
 @router.message(F.text.in_({"⚙️ Настройки", "⚙️ Баптаулар"}))
-async def cmd_settings(message: types.Message):
-    user = await db.get_user(message.from_user.id)
+async def cmd_settings(message: types.Message, session: AsyncSession):
+    user = await db.get_user(session, message.from_user.id)
     lang = user.language
-    branch_name = user.branch.name if user.branch else "---"
+    branch_name = user.branch_name or "---"
     
     text = get_text(lang, "current_settings").format(lang=lang.upper(), branch=branch_name)
     await message.answer(text, reply_markup=kb_inline.settings_menu(lang))
@@ -151,19 +159,19 @@ async def cb_settings_lang(callback: types.CallbackQuery):
     await callback.answer()
 
 @router.callback_query(F.data == "settings_branch")
-async def cb_settings_branch(callback: types.CallbackQuery):
-    branches = await db.get_branches()
-    user = await db.get_user(callback.from_user.id)
+async def cb_settings_branch(callback: types.CallbackQuery, session: AsyncSession):
+    branches = await db.get_branches(session)
+    user = await db.get_user(session, callback.from_user.id)
     lang = user.language
     await callback.message.answer(get_text(lang, "select_branch"), reply_markup=kb_inline.branches_list(branches))
     await callback.answer()
 
 @router.message(F.text.in_({"📞 Контакты отделов", "📞 Бөлімдер байланысы"}))
-async def cmd_contacts(message: types.Message):
-    user = await db.get_user(message.from_user.id)
+async def cmd_contacts(message: types.Message, session: AsyncSession):
+    user = await db.get_user(session, message.from_user.id)
     lang = user.language if user else "ru"
     
-    contacts = await db.get_contacts()
+    contacts = await db.get_contacts(session)
     
     if not contacts:
         await message.answer(get_text(lang, "contacts_empty"), parse_mode="Markdown")
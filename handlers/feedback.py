@@ -1,18 +1,20 @@
 from aiogram import Router, F, types
 from aiogram.fsm.context import FSMContext
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import config
 import keyboards.reply as kb_reply
 import database.requests as db
 from states import FeedbackState
+from utils import outbox
 from utils.locales import get_text
 
 router = Router()
 
 @router.message(F.text.in_({"⚠️ Сообщить о проблеме", "⚠️ Мәселе туралы хабарлау", "❓ Задать вопрос", "❓ Сұрақ қою"}))
-async def feedback_start(message: types.Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
+async def feedback_start(message: types.Message, state: FSMContext, session: AsyncSession):
+    user = await db.get_user(session, message.from_user.id)
     lang = user.language
     
     # Определяем тип тикета по тексту кнопки
@@ -28,10 +30,10 @@ async def feedback_start(message: types.Message, state: FSMContext):
     await state.set_state(FeedbackState.write_message)
 
 @router.message(FeedbackState.write_message)
-async def feedback_send(message: types.Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
+async def feedback_send(message: types.Message, state: FSMContext, session: AsyncSession):
+    user = await db.get_user(session, message.from_user.id)
     lang = user.language if user else "ru"
-    branch_name = user.branch.name if user and user.branch else "---"
+    branch_name = user.branch_name if user and user.branch_name else "---"
 
     data = await state.get_data()
     ticket_type = data.get("ticket_type", "problem")
@@ -39,13 +41,13 @@ async def feedback_send(message: types.Message, state: FSMContext):
     # Создаем тикет в БД
     message_content = message.text or message.caption or "[Media]"
     ticket_id = await db.create_ticket(
+        session,
         user_id=message.from_user.id,
         user_name=message.from_user.full_name,
         branch_name=branch_name,
         message=message_content,
         ticket_type=ticket_type
     )
-
     if ticket_type == "question":
         header_template = get_text(lang, "question_header")
         target_group = config.QUESTIONS_GROUP_ID
@@ -57,6 +59,7 @@ async def feedback_send(message: types.Message, state: FSMContext):
     header += f"\n🔢 Ticket ID: #{ticket_id}"
 
     if not target_group:
+        await session.commit()
         await message.answer("Error: Target group not configured.")
         await state.clear()
         return
@@ -65,12 +68,16 @@ async def feedback_send(message: types.Message, state: FSMContext):
     # Теперь в кнопке передаем ID тикета
     builder.button(text=get_text(lang, "feedback_reply_btn"), callback_data=f"reply_ticket_{ticket_id}")
     
-    try:
-        await message.bot.send_message(target_group, header, parse_mode="Markdown")
-        await message.copy_to(target_group, reply_markup=builder.as_markup())
-        await message.answer(get_text(lang, "feedback_sent"), reply_markup=kb_reply.main_menu(lang))
-    except Exception as e:
-        print(f"Error sending feedback: {e}")
-        await message.answer("Error sending message.")
-            
+    # В группу - через очередь, в одной транзакции с тикетом: заголовок, затем копия обращения
+    await db.enqueue_messages(session, [
+        outbox.text_message(target_group, header, parse_mode="Markdown", dedup_key=f"ticket:{ticket_id}:header"),
+        outbox.copy_message(
+            target_group, message.chat.id, message.message_id,
+            reply_markup=builder.as_markup(), dedup_key=f"ticket:{ticket_id}:copy",
+        ),
+    ])
+    # Фиксируем сразу, чтобы не держать запись в БД на время ответа пользователю
+    await session.commit()
+
+    await message.answer(get_text(lang, "feedback_sent"), reply_markup=kb_reply.main_menu(lang))
     await state.clear()
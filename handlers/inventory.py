@@ -1,5 +1,6 @@
 from aiogram import Router, F, types
 from aiogram.fsm.context import FSMContext
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import database.requests as db
 import keyboards.reply as kb_reply
@@ -10,16 +11,16 @@ from utils.locales import get_text
 router = Router()
 
 @router.message(F.text.in_({"📦 Отправить остатки", "📦 Қалдықтарды жіберу"}))
-async def start_inventory(message: types.Message, state: FSMContext):
-    await start_inventory_logic(message, state, message.from_user.id)
+async def start_inventory(message: types.Message, state: FSMContext, session: AsyncSession):
+    await start_inventory_logic(message, state, message.from_user.id, session)
 
 @router.callback_query(F.data == "start_inventory")
-async def start_inventory_callback(callback: types.CallbackQuery, state: FSMContext):
+async def start_inventory_callback(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     await callback.answer()
-    await start_inventory_logic(callback.message, state, callback.from_user.id)
+    await start_inventory_logic(callback.message, state, callback.from_user.id, session)
 
-async def start_inventory_logic(message: types.Message, state: FSMContext, user_id: int):
-    user = await db.get_user(user_id)
+async def start_inventory_logic(message: types.Message, state: FSMContext, user_id: int, session: AsyncSession):
+    user = await db.get_user(session, user_id)
     lang = user.language
 
     if not user.selected_branch_id:
@@ -27,7 +28,7 @@ async def start_inventory_logic(message: types.Message, state: FSMContext, user_
         return
 
     # Головной офис check
-    if user.branch and user.branch.name == config.HEAD_OFFICE_NAME:
+    if user.branch_name == config.HEAD_OFFICE_NAME:
         msg = get_text(lang, "inventory_head_office_deny")
         await message.answer(msg)
         return
@@ -35,11 +36,11 @@ async def start_inventory_logic(message: types.Message, state: FSMContext, user_
 
     # Проверяем, открыта ли инвентаризация
     # Проверяем, открыта ли инвентаризация
-    if not await db.is_inventory_open():
+    if not db.is_inventory_open():
         await message.answer(get_text(lang, "inventory_closed_warning"))
         return
 
-    items = await db.get_active_items()
+    items = await db.get_active_items(session)
     if not items:
         await message.answer(get_text(lang, "inventory_start_err_empty"))
         return
@@ -56,6 +57,7 @@ async def start_inventory_logic(message: types.Message, state: FSMContext, user_
         items=items_data, 
         current_index=0, 
         report={}, 
+        lines={}, 
         branch_id=user.selected_branch_id, 
         lang=lang,
         user_sector=user_sector
@@ -72,7 +74,7 @@ async def start_inventory_logic(message: types.Message, state: FSMContext, user_
     await state.set_state(InventoryState.fill_item)
 
 @router.message(InventoryState.fill_item)
-async def process_item_count(message: types.Message, state: FSMContext):
+async def process_item_count(message: types.Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     lang = data.get("lang", "ru")
 
@@ -84,18 +86,21 @@ async def process_item_count(message: types.Message, state: FSMContext):
     items = data['items']
     idx = data['current_index']
     report = data['report']
+    lines = data.get('lines', {})
     
     current_item_name = items[idx]['name']
     report[current_item_name] = count
+    # Ключи строкой - чтобы состояние сериализовалось в любом FSM storage
+    lines[str(items[idx]['id'])] = count
     
     next_idx = idx + 1
     if next_idx < len(items):
-        await state.update_data(current_index=next_idx, report=report)
+        await state.update_data(current_index=next_idx, report=report, lines=lines)
         next_item = items[next_idx]['name']
         await message.answer(f"{get_text(lang, 'enter_qty')} {next_item}")
     else:
         branch_id = data['branch_id']
-        branch = await db.get_branch_by_id(branch_id)
+        branch = await db.get_branch_by_id(session, branch_id)
         branch_name = branch.name if branch else "Unknown"
         user_sector = data.get("user_sector", config.SECTOR_FULL)
         
@@ -104,12 +109,16 @@ async def process_item_count(message: types.Message, state: FSMContext):
         
         # Сохраняем с учетом сектора
         await db.save_report(
+            session,
             user_id=message.from_user.id, 
             branch_name=branch_name, 
             report_data=summary, 
             user_name=message.from_user.full_name,
-            sector=user_sector
+            sector=user_sector,
+            lines=lines
         )
+        # Фиксируем сразу, чтобы не держать запись в БД на время ответа пользователю
+        await session.commit()
         
         # Уведомления админам (опционально, можно убрать чтобы не спамить)
         # for admin_id in config.ADMIN_IDS:
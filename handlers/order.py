@@ -1,11 +1,13 @@
 from aiogram import Router, F, types
 from aiogram.fsm.context import FSMContext
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from sqlalchemy.ext.asyncio import AsyncSession
 import asyncio
 import config
 import database.requests as db
 import keyboards.reply as kb_reply
 from states import OrderState
+from utils import outbox
 from utils.locales import get_text
 
 router = Router()
@@ -24,9 +26,9 @@ def get_items_keyboard(items, lang, cart=None):
     # Кнопка Отмена
     builder.button(text=get_text(lang, 'order_cancel_btn'), callback_data="order_cancel")
     
-    # Товары
+    # Товары (корзина: {str(item_id): qty})
     for item in items:
-        qty = cart.get(item.name)
+        qty = cart.get(str(item.id))
         if qty:
             btn_text = f"✅ {item.name} ({qty})"
         else:
@@ -38,8 +40,8 @@ def get_items_keyboard(items, lang, cart=None):
     return builder.as_markup()
 
 @router.message(F.text.in_({"📦 Заказ материалов", "📦 Материалдарға тапсырыс"}))
-async def order_start(message: types.Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
+async def order_start(message: types.Message, state: FSMContext, session: AsyncSession):
+    user = await db.get_user(session, message.from_user.id)
     lang = user.language if user else "ru"
     
     if not user.selected_branch_id:
@@ -48,31 +50,31 @@ async def order_start(message: types.Message, state: FSMContext):
 
     # Головной офис check
     # Головной офис check
-    if user.branch and user.branch.name == config.HEAD_OFFICE_NAME:
+    if user.branch_name == config.HEAD_OFFICE_NAME:
         msg = get_text(lang, "order_head_office_deny")
         await message.answer(msg)
         return
 
-    items = await db.get_active_items()
+    items = await db.get_active_items(session)
     if not items:
         await message.answer(get_text(lang, "inventory_start_err_empty"))
         return
     
     # Инициализируем корзину
-    await state.update_data(cart={}, lang=lang, branch_id=user.selected_branch_id)
+    await state.update_data(cart={}, cart_names={}, lang=lang, branch_id=user.selected_branch_id)
     
     kb = get_items_keyboard(items, lang, cart={})
     await message.answer(get_text(lang, "order_choose_item"), reply_markup=kb)
     await state.set_state(OrderState.choose_item)
 
 @router.callback_query(OrderState.choose_item, F.data.startswith("order_item_"))
-async def order_item_click(callback: types.CallbackQuery, state: FSMContext):
+async def order_item_click(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     item_id = int(callback.data.split("_")[2])
     data = await state.get_data()
     lang = data.get("lang", "ru")
     
     # Ищем название товара (лучше бы закэшировать, но для небольшого списка сойдет)
-    items = await db.get_active_items() 
+    items = await db.get_active_items(session) 
     item_name = next((i.name for i in items if i.id == item_id), "Item")
     
     # Сохраняем ID сообщения меню, чтобы потом к нему вернуться или удалить
@@ -87,7 +89,7 @@ async def order_item_click(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(OrderState.enter_qty)
-async def order_enter_qty(message: types.Message, state: FSMContext):
+async def order_enter_qty(message: types.Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     lang = data.get("lang", "ru")
     menu_msg_id = data.get("menu_msg_id")
@@ -107,16 +109,19 @@ async def order_enter_qty(message: types.Message, state: FSMContext):
         
     qty = int(message.text)
     cart = data.get("cart", {})
+    cart_names = data.get("cart_names", {})
+    item_id = str(data.get("current_item_id"))
     item_name = data.get("current_item_name")
     
-    cart[item_name] = qty
-    await state.update_data(cart=cart)
+    cart[item_id] = qty
+    cart_names[item_id] = item_name
+    await state.update_data(cart=cart, cart_names=cart_names)
     
     # Возвращаемся к выбору: Редактируем то самое сообщение, которое сейчас спрашивает "Введите количество"
     # Но так как мы удалили сообщение юзера, у нас нет объекта message для edit_text старого сообщения,
     # но мы знаем menu_msg_id. Используем bot.edit_message_text
     
-    items = await db.get_active_items()
+    items = await db.get_active_items(session)
     kb = get_items_keyboard(items, lang, cart)
     
     added_text = get_text(lang, "order_added").format(item=item_name, qty=qty)
@@ -144,7 +149,7 @@ async def order_cancel(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
 
 @router.callback_query(OrderState.choose_item, F.data == "order_done")
-async def order_done(callback: types.CallbackQuery, state: FSMContext):
+async def order_done(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     lang = data.get("lang", "ru")
     cart = data.get("cart", {})
@@ -154,33 +159,40 @@ async def order_done(callback: types.CallbackQuery, state: FSMContext):
         return
         
     # Формируем заказ
-    branch = await db.get_branch_by_id(data['branch_id'])
+    branch = await db.get_branch_by_id(session, data['branch_id'])
     branch_name = branch.name if branch else "Unknown"
     
-    items_str = "\n".join([f"▫️ {k}: {v} шт." for k, v in cart.items()])
+    cart_names = data.get("cart_names", {})
+    items_str = "\n".join([f"▫️ {cart_names.get(k, k)}: {v} шт." for k, v in cart.items()])
     
     header_template = get_text(lang, "order_header")
     order_text = header_template.format(branch=branch_name, user=callback.from_user.full_name, items=items_str)
     
-    # Создаем Тикет в БД (чтобы админы могли ответить "Принято в работу")
-    ticket_id = await db.create_ticket(
+    # Создаем заказ в БД (с тикетом, чтобы админы могли ответить "Принято в работу")
+    ticket_id = await db.create_order(
+        session,
         user_id=callback.from_user.id,
         user_name=callback.from_user.full_name,
+        branch_id=data['branch_id'],
         branch_name=branch_name,
-        message="[ЗАКАЗ МАТЕРИАЛОВ]\n" + items_str
+        lines=cart,
+        items_text=items_str
     )
     
-    # Отправляем в группу
+    # Отправляем в группу (через очередь, в одной транзакции с заказом)
     if config.SUPPORT_GROUP_ID:
         builder = InlineKeyboardBuilder()
         builder.button(text=f"Ответить #{ticket_id}", callback_data=f"reply_ticket_{ticket_id}")
         
-        await callback.bot.send_message(
+        await db.enqueue_messages(session, [outbox.text_message(
             config.SUPPORT_GROUP_ID, 
             order_text + f"\n\n🔢 Ticket ID: #{ticket_id}", 
             reply_markup=builder.as_markup(),
-            parse_mode="Markdown"
-        )
+            parse_mode="Markdown",
+            dedup_key=f"order:{ticket_id}",
+        )])
+    # Фиксируем сразу, чтобы не держать запись в БД на время ответа пользователю
+    await session.commit()
     
     await callback.message.edit_text(get_text(lang, "order_sent"))
     # Возврат в меню (хотя мы не убирали Reply клаву, так что она там)
@@ -7,17 +7,29 @@ from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 
 import config
-from database.models import init_db
+from database.models import async_session
+from database.migrations import init_db
+from database import archive
+import database.requests as db
+from middlewares.db import DbSessionMiddleware
 from handlers import basic, inventory, feedback, admin, admin_group, order, admin_panel
-from utils import scheduler
+from utils import scheduler, export, outbox
 
 async def main():
     # Инициализация БД
     await init_db()
+    await archive.ensure_schema()
+    async with async_session() as session:
+        await db.load_settings(session)
+        await db.load_branch_progress(session)
+        await session.commit()
 
     bot = Bot(token=config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     dp = Dispatcher()
 
+    # Одна сессия БД на апдейт
+    dp.update.middleware(DbSessionMiddleware(session_pool=async_session))
+
     # Подключаем роутеры модулей
     dp.include_routers(
         admin.router,
@@ -33,8 +45,14 @@ async def main():
     
     # Запуск планировщика
     scheduler.start_scheduler(bot)
+    # Доставка исходящих сообщений (в том числе оставшихся с прошлого запуска)
+    outbox.start(bot)
     
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await outbox.stop()
+        export.shutdown()
 
 if __name__ == "__main__":
     if sys.platform == 'win32':
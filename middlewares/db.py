@@ -0,0 +1,37 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Открывает одну сессию БД на апдейт и передает ее в хендлеры как `session`.
+    Коммит - один раз, после хендлера. При исключении сессия откатывается
+    (вместе с записанными в память настройками и счетчиками, см. database/cache.py).
+
+    Хендлер, который после записи еще ходит в Telegram API, коммитит сам
+    раньше (await session.commit()), чтобы не держать писателя SQLite
+    (он один на весь бот) на время сетевого запроса. Финальный коммит тогда ничего не делает.
+    """
+
+    def __init__(self, session_pool: async_sessionmaker):
+        super().__init__()
+        self.session_pool = session_pool
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with self.session_pool() as session:
+            data["session"] = session
+            try:
+                result = await handler(event, data)
+            except Exception:
+                await session.rollback()
+                raise
+            await session.commit()
+            return result
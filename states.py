@@ -16,6 +16,7 @@ class OrderState(StatesGroup):
 class AdminPanelState(StatesGroup):
     broadcast_msg = State()
     select_target = State()
+    broadcast_confirm = State()
     
     # Contacts
     contact_dept = State()
@@ -29,6 +30,12 @@ class AdminPanelState(StatesGroup):
     ticket_reply_id = State()
     ticket_reply_msg = State()
 
+    # Bulk import of items/branches
+    catalog_import = State()
+
+    # Search over tickets/orders
+    search_query = State()
+
 class AdminBranchState(StatesGroup):
     add_name = State()
     edit_name = State()
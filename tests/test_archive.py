@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import insert, select, update
+
+import database.requests as db
+from database import archive
+from database.archive import ArchiveConflict, archive_engine, archive_old_records
+from database.models import FeedbackTicket, InventoryReport, async_session, engine
+
+pytestmark = pytest.mark.usefixtures("fresh_db")
+
+OLD = datetime.utcnow() - timedelta(days=400)
+
+
+async def _old_closed_ticket(message: str) -> int:
+    async with async_session() as session:
+        ticket_id = await db.create_ticket(session, 1, "User", "Филиал", message)
+        await db.close_ticket(session, ticket_id, "Готово")
+        await session.execute(update(FeedbackTicket).where(FeedbackTicket.id == ticket_id).values(created_at=OLD))
+        await session.commit()
+        return ticket_id
+
+
+async def _new_ticket(message: str) -> int:
+    async with async_session() as session:
+        ticket_id = await db.create_ticket(session, 1, "User", "Филиал", message)
+        await session.commit()
+        return ticket_id
+
+
+async def _ids(bind, table):
+    async with bind.connect() as conn:
+        return list(await conn.scalars(select(table.c.id).order_by(table.c.id)))
+
+
+def test_ids_of_archived_rows_are_not_reused(run):
+    first = run(_old_closed_ticket("Первый"))
+    newest = run(_old_closed_ticket("Последний"))
+    assert run(archive_old_records(days=30)) == (2, 0)
+
+    # Без AUTOINCREMENT новая строка получила бы id = max(id) + 1 = 1
+    assert run(_new_ticket("Новый")) > newest > first
+
+
+@pytest.mark.skipif(engine.dialect.name != "sqlite", reason="счетчик AUTOINCREMENT - только SQLite")
+def test_counter_starts_above_archive(run):
+    # Архив, в который последние строки уехали до перехода на AUTOINCREMENT
+    async def setup():
+        async with archive_engine.begin() as conn:
+            await conn.execute(insert(InventoryReport.__table__), [
+                {"id": 50, "branch_name": "Филиал", "user_id": 1, "report_data": "", "timestamp": OLD, "sector": "full"},
+            ])
+        archive._schema_ready = False
+        await archive.ensure_schema()
+
+    run(setup())
+
+    async def new_report():
+        async with async_session() as session:
+            await db.save_report(session, 1, "Филиал", "")
+            await session.commit()
+
+    run(new_report())
+    assert run(_ids(engine, InventoryReport.__table__)) == [51]
+
+
+def test_conflicting_archive_row_aborts_chunk(run):
+    ticket_id = run(_old_closed_ticket("Новое обращение"))
+
+    async def put_other_row():
+        async with archive_engine.begin() as conn:
+            await conn.execute(insert(FeedbackTicket.__table__), [{
+                "id": ticket_id, "user_id": 2, "user_name": "Other", "branch_name": "Филиал",
+                "message": "Старое обращение", "ticket_type": "problem", "status": "closed", "created_at": OLD,
+            }])
+
+    run(put_other_row())
+    with pytest.raises(ArchiveConflict):
+        run(archive_old_records(days=30))
+
+    # Строка осталась в рабочей БД, архив не тронут
+    assert run(_ids(engine, FeedbackTicket.__table__)) == [ticket_id]
+
+    async def archived_message():
+        async with archive_engine.connect() as conn:
+            return await conn.scalar(select(FeedbackTicket.message).where(FeedbackTicket.id == ticket_id))
+
+    assert run(archived_message()) == "Старое обращение"
+
+
+def test_interrupted_move_is_retried(run):
+    ticket_id = run(_old_closed_ticket("Обращение"))
+
+    # Копия уже в архиве, а удаление из рабочей БД не успело выполниться
+    async def copy_only():
+        async with engine.connect() as conn:
+            row = (await conn.execute(select(FeedbackTicket.__table__).where(FeedbackTicket.id == ticket_id))).one()
+        async with archive_engine.begin() as conn:
+            await conn.execute(insert(FeedbackTicket.__table__), [dict(row._mapping)])
+
+    run(copy_only())
+    assert run(archive_old_records(days=30)) == (1, 0)
+    assert run(_ids(engine, FeedbackTicket.__table__)) == []
+    assert run(_ids(archive_engine, FeedbackTicket.__table__)) == [ticket_id]
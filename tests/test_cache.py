@@ -0,0 +1,89 @@
+import pytest
+from sqlalchemy import select
+
+import database.requests as db
+from database.models import GlobalSettings, async_session
+from middlewares.db import DbSessionMiddleware
+
+pytestmark = pytest.mark.usefixtures("fresh_db")
+
+
+async def _stored_settings() -> dict:
+    async with async_session() as session:
+        return dict((await session.execute(select(GlobalSettings.key, GlobalSettings.value))).all())
+
+
+def test_handler_error_reverts_settings(run):
+    async def handler(event, data):
+        await db.open_inventory_cycle(data["session"])
+        raise RuntimeError("handler failed")
+
+    since = db.get_progress_since()
+    with pytest.raises(RuntimeError):
+        run(DbSessionMiddleware(async_session)(handler, None, {}))
+
+    assert not db.is_inventory_open()
+    assert db.get_current_cycle_id() is None
+    assert db.get_progress_since() == since
+    assert db.CURRENT_CYCLE_KEY not in run(_stored_settings())
+
+
+def test_session_closed_without_commit_reverts_settings(run):
+    # Так работают планировщик и воркер очереди: своя сессия без middleware
+    async def forget_commit():
+        async with async_session() as session:
+            await db.set_setting(session, "inventory_auto_mode", "1")
+            assert db.get_setting("inventory_auto_mode", session=session) == "1"
+
+    run(forget_commit())
+    assert not db.get_inventory_schedule().auto_mode
+
+
+def test_uncommitted_settings_visible_only_in_own_session(run):
+    async def scenario():
+        async with async_session() as session:
+            cycle = await db.open_inventory_cycle(session)
+            # Другие апдейты до коммита видят закрытый сбор, сама сессия - свой новый цикл
+            assert not db.is_inventory_open()
+            assert db.get_current_cycle_id() is None
+            assert db.is_inventory_open(session)
+            assert db.get_current_cycle_id(session) == cycle.id
+            await session.commit()
+            return cycle.id
+
+    cycle_id = run(scenario())
+    assert db.is_inventory_open()
+    assert db.get_current_cycle_id() == cycle_id
+
+
+def test_committed_settings_stay(run):
+    async def handler(event, data):
+        await db.open_inventory_cycle(data["session"])
+
+    run(DbSessionMiddleware(async_session)(handler, None, {}))
+
+    assert db.is_inventory_open()
+    assert run(_stored_settings())[db.CURRENT_CYCLE_KEY] == str(db.get_current_cycle_id())
+
+
+def test_dashboard_stats_follow_commits(run):
+    async def stats():
+        async with async_session() as session:
+            return (await db.get_dashboard_stats(session)).items
+
+    async def scenario():
+        async with async_session() as writer:
+            await db.add_item(writer, "Фильтр")
+            # Своя сессия видит незакоммиченный товар, остальные - нет (и кэшируют старый счетчик)
+            assert (await db.get_dashboard_stats(writer)).items == 1
+            assert await stats() == 0
+            await writer.commit()
+        assert await stats() == 1
+
+        async with async_session() as writer:
+            await db.add_item(writer, "Масло")
+            assert (await db.get_dashboard_stats(writer)).items == 2
+            await writer.rollback()
+        assert await stats() == 1
+
+    run(scenario())
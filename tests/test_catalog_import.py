@@ -0,0 +1,70 @@
+import pytest
+from sqlalchemy import select
+
+import database.requests as db
+from database.models import Branch, Item, async_session
+from utils.catalog_import import ImportRow, parse_catalog_file
+
+pytestmark = pytest.mark.usefixtures("fresh_db")
+
+
+async def _catalog(model):
+    async with async_session() as session:
+        return (await session.execute(select(model.id, model.name).order_by(model.id))).all()
+
+
+async def _import(rows):
+    async with async_session() as session:
+        summary = await db.import_catalog(session, rows)
+        await session.commit()
+    return summary
+
+
+def test_duplicate_ids_are_rejected_in_validation():
+    data = "type;name;id\nitem;Фильтр;1\nitem;Масло;1\nbranch;Центр;1\nitem;Новый;\n".encode()
+    rows, errors = parse_catalog_file("catalog.csv", data)
+
+    assert rows == [ImportRow(4, "branch", "Центр", 1), ImportRow(5, "item", "Новый", None)]
+    assert errors == ["стр. 2: id 1 повторяется в файле", "стр. 3: id 1 повторяется в файле"]
+
+
+def test_restore_and_rename_of_same_item_counts_once(run):
+    async def setup():
+        async with async_session() as session:
+            item = await db.add_item(session, "Фильтр")
+            await db.delete_item(session, item.id)
+            await session.commit()
+            return item.id
+
+    item_id = run(setup())
+    summary = run(_import([
+        ImportRow(2, "item", "Фильтр", None),       # восстановление удаленного
+        ImportRow(3, "item", "Фильтр new", item_id),  # и тут же переименование
+    ]))
+
+    assert summary == db.ImportSummary(1, 0, [f"стр. 3: запись id {item_id} уже изменена строкой выше"])
+    assert run(_catalog(Item)) == [(item_id, "Фильтр")]
+
+
+def test_summary_matches_written_rows(run):
+    async def setup():
+        async with async_session() as session:
+            a = await db.add_item(session, "A")
+            b = await db.add_item(session, "B")
+            branch = await db.add_branch(session, "Центр")
+            await session.commit()
+            return a.id, b.id, branch.id
+
+    a, b, branch = run(setup())
+    summary = run(_import([
+        ImportRow(2, "item", "A2", a),
+        ImportRow(3, "item", "C", None),
+        ImportRow(4, "item", "B", None),
+        ImportRow(5, "branch", "Север", branch),
+        ImportRow(6, "branch", "Юг", None),
+    ]))
+
+    assert summary.inserted == 2 and summary.renamed == 2
+    assert summary.skipped == ["стр. 4: 'B' уже существует"]
+    assert [name for _, name in run(_catalog(Item))] == ["A2", "B", "C"]
+    assert [name for _, name in run(_catalog(Branch))] == ["Север", "Юг"]
@@ -0,0 +1,208 @@
+from array import array
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+import database.requests as db
+from database import search
+from database.archive import archive_engine, archive_old_records
+from database.models import (
+    Branch, BranchProgress, FeedbackTicket, GlobalSettings, Item, Order, OrderLine, User,
+    async_session, dialect_insert, engine,
+)
+from utils.catalog_import import ImportRow
+
+# Места, где SQL зависит от СУБД. Каждый тест запускается для обоих бэкендов:
+# тот, что не совпадает с текущей БД, пропускается (PostgreSQL - только с TEST_DATABASE_URL, см. conftest.py)
+
+DIALECTS = {"sqlite": sqlite.dialect(), "postgresql": postgresql.dialect()}
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def backend(request, fresh_db):
+    if engine.dialect.name != request.param:
+        pytest.skip(f"нужна БД {request.param} (TEST_DATABASE_URL)")
+    return request.param
+
+
+@pytest.mark.parametrize("name", DIALECTS)
+def test_dialect_insert_compiles_for_both_dialects(name):
+    target = SimpleNamespace(dialect=DIALECTS[name])
+    stmt = dialect_insert(target, GlobalSettings).values(key="k", value="v")
+    upsert = stmt.on_conflict_do_update(index_elements=[GlobalSettings.key], set_={"value": stmt.excluded.value})
+    sql = str(upsert.compile(dialect=DIALECTS[name]))
+    assert "ON CONFLICT (" in sql and "DO UPDATE SET value = excluded.value" in sql
+
+    ignore = dialect_insert(target, User).values(telegram_id=1).on_conflict_do_nothing(index_elements=[User.telegram_id])
+    assert "ON CONFLICT (telegram_id) DO NOTHING" in str(ignore.compile(dialect=DIALECTS[name]))
+
+
+def test_set_setting_upsert(run, backend):
+    async def go():
+        async with async_session() as session:
+            await db.set_setting(session, "inventory_auto_mode", "1")
+            await db.set_setting(session, "inventory_auto_mode", "0")
+            await session.commit()
+        async with async_session() as session:
+            return (await session.execute(
+                select(GlobalSettings.value).where(GlobalSettings.key == "inventory_auto_mode")
+            )).all()
+
+    assert run(go()) == [("0",)]
+
+
+def test_import_catalog(run, backend):
+    async def go():
+        async with async_session() as session:
+            summary = await db.import_catalog(session, [
+                ImportRow(2, "item", "Фильтр", None),
+                ImportRow(3, "branch", "Центр", None),
+                ImportRow(4, "branch", "Север", None),
+            ])
+            await session.commit()
+        async with async_session() as session:
+            items = list(await session.scalars(select(Item.name)))
+            branches = (await session.execute(
+                select(Branch.name, BranchProgress.total).join(BranchProgress, BranchProgress.branch_id == Branch.id)
+                .order_by(Branch.name)
+            )).all()
+        return summary, items, branches
+
+    summary, items, branches = run(go())
+    assert (summary.inserted, summary.renamed, summary.skipped) == (3, 0, [])
+    assert items == ["Фильтр"]
+    assert branches == [("Север", 0), ("Центр", 0)]
+
+
+def test_move_chunk_copies_order_tree(run, backend):
+    async def setup():
+        async with async_session() as session:
+            branch = await db.add_branch(session, "Центр")
+            item = await db.add_item(session, "Фильтр")
+            ticket_id = await db.create_order(session, 1, "User", branch.id, "Центр", {item.id: 3}, "Фильтр: 3")
+            await db.close_ticket(session, ticket_id)
+            await session.execute(
+                update(FeedbackTicket).where(FeedbackTicket.id == ticket_id)
+                .values(created_at=datetime.utcnow() - timedelta(days=400))
+            )
+            await session.commit()
+            return ticket_id, item.id
+
+    async def archived():
+        async with archive_engine.connect() as conn:
+            return (
+                list(await conn.scalars(select(FeedbackTicket.id))),
+                (await conn.execute(select(Order.ticket_id))).all(),
+                (await conn.execute(select(OrderLine.order_id, OrderLine.item_id, OrderLine.qty))).all(),
+            )
+
+    async def hot_tickets():
+        async with async_session() as session:
+            return list(await session.scalars(select(FeedbackTicket.id)))
+
+    ticket_id, item_id = run(setup())
+    assert run(archive_old_records(days=30)) == (1, 0)
+    assert run(archived()) == ([ticket_id], [(ticket_id,)], [(ticket_id, item_id, 3)])
+    assert run(hot_tickets()) == []
+
+
+def test_delete_branch_with_users_and_orders(run, backend):
+    async def setup():
+        async with async_session() as session:
+            branch = await db.add_branch(session, "Центр")
+            item = await db.add_item(session, "Фильтр")
+            await db.add_user(session, 1)
+            await db.update_user_branch(session, 1, branch.id)
+            ticket_id = await db.create_order(session, 1, "User", branch.id, "Центр", {item.id: 3}, "Фильтр: 3")
+            await session.commit()
+            return branch.id, ticket_id
+
+    async def delete(branch_id):
+        # На PostgreSQL внешние ключи проверяются: оставшаяся ссылка уронит коммит
+        async with async_session() as session:
+            assert await db.delete_branch(session, branch_id)
+            await session.commit()
+        async with async_session() as session:
+            return (
+                await session.get(Branch, branch_id),
+                await session.scalar(select(User.selected_branch_id).where(User.telegram_id == 1)),
+                await session.scalar(select(Order.branch_id).where(Order.ticket_id == ticket_id)),
+                await db.get_user(session, 1),
+            )
+
+    branch_id, ticket_id = run(setup())
+    branch, selected, ordered, profile = run(delete(branch_id))
+    assert (branch, selected, ordered) == (None, None, None)
+    assert profile.selected_branch_id is None and profile.branch_name is None
+
+
+def test_ilike_search_fallback(run, backend, monkeypatch):
+    # На SQLite обычно работает FTS5 - здесь принудительно проверяется путь остальных СУБД
+    monkeypatch.setattr(search, "IS_SQLITE", False)
+
+    async def go():
+        async with async_session() as session:
+            await db.create_ticket(session, 1, "Ivan", "Центр", "Не пришла поставка Filter")
+            await db.create_ticket(session, 2, "Petr", "Север", "Сломался погрузчик")
+            await session.commit()
+        async with async_session() as session:
+            return (
+                await search.search_tickets(session, "поставки FILTER ivan"),
+                await search.search_tickets(session, "ПОГРУЗЧИК"),
+                await search.search_tickets(session, "поставка север"),
+            )
+
+    across_fields, upper_case, no_match = run(go())
+    # "поставки" -> основа "поставк"; слова ищутся в разных полях; регистр латиницы не важен
+    assert [h.user_name for h in across_fields.hits] == ["Ivan"]
+    if engine.dialect.name == "postgresql":
+        # lower() в SQLite без ICU кириллицу не понижает - там поиск идет через FTS5
+        assert [h.user_name for h in upper_case.hits] == ["Petr"]
+    # Каждое слово должно найтись хотя бы в одном поле того же тикета
+    assert no_match.hits == []
+
+
+def test_ilike_search_finds_archived_tickets(run, backend, monkeypatch):
+    monkeypatch.setattr(search, "IS_SQLITE", False)
+
+    async def setup():
+        async with async_session() as session:
+            old = await db.create_ticket(session, 1, "Ivan", "Центр", "filter old")
+            await db.close_ticket(session, old)
+            await session.execute(
+                update(FeedbackTicket).where(FeedbackTicket.id == old)
+                .values(created_at=datetime.utcnow() - timedelta(days=400))
+            )
+            new = await db.create_ticket(session, 2, "Petr", "Север", "filter new")
+            await session.commit()
+            return old, new
+
+    async def find(page):
+        async with async_session() as session:
+            return await search.search_tickets(session, "filter", page, limit=1)
+
+    old, new = run(setup())
+    assert run(archive_old_records(days=30)) == (1, 0)
+    # Сначала новые: первая страница - из рабочей БД, вторая - из архива
+    first, second = run(find(0)), run(find(1))
+    assert ([h.id for h in first.hits], first.has_next) == ([new], True)
+    assert ([h.id for h in second.hits], second.has_next) == ([old], False)
+
+
+def test_audience_ids_array(run, backend):
+    big_ids = [2**40 + 1, 2**33, 7]
+
+    async def go():
+        async with async_session() as session:
+            for telegram_id in big_ids:
+                await db.add_user(session, telegram_id)
+            await session.commit()
+        async with async_session() as session:
+            return await db.get_audience_ids(session, db.Audience())
+
+    ids = run(go())
+    assert isinstance(ids, array) and ids.typecode == "q"
+    assert sorted(ids) == sorted(big_ids)
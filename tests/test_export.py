@@ -0,0 +1,155 @@
+import asyncio
+import io
+import os
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import openpyxl
+import pytest
+from sqlalchemy import func, insert, select, update
+
+import config
+import database.requests as db
+from database.archive import archive_old_records
+from database.models import InventoryReport, Item, ReportLine, async_session, engine
+from handlers.admin_panel import export_data_handler, get_admin_main_menu
+from utils import export
+
+pytestmark = pytest.mark.usefixtures("fresh_db")
+
+REPORTS = 20000
+
+
+@pytest.fixture(autouse=True)
+def shutdown_pool():
+    yield
+    export.shutdown()
+
+
+async def _fill(reports: int):
+    start = datetime.utcnow() - timedelta(days=100)
+    async with engine.begin() as conn:
+        await conn.execute(insert(Item), [{"id": i, "name": f"Товар {i}"} for i in range(1, 11)])
+        await conn.execute(insert(InventoryReport), [
+            {
+                "id": i, "branch_name": "Филиал", "user_id": i, "report_data": "Товар 1: 5",
+                "timestamp": start + timedelta(minutes=i),
+            }
+            for i in range(1, reports + 1)
+        ])
+        await conn.execute(insert(ReportLine), [
+            {"report_id": i, "item_id": i % 10 + 1, "qty": i % 50} for i in range(1, reports + 1)
+        ])
+
+
+async def _admin_menu_latency(delay: float = 0) -> float:
+    # Время от "прихода апдейта" через delay секунд до ответа: заблокированный event loop тоже попадает в замер
+    started = time.perf_counter()
+    await asyncio.sleep(delay)
+    async with async_session() as session:
+        await get_admin_main_menu(session)
+    return time.perf_counter() - started - delay
+
+
+def test_handlers_stay_responsive_during_export(run):
+    async def go():
+        await _fill(REPORTS)
+        baseline = [await _admin_menu_latency() for _ in range(10)]
+
+        started = time.perf_counter()
+        task = asyncio.create_task(export.build_report(0))
+        during = []
+        while not task.done():
+            during.append(await _admin_menu_latency(0.02))
+        data = await task
+        return baseline, during, time.perf_counter() - started, data
+
+    baseline, during, export_time, data = run(go())
+
+    assert data.startswith(b"PK")
+    # Выгрузка идет в другом процессе: event loop не блокируется на все время сборки книги
+    assert len(during) >= 10
+    assert max(during) < max(0.25, 10 * max(baseline)) < export_time / 2
+
+
+def _crash(days):
+    os._exit(1)
+
+
+class FakeStatus:
+    def __init__(self, text):
+        self.texts = [text]
+
+    async def edit_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+def test_worker_crash_is_reported_and_pool_recovers(run, monkeypatch):
+    statuses = []
+
+    async def answer(text, **kwargs):
+        statuses.append(FakeStatus(text))
+        return statuses[-1]
+
+    async def noop(*args, **kwargs):
+        pass
+
+    callback = SimpleNamespace(
+        data="admin_export_7",
+        from_user=SimpleNamespace(id=1),
+        message=SimpleNamespace(answer=answer, answer_document=noop),
+        answer=noop,
+    )
+    monkeypatch.setattr(config, "ADMIN_IDS", [1])
+    monkeypatch.setattr(export, "build_report_sync", _crash)
+
+    run(export_data_handler(callback))
+    assert statuses[-1].texts[-1].startswith("❌ Не удалось сформировать отчет")
+
+    # Упавший пул заменяется: следующая выгрузка проходит
+    monkeypatch.undo()
+    monkeypatch.setattr(config, "ADMIN_IDS", [1])
+    run(export_data_handler(callback))
+    assert statuses[-1].texts[-1].startswith("✅")
+
+
+def _sheet(data: bytes, title: str) -> list:
+    wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True)
+    rows = list(wb[title].iter_rows(min_row=2, values_only=True))
+    wb.close()
+    return rows
+
+
+def test_all_time_export_merges_archive_by_date(run):
+    async def setup():
+        async with async_session() as session:
+            item = await db.add_item(session, "Фильтр")
+            await session.commit()
+        # Отчеты 300, 200 и 100 дней назад и вчерашний; старые уедут в архив
+        for days_ago, qty in ((300, 1), (200, 2), (100, 3), (1, 4)):
+            async with async_session() as session:
+                await db.save_report(session, 1, "Центр", f"Фильтр: {qty}", lines={item.id: qty})
+                await session.execute(
+                    update(InventoryReport).where(InventoryReport.id == select(func.max(InventoryReport.id)).scalar_subquery())
+                    .values(timestamp=datetime.utcnow() - timedelta(days=days_ago))
+                )
+                await session.commit()
+        assert await archive_old_records(days=150) == (0, 2)
+
+    run(setup())
+    data = export.build_report_sync(0)
+
+    history = _sheet(data, "Stock History")
+    assert [row[4] for row in history] == [1, 2, 3, 4]
+    assert [row[0] for row in history] == sorted(row[0] for row in history)
+    inventory = _sheet(data, "Inventory")
+    assert [row[5] for row in inventory] == ["Фильтр: 4", "Фильтр: 3", "Фильтр: 2", "Фильтр: 1"]
+
+
+def test_export_does_not_create_missing_archive(tmp_path, monkeypatch):
+    missing = tmp_path / "archive.db"
+    monkeypatch.setattr(config, "ARCHIVE_DATABASE_URL", f"sqlite+aiosqlite:///{missing}")
+
+    assert export.build_report_sync(0).startswith(b"PK")
+    assert not missing.exists()
@@ -0,0 +1,169 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, func, inspect, select, text
+
+from database import migrations
+from database.migrations import SCHEMA_VERSION, get_schema_version, init_db
+from database.models import (
+    Base, engine, GlobalSettings, InventoryCycle, InventoryReport, Order, OrderLine,
+    ReportLine, StockLevel, FeedbackTicket, User,
+)
+
+# Таблицы первой версии бота (create_all из baseline models.py) до колонок,
+# которые потом дописывал check_and_migrate: tickets.ticket_type, users.sector, inventory_reports.sector
+BASELINE_DDL = [
+    "CREATE TABLE branches (id INTEGER PRIMARY KEY, name VARCHAR UNIQUE NOT NULL)",
+    "CREATE TABLE items (id INTEGER PRIMARY KEY, name VARCHAR UNIQUE NOT NULL, is_active BOOLEAN NOT NULL)",
+    "CREATE TABLE users (telegram_id BIGINT PRIMARY KEY, "
+    "selected_branch_id INTEGER REFERENCES branches (id), language VARCHAR NOT NULL)",
+    "CREATE TABLE inventory_reports (id INTEGER PRIMARY KEY, branch_name VARCHAR NOT NULL, user_id BIGINT NOT NULL, "
+    "user_name VARCHAR, report_data TEXT NOT NULL, timestamp TIMESTAMP NOT NULL)",
+    "CREATE TABLE settings (key VARCHAR PRIMARY KEY, value VARCHAR NOT NULL)",
+    "CREATE TABLE tickets (id INTEGER PRIMARY KEY, user_id BIGINT NOT NULL, user_name VARCHAR NOT NULL, "
+    "branch_name VARCHAR NOT NULL, message TEXT NOT NULL, status VARCHAR NOT NULL, created_at TIMESTAMP NOT NULL, "
+    "reply_message TEXT, reply_at TIMESTAMP, responder_id BIGINT, responder_name VARCHAR)",
+    "CREATE TABLE department_contacts (id INTEGER PRIMARY KEY, department VARCHAR NOT NULL, info VARCHAR NOT NULL)",
+]
+
+NOW = datetime.utcnow()
+ORDER_TEXT = "[ЗАКАЗ МАТЕРИАЛОВ]\n▫️ Товар A: 2 шт."
+
+
+@contextmanager
+def captured_statements():
+    statements = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", listener)
+    try:
+        yield statements
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", listener)
+
+
+def _baseline(connection):
+    for ddl in BASELINE_DDL:
+        connection.execute(text(ddl))
+    connection.execute(text("INSERT INTO branches (id, name) VALUES (1, 'Филиал')"))
+    connection.execute(text("INSERT INTO items (id, name, is_active) VALUES (1, 'Товар A', true), (2, 'Товар B', true)"))
+    connection.execute(text("INSERT INTO users (telegram_id, selected_branch_id, language) VALUES (10, 1, 'ru')"))
+    connection.execute(
+        text(
+            "INSERT INTO inventory_reports (id, branch_name, user_id, user_name, report_data, timestamp) "
+            "VALUES (:id, 'Филиал', 10, 'User', :data, :ts)"
+        ),
+        [
+            {"id": 1, "data": "Товар A: 3", "ts": NOW - timedelta(days=3)},
+            {"id": 2, "data": "Товар A: 5\nТовар B: 7", "ts": NOW - timedelta(hours=2)},
+        ],
+    )
+    connection.execute(
+        text(
+            "INSERT INTO tickets (id, user_id, user_name, branch_name, message, status, created_at) "
+            "VALUES (:id, 10, 'User', 'Филиал', :message, 'open', :ts)"
+        ),
+        [{"id": 1, "message": "Не пришла поставка", "ts": NOW}, {"id": 2, "message": ORDER_TEXT, "ts": NOW}],
+    )
+    connection.execute(text("INSERT INTO settings (key, value) VALUES ('inventory_open', '1')"))
+
+
+def _baseline_check_and_migrate(connection):
+    # check_and_migrate первой версии: только три колонки
+    migrations._add_column(connection, "tickets", "ticket_type", "VARCHAR DEFAULT 'problem'")
+    migrations._add_column(connection, "users", "sector", "VARCHAR DEFAULT 'full'")
+    migrations._add_column(connection, "inventory_reports", "sector", "VARCHAR DEFAULT 'full'")
+
+
+def _pre_versioned_init_db(connection):
+    # init_db до schema_version: create_all + check_and_migrate (колонки, все индексы) + разовые переносы
+    _baseline_check_and_migrate(connection)
+    Base.metadata.create_all(connection, tables=[
+        Base.metadata.tables[name]
+        for name in ("inventory_cycles", "report_lines", "orders", "order_lines", "branch_progress")
+    ])
+    migrations._add_column(connection, "users", "last_report_at", "TIMESTAMP")
+    migrations._add_column(connection, "inventory_reports", "cycle_id", "INTEGER REFERENCES inventory_cycles(id)")
+    migrations._create_indexes(
+        connection, "inventory_reports", "ix_inventory_reports_timestamp_user", "ix_inventory_reports_cycle_user"
+    )
+    migrations._create_indexes(connection, "tickets", "ix_tickets_status_type_created", "ix_tickets_created_at")
+    migrations._create_indexes(connection, "users", "ix_users_selected_branch_id")
+    migrations.backfill_report_lines(connection)
+    migrations.migrate_order_tickets(connection)
+    migrations.backfill_last_report_at(connection)
+    migrations.migrate_open_cycle(connection)
+
+
+def _schema_matches_models(connection):
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        columns = {c["name"] for c in inspector.get_columns(table.name)}
+        assert {c.name for c in table.columns} <= columns, table.name
+        indexes = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        assert {ix.name for ix in table.indexes} <= indexes, table.name
+
+
+def test_boot_on_current_schema_runs_one_select(run, fresh_db):
+    with captured_statements() as statements:
+        run(init_db())
+    assert statements == ["SELECT version FROM schema_version"]
+
+
+@pytest.mark.parametrize("old_migrate", [_baseline_check_and_migrate, _pre_versioned_init_db])
+def test_migrates_old_database(run, empty_db, old_migrate):
+    async def setup():
+        async with engine.begin() as conn:
+            await conn.run_sync(_baseline)
+            await conn.run_sync(old_migrate)
+
+    async def check_schema():
+        async with engine.connect() as conn:
+            await conn.run_sync(_schema_matches_models)
+
+    async def fetch(stmt):
+        async with engine.connect() as conn:
+            return (await conn.execute(stmt)).all()
+
+    run(setup())
+    assert run(get_schema_version()) == 0
+
+    run(init_db())
+
+    assert run(get_schema_version()) == SCHEMA_VERSION
+    run(check_schema())
+    if engine.dialect.name == "sqlite":
+        # v12: таблицы пересозданы с AUTOINCREMENT, внешние ключи по-прежнему ведут на них
+        ddl = dict(run(fetch(text("SELECT name, sql FROM sqlite_master WHERE type = 'table'"))))
+        assert "AUTOINCREMENT" in ddl["tickets"] and "AUTOINCREMENT" in ddl["inventory_reports"]
+        assert "REFERENCES tickets " in ddl["orders"] and "REFERENCES inventory_reports " in ddl["report_lines"]
+        assert not any(name.endswith("_old") for name in ddl)
+
+    # Разовые переносы выполнены ровно один раз
+    assert run(fetch(select(ReportLine.report_id, ReportLine.item_id, ReportLine.qty, ReportLine.delta)
+                     .order_by(ReportLine.report_id, ReportLine.item_id))) == [
+        (1, 1, 3, None), (2, 1, 5, 2), (2, 2, 7, None),
+    ]
+    assert run(fetch(select(FeedbackTicket.id, FeedbackTicket.ticket_type).order_by(FeedbackTicket.id))) == [
+        (1, "problem"), (2, "order"),
+    ]
+    assert run(fetch(select(Order.ticket_id, Order.branch_id))) == [(2, 1)]
+    assert run(fetch(select(OrderLine.order_id, OrderLine.item_id, OrderLine.qty))) == [(2, 1, 2)]
+
+    [(cycle_id,)] = run(fetch(select(InventoryCycle.id)))
+    assert run(fetch(select(InventoryReport.id).where(InventoryReport.cycle_id == cycle_id))) == [(2,)]
+    assert run(fetch(select(GlobalSettings.value).where(GlobalSettings.key == "current_cycle_id"))) == [
+        (str(cycle_id),)
+    ]
+    assert run(fetch(select(func.count()).select_from(User).where(User.last_report_at.is_not(None)))) == [(1,)]
+    assert run(fetch(select(StockLevel.item_id, StockLevel.qty, StockLevel.report_id).order_by(StockLevel.item_id))) == [
+        (1, 5, 2), (2, 7, 2),
+    ]
+
+    # Следующий старт - уже один SELECT
+    with captured_statements() as statements:
+        run(init_db())
+    assert len(statements) == 1
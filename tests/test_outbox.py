@@ -0,0 +1,155 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import select
+
+import config
+import database.requests as db
+from database.models import OutboxMessage, async_session
+from utils import outbox
+
+pytestmark = pytest.mark.usefixtures("fresh_db")
+
+
+async def _statuses():
+    async with async_session() as session:
+        return dict((await session.execute(select(OutboxMessage.chat_id, OutboxMessage.status))).all())
+
+
+def test_worker_error_releases_only_unstarted_messages(run, monkeypatch):
+    monkeypatch.setattr(config, "BROADCAST_CONCURRENCY", 2)
+
+    async def send_message(chat_id, **kwargs):
+        # Сообщение в чат 2 еще в полете, когда у чата 1 падает запись результата
+        if chat_id == 2:
+            await asyncio.sleep(0.2)
+
+    record = outbox._record
+
+    async def failing_record(update, message_id, *args, **kwargs):
+        if update is db.mark_outbox_sent and message_id == ids[1]:
+            await asyncio.sleep(0.05)
+            raise RuntimeError("БД недоступна")
+        await record(update, message_id, *args, **kwargs)
+
+    monkeypatch.setattr(outbox, "_record", failing_record)
+
+    async def enqueue():
+        async with async_session() as session:
+            await db.enqueue_messages(session, [outbox.text_message(c, "Текст") for c in (1, 2, 3)])
+            await session.commit()
+        async with async_session() as session:
+            return dict((await session.execute(select(OutboxMessage.chat_id, OutboxMessage.id))).all())
+
+    ids = run(enqueue())
+    with pytest.raises(RuntimeError):
+        run(outbox._process(SimpleNamespace(send_message=send_message)))
+
+    # Начатая отправка доведена до конца, а не возвращена в очередь; неначатое сообщение снова ждет
+    assert run(_statuses()) == {1: "sending", 2: "sent", 3: "pending"}
+
+
+def test_unrecorded_send_does_not_stall_chat(run, monkeypatch):
+    monkeypatch.setattr(outbox.broadcast, "_chats", outbox.broadcast.ChatLimiter(0))
+    sent = []
+
+    async def send_message(chat_id, text, **kwargs):
+        sent.append(text)
+
+    record = outbox._record
+
+    async def failing_record(update, message_id, *args, **kwargs):
+        if update is db.mark_outbox_sent and not sent[1:]:
+            raise RuntimeError("БД недоступна")
+        await record(update, message_id, *args, **kwargs)
+
+    monkeypatch.setattr(outbox, "_record", failing_record)
+    bot = SimpleNamespace(send_message=send_message)
+
+    async def enqueue():
+        async with async_session() as session:
+            await db.enqueue_messages(session, [outbox.text_message(1, t) for t in ("Первое", "Второе")])
+            await session.commit()
+
+    run(enqueue())
+    # Первое ушло, но статус не записался: оно остается sending и держит чат
+    with pytest.raises(RuntimeError):
+        run(outbox._process(bot))
+    assert run(outbox._process(bot)) is False
+
+    # Захват просрочен - сообщение снова в очереди (уходит повторно), за ним доходит и следующее
+    monkeypatch.setattr(config, "OUTBOX_CLAIM_TIMEOUT", 0)
+    while run(outbox._process(bot)):
+        pass
+    assert sent == ["Первое", "Первое", "Второе"]
+
+    async def statuses():
+        async with async_session() as session:
+            return list(await session.scalars(select(OutboxMessage.status).order_by(OutboxMessage.id)))
+
+    assert run(statuses()) == ["sent", "sent"]
+
+
+def test_inventory_open_notifications_are_committed_with_cycle(run, monkeypatch):
+    from handlers.admin_panel import admin_inventory_toggle_handler
+
+    monkeypatch.setattr(config, "ADMIN_IDS", [1])
+
+    async def fail(*args, **kwargs):
+        raise RuntimeError("нет сети")
+
+    callback = SimpleNamespace(
+        from_user=SimpleNamespace(id=1),
+        message=SimpleNamespace(chat=SimpleNamespace(id=1), edit_text=fail),
+        answer=fail,
+    )
+
+    async def toggle():
+        async with async_session() as session:
+            await db.load_settings(session)
+            await db.add_user(session, 10)
+            await session.commit()
+        async with async_session() as session:
+            await admin_inventory_toggle_handler(callback, session)
+
+    # Ответ админу упал уже после коммита: сбор открыт, уведомления в очереди
+    with pytest.raises(RuntimeError):
+        run(toggle())
+    assert db.is_inventory_open()
+    assert run(_statuses()) == {10: "pending"}
+
+
+def test_only_admin_can_stop_broadcast(run, monkeypatch):
+    from handlers.admin_panel import broadcast_stop
+
+    monkeypatch.setattr(config, "ADMIN_IDS", [1])
+    answers = []
+
+    async def answer(text=None, **kwargs):
+        answers.append(text)
+
+    async def setup():
+        async with async_session() as session:
+            batch_id = await db.create_outbox_batch(session, "Объявление", chat_id=5)
+            await db.enqueue_messages(session, [outbox.text_message(10, "Текст")], batch_id)
+            await session.commit()
+            return batch_id
+
+    async def stop(user_id):
+        callback = SimpleNamespace(
+            data=f"outbox_stop_{batch_id}", from_user=SimpleNamespace(id=user_id),
+            message=SimpleNamespace(chat=SimpleNamespace(id=5)), answer=answer,
+        )
+        async with async_session() as session:
+            await broadcast_stop(callback, session)
+
+    batch_id = run(setup())
+    # Не админ в том же чате (группа) кнопкой рассылку не останавливает
+    run(stop(2))
+    assert run(_statuses()) == {10: "pending"}
+
+    run(stop(1))
+    assert run(_statuses()) == {10: "cancelled"}
+    assert answers == ["⛔ Рассылка остановлена"]
+    outbox._cancelled.discard(batch_id)
@@ -0,0 +1,384 @@
+import inspect
+import re
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import event
+
+import config
+import database.requests as db
+from database import cache, search
+from database.models import Base, async_session, engine, read_engine
+from utils import outbox
+from utils.catalog_import import ImportRow
+
+# Регрессия индексов: запросы, ради которых индексы добавлены, должны идти по ним, а не полным SCAN.
+# План берется из EXPLAIN QUERY PLAN для SQL, который функции из database/requests.py реально выполняют.
+
+pytestmark = [
+    pytest.mark.usefixtures("fresh_db"),
+    pytest.mark.skipif(engine.dialect.name != "sqlite", reason="EXPLAIN QUERY PLAN - только SQLite"),
+]
+
+
+@contextmanager
+def captured_selects():
+    statements = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    for target in (engine.sync_engine, read_engine.sync_engine):
+        event.listen(target, "before_cursor_execute", listener)
+    try:
+        yield statements
+    finally:
+        for target in (engine.sync_engine, read_engine.sync_engine):
+            event.remove(target, "before_cursor_execute", listener)
+
+
+async def _plan(statement, parameters) -> str:
+    async with read_engine.connect() as conn:
+        rows = await conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+        return "\n".join(row[-1] for row in rows)
+
+
+def plans(run, call) -> list:
+    """Планы всех SELECT, выполненных call(session)"""
+    async def go():
+        with captured_selects() as statements:
+            async with async_session() as session:
+                await call(session)
+                await session.rollback()
+        return [await _plan(s, p) for s, p in statements]
+    return run(go())
+
+
+def query_plan(run, stmt) -> str:
+    """План запроса выгрузки (они выполняются в процессе-воркере, поэтому компилируем сами)"""
+    compiled = stmt.compile(dialect=engine.dialect)
+    parameters = tuple(compiled.params[name] for name in compiled.positiontup)
+    return run(_plan(str(compiled), parameters))
+
+
+def test_open_tickets_page_uses_status_type_index(run):
+    [plan] = plans(run, lambda s: db.get_open_tickets_page(s, "problem"))
+    assert "USING INDEX ix_tickets_status_type_created" in plan
+
+
+def test_dashboard_counters_use_indexes(run):
+    [plan] = plans(run, db.get_dashboard_stats)
+    assert "COVERING INDEX ix_inventory_reports_timestamp_user (timestamp>?)" in plan
+    assert plan.count("COVERING INDEX ix_tickets_status_type_created (status=? AND ticket_type=?)") == 3
+    assert "SCAN tickets" not in plan and "SCAN inventory_reports" not in plan
+
+
+def test_export_ranges_use_date_indexes(run):
+    assert "INDEX ix_inventory_reports_timestamp_user (timestamp>?)" in query_plan(run, db.reports_by_range_query(7))
+    assert "INDEX ix_tickets_created_at (created_at>?)" in query_plan(run, db.tickets_by_range_query("problem", 7))
+    assert "INDEX ix_inventory_reports_timestamp_user (timestamp>?)" in query_plan(run, db.stock_history_query(7))
+
+
+def test_branch_progress_uses_branch_index(run):
+    found = plans(run, lambda s: db.rebuild_branch_progress(s, datetime.utcnow()))
+    counts = [p for p in found if "users" in p]
+    assert counts and all("INDEX ix_users_selected_branch_id" in p for p in counts)
+
+
+def test_audience_uses_segment_indexes(run):
+    [by_branch] = plans(run, lambda s: db.count_audience(s, db.Audience(branch_ids=(1, 2))))
+    assert "INDEX ix_users_selected_branch_id (selected_branch_id=?)" in by_branch
+    [by_sector] = plans(run, lambda s: db.count_audience(s, db.Audience(sectors=("oil",))))
+    assert "INDEX ix_users_sector_branch (sector=?)" in by_sector
+
+
+def test_pending_report_uses_cycle_index(run):
+    async def pending(session):
+        await db.set_setting(session, db.CURRENT_CYCLE_KEY, "1")
+        return await db.get_users_pending_report(session)
+
+    found = plans(run, pending)
+    assert any("COVERING INDEX ix_inventory_reports_cycle_user (cycle_id=? AND user_id=?)" in p for p in found)
+
+
+def test_outbox_queries_use_indexes(run):
+    [claim] = plans(run, lambda s: db.claim_outbox(s, 10))
+    assert "INDEX ix_outbox_status_id (status=?)" in claim
+    assert "INDEX ix_outbox_chat_status (chat_id=?" in claim
+    [progress] = plans(run, lambda s: db.get_outbox_batch_progress(s, 1))
+    assert "INDEX ix_outbox_batch_status (batch_id=?)" in progress
+
+
+def test_outbox_purge_uses_date_indexes(run):
+    async def purge():
+        with captured_queries() as statements:
+            async with async_session() as session:
+                await db.purge_outbox(session, 7)
+                await session.rollback()
+        return [await _plan(s, p) for s, p in statements]
+
+    messages, batches = run(purge())
+    assert "INDEX ix_outbox_status_created (status=? AND created_at<?)" in messages
+    assert "INDEX ix_outbox_batches_created_at (created_at<?)" in batches
+
+
+# --- Полные проходы по таблицам во всех запросах database/requests.py ---
+# Каждая функция вызывается на заполненной БД, для каждого ее SELECT/UPDATE/DELETE снимается план.
+# "SCAN <таблица>" (в т.ч. по индексу целиком) - ошибка, если пары (функция, таблица) нет в ALLOWED_SCANS.
+
+ALLOWED_SCANS = {
+    # Справочники целиком загружаются в кэш (database/cache.py); таблицы маленькие, загрузка - раз до изменения
+    ("get_branches", "branches"),
+    ("get_active_items", "items"),
+    ("get_contacts", "department_contacts"),
+    # Импорт сверяет файл со всем справочником
+    ("import_catalog", "items"),
+    ("import_catalog", "branches"),
+    # Все настройки и счетчики прогресса загружаются в память при старте
+    ("load_settings", "settings"),
+    ("load_branch_progress", "branch_progress"),
+    # Рассылка "всем": выборка и есть вся таблица
+    ("get_all_users", "users"),
+    ("count_audience:all", "users"),
+    # Должники - anti-join от всех пользователей; отчеты ищутся по индексу (cycle_id, user_id)
+    ("get_users_pending_report", "users"),
+    ("count_audience:pending", "users"),
+    # Счетчики /admin: число всех пользователей, филиалов, товаров, контактов (кэш DASHBOARD_CACHE_TTL)
+    ("get_dashboard_stats", "users"),
+    ("get_dashboard_stats", "branches"),
+    ("get_dashboard_stats", "items"),
+    ("get_dashboard_stats", "department_contacts"),
+    # Последние отчеты: обход индекса по timestamp с конца, читается только limit строк
+    ("get_last_reports", "inventory_reports"),
+    # Top изменений по филиалам: окно по всей stock_levels (филиалы x секторы x товары, без истории)
+    ("get_largest_movements", "stock_levels"),
+    # Выгрузка за все время читает все строки
+    ("reports_by_range_query:0", "inventory_reports"),
+    ("tickets_by_range_query:0", "tickets"),
+    ("stock_history_query:0", "report_lines"),
+    ("item_totals_query:0", "report_lines"),
+}
+
+# Не выполняют SQL сами: настройки из памяти, построители условий, кэш справочников
+NO_QUERIES = {
+    "get_setting", "is_inventory_open", "get_current_cycle_id", "get_progress_since", "get_inventory_schedule",
+    "invalidate_dashboard_stats", "_day", "_reported_this_period",
+    "_audience_query", "_count_open_tickets", "_outbox_next_in_chat",
+    # При промахе кэша - тот же запрос, что у get_branches / get_active_items / get_contacts
+    "get_branch_by_id", "get_item", "get_contact", "get_branch_progress",
+}
+# Запросы этих помощников выполняются внутри проверяемых функций
+HELPERS = {
+    "_catalog": "get_branches", "_bump_progress": "update_user_branch", "_stock_levels": "save_report",
+    "_update_stock_levels": "save_report", "_batch_progress": "get_outbox_batch_progress",
+}
+
+TABLES = set(Base.metadata.tables) | {"tickets_fts"}
+
+
+async def _seed():
+    """Немного данных во всех таблицах: несколько филиалов, пользователей, отчетов, тикетов, сообщений очереди"""
+    async with async_session() as session:
+        branches = [await db.add_branch(session, name) for name in ("Центр", "Север", config.HEAD_OFFICE_NAME)]
+        items = [await db.add_item(session, f"Товар {i}") for i in range(5)]
+        await db.add_contact(session, "IT", "+7 700 000 00 00")
+        await session.commit()
+    async with async_session() as session:
+        for user_id in range(1, 21):
+            await db.add_user(session, user_id)
+            await db.update_user_branch(session, user_id, branches[user_id % 3].id)
+        await db.open_inventory_cycle(session)
+        await session.commit()
+    async with async_session() as session:
+        for user_id in range(1, 11):
+            await db.save_report(session, user_id, "Центр", "", lines={item.id: user_id for item in items})
+        ticket_ids = [await db.create_ticket(session, u, "User", "Центр", f"Не пришла поставка {u}") for u in range(1, 6)]
+        order_id = await db.create_order(session, 1, "User", branches[0].id, "Центр", {items[0].id: 2}, "Товар 0: 2")
+        await db.close_ticket(session, ticket_ids[0], "Готово")
+        batch_id = await db.create_outbox_batch(session, "Объявление", chat_id=1)
+        await db.enqueue_messages(session, [outbox.text_message(u, "Текст") for u in range(1, 21)], batch_id)
+        await session.commit()
+    async with async_session() as session:
+        claimed = await db.claim_outbox(session, 5)
+        for msg in claimed:
+            await db.mark_outbox_sent(session, msg.id)
+        await session.commit()
+    return SimpleNamespace(
+        branch=branches[0].id, other_branch=branches[1].id, item=items[0].id, user=1,
+        ticket=ticket_ids[1], order=order_id, batch=batch_id, message=claimed[0].id,
+        contact=(await _first_contact()),
+    )
+
+
+async def _first_contact():
+    async with async_session() as session:
+        return (await db.get_contacts(session))[0].id
+
+
+def _cold(catalog, call):
+    async def go(session, ids):
+        catalog.invalidate()
+        return await call(session)
+    return go
+
+
+CASES = {
+    "get_branches": _cold(cache.branches, db.get_branches),
+    "get_active_items": _cold(cache.items, db.get_active_items),
+    "get_contacts": _cold(cache.contacts, db.get_contacts),
+    "add_branch": lambda s, ids: db.add_branch(s, "Юг"),
+    "add_item": lambda s, ids: db.add_item(s, "Новый товар"),
+    "import_catalog": lambda s, ids: db.import_catalog(s, [
+        ImportRow(2, "item", "Товар 9", None), ImportRow(3, "item", "Товар A", ids.item),
+        ImportRow(4, "branch", "Восток", None), ImportRow(5, "branch", "Запад", ids.other_branch),
+    ]),
+    "rename_item": lambda s, ids: db.rename_item(s, ids.item, "Товар A"),
+    "delete_item": lambda s, ids: db.delete_item(s, ids.item),
+    "rename_branch": lambda s, ids: db.rename_branch(s, ids.branch, "Центральный"),
+    "delete_branch": lambda s, ids: db.delete_branch(s, ids.other_branch),
+    "get_user": lambda s, ids: db.get_user(s, ids.user),
+    "add_user": lambda s, ids: db.add_user(s, 100),
+    "update_user_branch": lambda s, ids: db.update_user_branch(s, ids.user, ids.other_branch),
+    "update_user_language": lambda s, ids: db.update_user_language(s, ids.user, "kz"),
+    "update_user_sector": lambda s, ids: db.update_user_sector(s, ids.user, "oil"),
+    "get_last_reports": lambda s, ids: db.get_last_reports(s),
+    "create_ticket": lambda s, ids: db.create_ticket(s, 1, "User", "Центр", "Сломался погрузчик"),
+    "create_order": lambda s, ids: db.create_order(s, 1, "User", ids.branch, "Центр", {ids.item: 1}, "Товар 0: 1"),
+    "get_open_tickets": lambda s, ids: db.get_open_tickets(s),
+    "get_open_tickets:type": lambda s, ids: db.get_open_tickets(s, "problem"),
+    "get_open_tickets_page": lambda s, ids: db.get_open_tickets_page(s, "problem", (datetime.utcnow(), 1)),
+    "get_open_tickets_page:back": lambda s, ids: db.get_open_tickets_page(s, "problem", (datetime.utcnow(), 1), True),
+    "get_ticket": lambda s, ids: db.get_ticket(s, ids.ticket),
+    "close_ticket": lambda s, ids: db.close_ticket(s, ids.ticket, "Ответ", 1, "Admin"),
+    "get_all_users": lambda s, ids: db.get_all_users(s),
+    "count_audience:all": lambda s, ids: db.count_audience(s, db.Audience()),
+    "count_audience:segment": lambda s, ids: db.count_audience(
+        s, db.Audience(sectors=("oil",), branch_ids=(ids.branch,), languages=("ru",))
+    ),
+    "count_audience:pending": lambda s, ids: db.count_audience(s, db.Audience(pending_only=True)),
+    "get_audience_ids": lambda s, ids: db.get_audience_ids(s, db.Audience(branch_ids=(ids.branch,))),
+    "mark_user_unreachable": lambda s, ids: db.mark_user_unreachable(s, 20, "Forbidden"),
+    "add_contact": lambda s, ids: db.add_contact(s, "Логистика", "+7 700 000 00 01"),
+    "delete_contact": lambda s, ids: db.delete_contact(s, ids.contact),
+    "update_contact": lambda s, ids: db.update_contact(s, ids.contact, "IT", "+7 700 000 00 02"),
+    "get_dashboard_stats": lambda s, ids: db.get_dashboard_stats(s),
+    "get_users_pending_report": lambda s, ids: db.get_users_pending_report(s),
+    "load_settings": lambda s, ids: db.load_settings(s),
+    "set_setting": lambda s, ids: db.set_setting(s, "inventory_auto_mode", "1"),
+    "open_inventory_cycle": lambda s, ids: db.open_inventory_cycle(s),
+    "close_inventory_cycle": lambda s, ids: db.close_inventory_cycle(s),
+    "save_report": lambda s, ids: db.save_report(s, 11, "Север", "", lines={ids.item: 3}),
+    "get_largest_movements": lambda s, ids: db.get_largest_movements(s),
+    "rebuild_branch_progress": lambda s, ids: db.rebuild_branch_progress(s, datetime.utcnow()),
+    "load_branch_progress": lambda s, ids: db.load_branch_progress(s),
+    "create_outbox_batch": lambda s, ids: db.create_outbox_batch(s, "Напоминание", chat_id=1),
+    "enqueue_messages": lambda s, ids: db.enqueue_messages(s, [outbox.text_message(1, "Еще")], ids.batch),
+    "claim_outbox": lambda s, ids: db.claim_outbox(s, 10),
+    "get_next_outbox_attempt": lambda s, ids: db.get_next_outbox_attempt(s),
+    "mark_outbox_sent": lambda s, ids: db.mark_outbox_sent(s, ids.message),
+    "retry_outbox_message": lambda s, ids: db.retry_outbox_message(s, ids.message, datetime.utcnow(), "timeout"),
+    "mark_outbox_failed": lambda s, ids: db.mark_outbox_failed(s, ids.message, "Bad Request"),
+    "mark_outbox_cancelled": lambda s, ids: db.mark_outbox_cancelled(s, ids.message),
+    "release_outbox_claims": lambda s, ids: db.release_outbox_claims(s),
+    "release_outbox_claims:ids": lambda s, ids: db.release_outbox_claims(s, [ids.message]),
+    "get_outbox_batch_progress": lambda s, ids: db.get_outbox_batch_progress(s, ids.batch),
+    "finish_outbox_batches": lambda s, ids: db.finish_outbox_batches(s, [ids.batch]),
+    "cancel_outbox_batch": lambda s, ids: db.cancel_outbox_batch(s, ids.batch, 1),
+    "purge_outbox": lambda s, ids: db.purge_outbox(s, 0),
+    "search_tickets": lambda s, ids: search.search_tickets(s, "поставки"),
+}
+
+# Запросы выгрузки строятся здесь, а выполняются в процессе-воркере: (функция, аргументы)
+BUILDERS = {
+    "reports_by_range_query:7": (db.reports_by_range_query, (7,)),
+    "reports_by_range_query:0": (db.reports_by_range_query, (0,)),
+    "tickets_by_range_query:7": (db.tickets_by_range_query, ("problem", 7)),
+    "tickets_by_range_query:0": (db.tickets_by_range_query, ("problem", 0)),
+    "stock_history_query:7": (db.stock_history_query, (7,)),
+    "stock_history_query:0": (db.stock_history_query, (0,)),
+    "item_totals_query:7": (db.item_totals_query, (7, True)),
+    "item_totals_query:0": (db.item_totals_query, (0, True)),
+}
+
+
+@contextmanager
+def captured_queries():
+    """SELECT, UPDATE и DELETE (INSERT ... VALUES не читает таблиц)"""
+    statements = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().split(None, 1)[0].upper() in ("SELECT", "UPDATE", "DELETE", "WITH"):
+            statements.append((statement, parameters[0] if executemany else parameters))
+
+    for target in (engine.sync_engine, read_engine.sync_engine):
+        event.listen(target, "before_cursor_execute", listener)
+    try:
+        yield statements
+    finally:
+        for target in (engine.sync_engine, read_engine.sync_engine):
+            event.remove(target, "before_cursor_execute", listener)
+
+
+def _full_scans(plan: str) -> set:
+    scans = set()
+    for line in plan.splitlines():
+        match = re.match(r"SCAN (\w+)", line.strip())
+        if not match or "VIRTUAL TABLE INDEX" in line:
+            continue
+        name = match.group(1)
+        # Псевдонимы aliased(...) - outbox_1 и т.п.
+        table = name if name in TABLES else re.sub(r"_\d+$", "", name)
+        if table in TABLES:
+            scans.add(table)
+    return scans
+
+
+async def _warm_caches():
+    async with async_session() as session:
+        await db.get_branches(session)
+        await db.get_active_items(session)
+        await db.get_contacts(session)
+    cache.users.invalidate()
+    db.invalidate_dashboard_stats()
+
+
+def test_every_query_function_is_checked():
+    defined = {
+        name for name, f in vars(db).items()
+        if inspect.isfunction(f) and f.__module__ == db.__name__
+    }
+    checked = {name.split(":")[0] for name in (*CASES, *BUILDERS)} | NO_QUERIES | set(HELPERS)
+    assert sorted(defined - checked) == []
+
+
+def test_no_unexpected_full_scans(run):
+    ids = run(_seed())
+    violations, used = [], set()
+
+    async def check(name, call):
+        await _warm_caches()
+        with captured_queries() as statements:
+            async with async_session() as session:
+                await call(session, ids)
+                await session.rollback()
+        # Откат вернул данные как были; настройки и кэши - тоже (after_transaction_end)
+        for statement, parameters in statements:
+            for table in _full_scans(await _plan(statement, parameters)):
+                used.add((name, table))
+                if (name, table) not in ALLOWED_SCANS:
+                    violations.append(f"{name}: SCAN {table}\n{statement}")
+
+    for name, call in CASES.items():
+        run(check(name, call))
+    for name, (builder, args) in BUILDERS.items():
+        for table in _full_scans(query_plan(run, builder(*args))):
+            used.add((name, table))
+            if (name, table) not in ALLOWED_SCANS:
+                violations.append(f"{name}: SCAN {table}")
+
+    assert not violations, "\n\n".join(violations)
+    # Устаревшие разрешения тоже убираются
+    assert sorted(ALLOWED_SCANS - used) == []
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import update
+
+import database.requests as db
+from database.archive import archive_old_records
+from database.models import FeedbackTicket, async_session, engine
+from database.search import search_tickets
+
+pytestmark = [
+    pytest.mark.usefixtures("fresh_db"),
+    pytest.mark.skipif(engine.dialect.name != "sqlite", reason="архив ищется только через FTS5 (SQLite)"),
+]
+
+
+def test_archived_and_new_tickets_are_both_found(run):
+    async def archived_ticket():
+        async with async_session() as session:
+            ticket_id = await db.create_ticket(session, 1, "User", "Центр", "Сломался погрузчик на складе")
+            await db.close_ticket(session, ticket_id, "Починили")
+            await session.execute(
+                update(FeedbackTicket).where(FeedbackTicket.id == ticket_id)
+                .values(created_at=datetime.utcnow() - timedelta(days=400))
+            )
+            await session.commit()
+        assert await archive_old_records(days=30) == (1, 0)
+        return ticket_id
+
+    async def new_ticket():
+        async with async_session() as session:
+            ticket_id = await db.create_ticket(session, 2, "User", "Север", "Погрузчик снова сломан")
+            await session.commit()
+            return ticket_id
+
+    async def search(query):
+        async with async_session() as session:
+            return {hit.id: hit.status for hit in (await search_tickets(session, query)).hits}
+
+    old_id = run(archived_ticket())
+    new_id = run(new_ticket())
+
+    assert new_id != old_id
+    assert run(search("погрузчик")) == {old_id: "closed", new_id: "open"}
+    assert run(search("склад")) == {old_id: "closed"}
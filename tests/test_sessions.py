@@ -0,0 +1,96 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+import database.requests as db
+from database.models import async_session, engine, read_engine
+
+pytestmark = [
+    pytest.mark.usefixtures("fresh_db"),
+    pytest.mark.skipif(read_engine is engine, reason="на PostgreSQL пул один, маршрутизировать нечего"),
+]
+
+
+@contextmanager
+def routed():
+    """Запоминает, через какой пул прошел каждый запрос: [("writer" | "reader", sql)]"""
+    seen = []
+
+    def listener(name):
+        def record(conn, cursor, statement, parameters, context, executemany):
+            seen.append((name, statement))
+        return record
+
+    listeners = [(engine.sync_engine, listener("writer")), (read_engine.sync_engine, listener("reader"))]
+    for target, fn in listeners:
+        event.listen(target, "before_cursor_execute", fn)
+    try:
+        yield seen
+    finally:
+        for target, fn in listeners:
+            event.remove(target, "before_cursor_execute", fn)
+
+
+def _pools(seen, table):
+    return {name for name, sql in seen if sql.lstrip().upper().startswith("SELECT") and table in sql}
+
+
+def test_reads_go_to_reader_pool(run):
+    async def scenario():
+        async with async_session() as session:
+            with routed() as seen:
+                await db.get_open_tickets(session)
+                await db.get_all_users(session)
+            # Короткая сессия читателя уже закрыта, соединение вернулось в пул
+            assert read_engine.sync_engine.pool.checkedout() == 0
+        return seen
+
+    seen = run(scenario())
+    assert _pools(seen, "tickets") == {"reader"}
+    assert _pools(seen, "users") == {"reader"}
+
+
+def test_read_then_write_checks_run_on_writer(run):
+    async def setup():
+        async with async_session() as session:
+            await db.add_branch(session, "Центр")
+            await db.add_user(session, 10)
+            await session.commit()
+        async with async_session() as session:
+            [branch] = await db.get_branches(session)
+            return branch.id
+
+    branch_id = run(setup())
+
+    async def scenario():
+        async with async_session() as session:
+            with routed() as seen:
+                assert await db.add_branch(session, "Центр") is None
+                await db.update_user_branch(session, 10, branch_id)
+                await db.save_report(session, 10, "Центр", "отчет")
+            await session.commit()
+        return seen
+
+    seen = run(scenario())
+    assert _pools(seen, "branches") == {"writer"}
+    assert _pools(seen, "users") == {"writer"}
+
+
+def test_session_reads_own_writes_after_first_write(run):
+    async def scenario():
+        async with async_session() as session:
+            await db.add_user(session, 10)
+            with routed() as seen:
+                ticket_id = await db.create_ticket(session, 10, "Иван", "Центр", "Не работает")
+                found = await db.get_ticket(session, ticket_id)
+                tickets = await db.get_open_tickets(session)
+            # Читатель не занят, пока сессия держит незакоммиченную запись
+            assert read_engine.sync_engine.pool.checkedout() == 0
+            assert found is not None
+            assert [t.id for t in tickets] == [ticket_id]
+            await session.rollback()
+        return seen
+
+    seen = run(scenario())
+    assert {name for name, _ in seen} == {"writer"}
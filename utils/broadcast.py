@@ -0,0 +1,72 @@
+import asyncio
+import time
+from typing import Dict
+
+import config
+
+# Лимиты Telegram для исходящих сообщений: общий token bucket на бота (BROADCAST_RATE в секунду)
+# и минимальный интервал между сообщениями в один чат. Ими пользуется воркер очереди (utils/outbox.py),
+# отправки идут параллельно (BROADCAST_CONCURRENCY в полете), но не быстрее лимитов.
+
+class TokenBucket:
+    """В среднем не больше rate операций в секунду, всплеск - до capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Под замком: ожидающие получают токены строго по очереди
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ChatLimiter:
+    """Не чаще одного сообщения в interval секунд в один чат"""
+
+    MAX_CHATS = 10000
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_at: Dict[int, float] = {}
+
+    async def acquire(self, chat_id: int):
+        now = time.monotonic()
+        at = max(now, self.next_at.get(chat_id, 0.0))
+        # Слот бронируется сразу, чтобы параллельные отправки в тот же чат встали в очередь
+        self.next_at[chat_id] = at + self.interval
+        if len(self.next_at) > self.MAX_CHATS:
+            self.next_at = {c: t for c, t in self.next_at.items() if t > now}
+        if at > now:
+            await asyncio.sleep(at - now)
+
+_bucket = TokenBucket(config.BROADCAST_RATE, config.BROADCAST_BURST)
+_chats = ChatLimiter(config.BROADCAST_CHAT_INTERVAL)
+# До этого момента (time.monotonic) не отправляется ничего: Telegram ответил "Too Many Requests"
+_paused_until = 0.0
+
+def pause(seconds: float):
+    """Останавливает все отправки на seconds (RetryAfter). Лимит Telegram общий на бота, а не на чат"""
+    global _paused_until
+    _paused_until = max(_paused_until, time.monotonic() + seconds)
+
+async def throttle(chat_id: int):
+    """Ждет, пока можно отправить сообщение в chat_id, не превышая лимитов"""
+    await _chats.acquire(chat_id)
+    while True:
+        delay = _paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await _bucket.acquire()
+        # Пауза могла начаться, пока ждали токен
+        if _paused_until <= time.monotonic():
+            return
@@ -0,0 +1,93 @@
+import csv
+import io
+from collections import Counter
+from typing import List, NamedTuple, Optional, Tuple
+
+import openpyxl
+
+# Разбор файла массового импорта справочников (CSV или XLSX, первая строка - заголовок):
+#   type  - item / branch (или товар / филиал)
+#   name  - название
+#   id    - необязательно: ID существующей записи, которую нужно переименовать в name
+
+KINDS = {"item": "item", "товар": "item", "branch": "branch", "филиал": "branch"}
+COLUMNS = {
+    "type": "type", "тип": "type",
+    "name": "name", "название": "name",
+    "id": "id",
+}
+
+class ImportRow(NamedTuple):
+    line: int  # номер строки в файле (для сообщений об ошибках)
+    kind: str  # item / branch
+    name: str
+    id: Optional[int]
+
+class CatalogFileError(ValueError):
+    """Файл целиком не подходит (формат, заголовок)"""
+
+def _read_csv(data: bytes):
+    try:
+        content = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        # Excel в русской локали сохраняет CSV в cp1251
+        content = data.decode("cp1251")
+    # Разделитель - по заголовку: Excel пишет ";" в русской локали и "," в английской
+    header = content.split("\n", 1)[0]
+    delimiter = max(";,\t", key=header.count)
+    return list(csv.reader(io.StringIO(content), delimiter=delimiter))
+
+def _read_xlsx(data: bytes):
+    try:
+        wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    except Exception as e:
+        raise CatalogFileError(f"Не удалось открыть XLSX: {e}")
+    rows = [["" if v is None else str(v) for v in row] for row in wb.worksheets[0].iter_rows(values_only=True)]
+    wb.close()
+    return rows
+
+def parse_catalog_file(filename: str, data: bytes) -> Tuple[List[ImportRow], List[str]]:
+    """Возвращает (строки, ошибки по строкам). CatalogFileError - если файл не разобрать вовсе"""
+    if filename.lower().endswith(".xlsx"):
+        table = _read_xlsx(data)
+    elif filename.lower().endswith(".csv"):
+        table = _read_csv(data)
+    else:
+        raise CatalogFileError("Поддерживаются только файлы .csv и .xlsx")
+
+    if not table:
+        raise CatalogFileError("Файл пустой")
+
+    header = [COLUMNS.get(h.strip().lower()) for h in table[0]]
+    if "type" not in header or "name" not in header:
+        raise CatalogFileError("В первой строке нужны колонки type и name (и id для переименования)")
+    col = {name: i for i, name in enumerate(header) if name}
+
+    def cell(row, name):
+        i = col.get(name)
+        return row[i].strip() if i is not None and i < len(row) and row[i] else ""
+
+    rows, errors = [], []
+    for line, row in enumerate(table[1:], start=2):
+        if not any(v.strip() for v in row):
+            continue
+        kind = KINDS.get(cell(row, "type").lower())
+        name = cell(row, "name")
+        raw_id = cell(row, "id")
+        if not kind:
+            errors.append(f"стр. {line}: неизвестный тип '{cell(row, 'type')}'")
+        elif not name:
+            errors.append(f"стр. {line}: пустое название")
+        elif raw_id and not raw_id.isdigit():
+            errors.append(f"стр. {line}: id должен быть числом")
+        else:
+            rows.append(ImportRow(line, kind, name, int(raw_id) if raw_id else None))
+
+    # Один id в нескольких строках - непонятно, какое название верное: отклоняем все такие строки
+    counts = Counter((row.kind, row.id) for row in rows if row.id is not None)
+    duplicates = {key for key, count in counts.items() if count > 1}
+    for row in rows:
+        if (row.kind, row.id) in duplicates:
+            errors.append(f"стр. {row.line}: id {row.id} повторяется в файле")
+    rows = [row for row in rows if (row.kind, row.id) not in duplicates]
+    return rows, errors
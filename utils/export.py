@@ -0,0 +1,219 @@
+import asyncio
+import heapq
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import openpyxl
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+import config
+import database.requests as db
+from database.models import DATABASE_URL, Item, InventoryReport, ReportLine, _apply_sqlite_pragmas
+
+# Сборка Excel - чистая работа CPU, поэтому она идет в отдельных процессах,
+# а event loop бота продолжает обслуживать остальных пользователей.
+
+TICKET_HEADER = ["ID", "Date", "Status", "Branch", "Sender", "Message", "Responder", "Reply", "Reply Date"]
+
+class ExportBusy(Exception):
+    """Очередь выгрузок заполнена (EXPORT_MAX_PENDING)"""
+
+_executor = None
+_pending = 0
+
+# --- Внутри процесса-воркера ---
+
+_engines = {}
+
+def _get_engine(database_url: str):
+    # Свой движок на процесс с тем же async-драйвером, что и у бота (aiosqlite / asyncpg).
+    # NullPool: каждая выгрузка идет в своем event loop, соединения между ними не переиспользуются
+    if database_url not in _engines:
+        worker_engine = create_async_engine(database_url, poolclass=NullPool)
+        if worker_engine.dialect.name == "sqlite":
+            @event.listens_for(worker_engine.sync_engine, "connect")
+            def _on_connect(dbapi_connection, connection_record):
+                _apply_sqlite_pragmas(dbapi_connection, read_only=True)
+        _engines[database_url] = worker_engine
+    return _engines[database_url]
+
+def _merged(results, key, reverse: bool):
+    # Рабочая БД и архив читаются параллельно (по курсору на каждую) и сливаются по дате - в том же порядке,
+    # что и ORDER BY запроса. Какие даты лежат в архиве, а какие еще в рабочей БД, не важно
+    return heapq.merge(*results, key=key, reverse=reverse)
+
+def _rows(sessions, query, key):
+    """Объекты query из всех БД, от новых к старым (как в запросах выгрузки)"""
+    return _merged((session.scalars(query) for session in sessions), key, reverse=True)
+
+def _item_names(sessions):
+    # В архиве нет справочника товаров: названия всегда берем из рабочей БД
+    return dict(sessions[0].execute(select(Item.id, Item.name)).all())
+
+def _item_totals(sessions, days: int):
+    if len(sessions) == 1:
+        return sessions[0].execute(db.item_totals_query(days, by_branch=True)).all()
+
+    # Суммируем по item_id в каждой БД, названия - из рабочей
+    names = _item_names(sessions)
+    totals = {}
+    for session in sessions:
+        stmt = (
+            select(InventoryReport.branch_name, ReportLine.item_id, func.sum(ReportLine.qty))
+            .join(ReportLine, ReportLine.report_id == InventoryReport.id)
+            .group_by(InventoryReport.branch_name, ReportLine.item_id)
+        )
+        for branch_name, item_id, qty in session.execute(stmt):
+            if item_id in names:
+                key = (branch_name, names[item_id])
+                totals[key] = totals.get(key, 0) + qty
+    return [(branch_name, item_name, qty) for (branch_name, item_name), qty in sorted(totals.items())]
+
+def _user_link(user_id, name):
+    display = name if name else str(user_id)
+    return f'=HYPERLINK("tg://user?id={user_id}", "{display}")'
+
+def _responder_link(t):
+    return _user_link(t.responder_id, t.responder_name) if t.responder_id else ""
+
+def _write_workbook(sessions, days: int, fileobj):
+    """
+    Книга в режиме write_only, строки читаются из БД пачками (EXPORT_BATCH_SIZE) -
+    в памяти одновременно только одна пачка, сколько бы ни было данных.
+    sessions: рабочая БД и (для выгрузки за все время) архив.
+    """
+    wb = openpyxl.Workbook(write_only=True)
+
+    # --- Лист 1: Инвентаризация ---
+    ws = wb.create_sheet("Inventory")
+    ws.append(["ID", "Date", "Branch", "Sector", "User", "Report Data"])
+    for r in _rows(sessions, db.reports_by_range_query(days), key=lambda r: r.timestamp):
+        # Sector (handle None for old records)
+        sector_display = r.sector if r.sector else "N/A"
+        ws.append([r.id, r.timestamp, r.branch_name, sector_display, _user_link(r.user_id, r.user_name), r.report_data])
+
+    # --- Листы 2-3: Проблемы и Вопросы ---
+    for title, ticket_type in (("Problems", "problem"), ("Questions", "question")):
+        ws = wb.create_sheet(title)
+        ws.append(TICKET_HEADER)
+        for t in _rows(sessions, db.tickets_by_range_query(ticket_type, days), key=lambda t: t.created_at):
+            ws.append([
+                t.id, t.created_at, t.status, t.branch_name,
+                _user_link(t.user_id, t.user_name), t.message,
+                _responder_link(t), t.reply_message, t.reply_at
+            ])
+
+    # --- Лист 4: Заявки (Orders) ---
+    ws = wb.create_sheet("Orders")
+    ws.append(["ID", "Date", "Status", "Branch", "User", "Order Details", "Responder", "Note"])
+    for o in _rows(sessions, db.tickets_by_range_query("order", days), key=lambda o: o.created_at):
+        ws.append([
+            o.id, o.created_at, o.status, o.branch_name,
+            _user_link(o.user_id, o.user_name), o.message,
+            _responder_link(o), o.reply_message
+        ])
+
+    # --- Лист 5: Итоги по товарам (агрегат по report_lines) ---
+    ws = wb.create_sheet("Item Totals")
+    ws.append(["Branch", "Item", "Total Qty"])
+    for branch_name, item_name, qty in _item_totals(sessions, days):
+        ws.append([branch_name, item_name, qty])
+
+    # --- Лист 6: История остатков (ряд по филиалу/сектору/товару с изменением к прошлому отчету) ---
+    ws = wb.create_sheet("Stock History")
+    ws.append(["Date", "Branch", "Sector", "Item", "Qty", "Delta"])
+    names = _item_names(sessions)
+    history = _merged(
+        (session.execute(db.stock_history_query(days)) for session in sessions), key=lambda row: row[0], reverse=False
+    )
+    for timestamp, branch_name, sector, item_id, qty, delta in history:
+        ws.append([timestamp, branch_name, sector, names.get(item_id, f"#{item_id}"), qty, delta])
+
+    wb.save(fileobj)
+
+def _archive_exists(database_url: str) -> bool:
+    # Подключение к несуществующему файлу SQLite создало бы пустой архив
+    url = make_url(database_url)
+    if url.get_backend_name() != "sqlite":
+        return True
+    return bool(url.database) and url.database != ":memory:" and os.path.exists(url.database)
+
+async def _build(days: int, fileobj):
+    async with _get_engine(DATABASE_URL).connect() as main:
+        connections = [main]
+        archive = None
+        if not days and _archive_exists(config.ARCHIVE_DATABASE_URL):
+            # "Все время" - вместе с архивом, если он уже создан
+            archive = await _get_engine(config.ARCHIVE_DATABASE_URL).connect()
+            if await archive.run_sync(lambda conn: inspect(conn).has_table("tickets")):
+                connections.append(archive)
+        try:
+            # Сборка книги - обычный синхронный код поверх sync-обертки async-соединений
+            def write(_):
+                sessions = [Session(bind=conn.sync_connection) for conn in connections]
+                try:
+                    _write_workbook(sessions, days, fileobj)
+                finally:
+                    for session in sessions:
+                        session.close()
+            await main.run_sync(write)
+        finally:
+            if archive is not None:
+                await archive.close()
+
+def build_report_sync(days: int) -> bytes:
+    """Точка входа воркера: готовый .xlsx в байтах"""
+    buffer = io.BytesIO()
+    asyncio.run(_build(days, buffer))
+    return buffer.getvalue()
+
+# --- В процессе бота ---
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn: воркер не наследует event loop и соединения бота
+        _executor = ProcessPoolExecutor(
+            max_workers=config.EXPORT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+async def build_report(days: int) -> bytes:
+    """Собирает отчет в процессе-воркере. ExportBusy, если очередь выгрузок заполнена"""
+    global _pending
+    if _pending >= config.EXPORT_MAX_PENDING:
+        raise ExportBusy()
+    _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        executor = _get_executor()
+        try:
+            return await loop.run_in_executor(executor, build_report_sync, days)
+        except BrokenProcessPool:
+            # Воркер умер (OOM, kill): такой пул больше не принимает задачи - следующая выгрузка создаст новый
+            logging.warning("Export: процесс-воркер выгрузки завершился аварийно, пул пересоздается")
+            _reset_executor(executor)
+            raise
+    finally:
+        _pending -= 1
+
+def _reset_executor(broken):
+    global _executor
+    if _executor is broken:
+        _executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,292 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from sqlalchemy import event
+
+import config
+import database.requests as db
+from database.models import OutboxMessage, WriterSession, async_session
+from utils import broadcast
+
+# Исходящая очередь. Хендлеры и планировщик не отправляют сообщения сами, а ставят их в таблицу
+# outbox (db.enqueue_messages) в своей транзакции. Воркер забирает их пачками, отправляет с учетом
+# лимитов Telegram (utils/broadcast.py) и сразу записывает результат каждого сообщения, поэтому
+# после перезапуска доставка продолжается с того места, где остановилась.
+
+# --- Сообщения для очереди ---
+
+def _message(chat_id: int, method: str, dedup_key: Optional[str], **kwargs) -> dict:
+    payload = {k: v for k, v in kwargs.items() if v is not None}
+    return {
+        "chat_id": chat_id,
+        "method": method,
+        "payload": json.dumps(payload, ensure_ascii=False),
+        "dedup_key": dedup_key,
+    }
+
+def _markup(reply_markup: Optional[InlineKeyboardMarkup]) -> Optional[dict]:
+    return reply_markup.model_dump(exclude_none=True) if reply_markup else None
+
+def text_message(chat_id: int, text: str, parse_mode: Optional[str] = None,
+                 reply_markup: Optional[InlineKeyboardMarkup] = None, dedup_key: Optional[str] = None) -> dict:
+    """send_message. Без parse_mode действует режим бота по умолчанию"""
+    return _message(chat_id, "send_message", dedup_key, text=text, parse_mode=parse_mode, reply_markup=_markup(reply_markup))
+
+def copy_message(chat_id: int, from_chat_id: int, message_id: int,
+                 reply_markup: Optional[InlineKeyboardMarkup] = None, dedup_key: Optional[str] = None) -> dict:
+    """copy_message: исходное сообщение должно существовать на момент доставки"""
+    return _message(
+        chat_id, "copy_message", dedup_key,
+        from_chat_id=from_chat_id, message_id=message_id, reply_markup=_markup(reply_markup),
+    )
+
+# --- Воркер ---
+
+_wakeup: Optional[asyncio.Event] = None
+_task: Optional[asyncio.Task] = None
+# Остановленные рассылки: уже забранные воркером сообщения из них не отправляются
+_cancelled: Set[int] = set()
+# batch_id -> (когда обновляли прогресс, сколько к тому моменту было обработано)
+_progress_at: Dict[int, Tuple[float, int]] = {}
+
+def wake():
+    if _wakeup is not None:
+        _wakeup.set()
+
+def cancel(batch_id: int):
+    """Вызывается после db.cancel_outbox_batch"""
+    _cancelled.add(batch_id)
+    wake()
+
+def stop_keyboard(batch_id: int) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="⛔ Остановить", callback_data=f"outbox_stop_{batch_id}")
+    return builder.as_markup()
+
+@event.listens_for(WriterSession, "after_commit")
+def _on_commit(session):
+    # enqueue_messages помечает сессию: новые сообщения видны воркеру только после коммита
+    if session.info.pop("outbox", False):
+        wake()
+
+@event.listens_for(WriterSession, "after_rollback")
+def _on_rollback(session):
+    session.info.pop("outbox", None)
+
+def _retry_delay(attempts: int) -> float:
+    return min(config.OUTBOX_RETRY_BASE * 2 ** (attempts - 1), config.OUTBOX_RETRY_MAX)
+
+async def _call(bot: Bot, msg: OutboxMessage):
+    kwargs = json.loads(msg.payload)
+    if "reply_markup" in kwargs:
+        kwargs["reply_markup"] = InlineKeyboardMarkup.model_validate(kwargs["reply_markup"])
+    if msg.method == "copy_message":
+        await bot.copy_message(chat_id=msg.chat_id, **kwargs)
+    else:
+        await bot.send_message(chat_id=msg.chat_id, **kwargs)
+
+async def _record(update, *args, **kwargs):
+    # Результат фиксируется сразу: после перезапуска доставленное не уйдет повторно
+    async with async_session() as session:
+        await update(session, *args, **kwargs)
+        await session.commit()
+
+async def _mark_unreachable(session, msg: OutboxMessage, error: str):
+    await db.mark_outbox_failed(session, msg.id, error)
+    if await db.mark_user_unreachable(session, msg.chat_id, error):
+        logging.info(f"Outbox: пользователь {msg.chat_id} заблокировал бота, исключен из рассылок")
+
+async def _deliver(bot: Bot, msg: OutboxMessage):
+    # Остановленная рассылка не тратит лимит; проверяем и после ожидания - за это время могли остановить
+    if msg.batch_id not in _cancelled:
+        await broadcast.throttle(msg.chat_id)
+    if msg.batch_id in _cancelled:
+        await _record(db.mark_outbox_cancelled, msg.id)
+        return
+    try:
+        await _call(bot, msg)
+    except TelegramRetryAfter as e:
+        # Не ошибка: Telegram просит подождать - ждут все отправки, попытка не засчитывается
+        logging.warning(f"Outbox: flood wait {e.retry_after} с")
+        broadcast.pause(e.retry_after)
+        next_at = datetime.utcnow() + timedelta(seconds=e.retry_after)
+        await _record(db.retry_outbox_message, msg.id, next_at, str(e), count_attempt=False)
+    except TelegramForbiddenError as e:
+        # Бот заблокирован пользователем (или удален из группы): больше в этот чат не пишем
+        logging.info(f"Outbox: не доставлено в {msg.chat_id}: {e}")
+        await _record(_mark_unreachable, msg, str(e))
+    except TelegramBadRequest as e:
+        # Чат не найден, исходное сообщение удалено - повтор не поможет
+        logging.info(f"Outbox: не доставлено в {msg.chat_id}: {e}")
+        await _record(db.mark_outbox_failed, msg.id, str(e))
+    except Exception as e:
+        attempts = msg.attempts + 1
+        if attempts >= config.OUTBOX_MAX_ATTEMPTS:
+            logging.warning(f"Outbox: не доставлено в {msg.chat_id} после {attempts} попыток: {e}")
+            await _record(db.mark_outbox_failed, msg.id, str(e))
+        else:
+            next_at = datetime.utcnow() + timedelta(seconds=_retry_delay(attempts))
+            await _record(db.retry_outbox_message, msg.id, next_at, str(e))
+    else:
+        await _record(db.mark_outbox_sent, msg.id)
+
+async def _show_progress(bot: Bot, batch_id: int):
+    """Обновляет сообщение рассылки не чаще BROADCAST_PROGRESS_INTERVAL: правки тоже расходуют лимит"""
+    now = time.monotonic()
+    last = _progress_at.get(batch_id)
+    if batch_id in _cancelled or (last is not None and now - last[0] < config.BROADCAST_PROGRESS_INTERVAL):
+        return
+    # Время занимается сразу, чтобы параллельные отправки не обновляли одно и то же
+    _progress_at[batch_id] = (now, last[1] if last else 0)
+
+    async with async_session() as session:
+        progress = await db.get_outbox_batch_progress(session, batch_id)
+    if progress is None or not progress.batch.message_id or not progress.remaining:
+        return
+    batch = progress.batch
+    done = progress.sent + progress.failed + progress.cancelled
+    if last is None:
+        elapsed = max((datetime.utcnow() - batch.created_at).total_seconds(), 1.0)
+        rate = done / elapsed
+    else:
+        rate = (done - last[1]) / (now - last[0])
+    _progress_at[batch_id] = (now, done)
+
+    text = (
+        f"⏳ {batch.title}\n"
+        f"Доставлено: {progress.sent}, не доставлено: {progress.failed}, осталось: {progress.remaining} из {batch.total}\n"
+        f"Скорость: {rate:.1f} сообщ./с"
+    )
+    try:
+        await broadcast.throttle(batch.chat_id)
+        await bot.edit_message_text(
+            text, chat_id=batch.chat_id, message_id=batch.message_id,
+            reply_markup=stop_keyboard(batch_id), parse_mode=None,
+        )
+    except Exception as e:
+        logging.info(f"Outbox: не удалось обновить прогресс рассылки {batch_id}: {e}")
+
+async def _report(bot: Bot, batch_ids: Iterable[int]):
+    """Итоги завершившихся рассылок - тому, кто их запустил"""
+    batch_ids = list(batch_ids)
+    # Вызывается, когда в работе ничего нет: из остановленных рассылок пропускать уже нечего
+    _cancelled.difference_update(batch_ids)
+    async with async_session() as session:
+        finished = await db.finish_outbox_batches(session, batch_ids)
+        await session.commit()
+    for progress in finished:
+        batch = progress.batch
+        _progress_at.pop(batch.id, None)
+        if progress.cancelled:
+            text = f"⛔ {batch.title}: остановлено. Доставлено {progress.sent} из {batch.total}, отменено {progress.cancelled}"
+        else:
+            text = f"✅ {batch.title}: доставлено {progress.sent} из {batch.total}"
+        if progress.failed:
+            text += f" (не доставлено: {progress.failed})"
+        if batch.chat_id is None:
+            logging.info(f"Outbox: {text}")
+            continue
+        try:
+            if batch.message_id:
+                await bot.edit_message_text(text, chat_id=batch.chat_id, message_id=batch.message_id, parse_mode=None)
+            else:
+                await bot.send_message(batch.chat_id, text, parse_mode=None)
+        except Exception as e:
+            logging.info(f"Outbox: не удалось отправить итог рассылки {batch.id}: {e}")
+
+async def _process(bot: Bot) -> bool:
+    """Одна пачка. False - отправлять нечего"""
+    async with async_session() as session:
+        messages = await db.claim_outbox(session, config.OUTBOX_BATCH_SIZE)
+        await session.commit()
+    if not messages:
+        return False
+
+    queue = iter(messages)
+    started: Set[int] = set()
+    errors = []
+
+    async def worker():
+        # Итератор общий: каждое сообщение забирает ровно один воркер
+        for msg in queue:
+            if errors:
+                return
+            started.add(msg.id)
+            try:
+                await _deliver(bot, msg)
+                if msg.batch_id:
+                    await _show_progress(bot, msg.batch_id)
+            except Exception as e:
+                errors.append(e)
+                return
+
+    # После ошибки остальные воркеры доводят начатые отправки, но новых не берут
+    await asyncio.gather(*(worker() for _ in range(config.BROADCAST_CONCURRENCY)))
+    if errors:
+        # В очередь возвращаются только неначатые: начатое могло уже дойти до получателя
+        await _release_claims([m.id for m in messages if m.id not in started])
+        raise errors[0]
+    await _report(bot, {m.batch_id for m in messages if m.batch_id} | _cancelled)
+    return True
+
+async def _release_claims(ids: Optional[List[int]] = None) -> int:
+    async with async_session() as session:
+        released = await db.release_outbox_claims(session, ids)
+        await session.commit()
+    return released
+
+async def _idle_timeout() -> float:
+    try:
+        async with async_session() as session:
+            next_at = await db.get_next_outbox_attempt(session)
+    except Exception:
+        return config.OUTBOX_POLL_INTERVAL
+    if next_at is None:
+        return config.OUTBOX_POLL_INTERVAL
+    return min(config.OUTBOX_POLL_INTERVAL, max(0.1, (next_at - datetime.utcnow()).total_seconds()))
+
+async def _run(bot: Bot):
+    released = await _release_claims()
+    if released:
+        logging.info(f"Outbox: {released} сообщений, прерванных перезапуском, снова в очереди")
+
+    while True:
+        _wakeup.clear()
+        try:
+            if await _process(bot):
+                continue
+            if _cancelled:
+                # Остановленная рассылка, из которой в работе ничего не было
+                await _report(bot, set(_cancelled))
+        except Exception:
+            logging.exception("Outbox: ошибка воркера")
+        # Новые сообщения будят воркер сразу, отложенные повторы - к своему времени
+        try:
+            await asyncio.wait_for(_wakeup.wait(), await _idle_timeout())
+        except asyncio.TimeoutError:
+            pass
+
+def start(bot: Bot):
+    global _wakeup, _task
+    _wakeup = asyncio.Event()
+    _task = asyncio.create_task(_run(bot))
+
+async def stop():
+    """Недоставленные сообщения остаются в таблице и уйдут после следующего запуска"""
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
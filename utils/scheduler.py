@@ -1,6 +1,9 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from aiogram import Bot
 import database.requests as db
+from database.models import async_session
+from database.archive import archive_old_records
+from utils import outbox
 from utils.locales import get_text
 from datetime import datetime
 
@@ -12,50 +15,58 @@ async def check_auto_inventory_status(bot: Bot):
     """
     Проверяет, нужно ли автоматически открыть/закрыть инвентаризацию по расписанию.
     """
+    async with async_session() as session:
+        await _check_auto_inventory_status(bot, session)
+        await session.commit()
+
+async def _check_auto_inventory_status(bot: Bot, session):
     # 1. Проверяем, включен ли авто-режим
-    auto_mode = await db.get_setting("inventory_auto_mode", "0")
-    if auto_mode != "1":
+    schedule = db.get_inventory_schedule()
+    if not schedule.auto_mode:
         return
 
     # 2. Получаем настройки дней
-    try:
-        start_day = int(await db.get_setting("inventory_start_day", "25"))
-        end_day = int(await db.get_setting("inventory_end_day", "1"))
-    except:
+    start_day, end_day = schedule.start_day, schedule.end_day
+    if start_day is None or end_day is None:
         return # Ошибка в настройках
         
     current_day = datetime.now().day
-    is_open = await db.is_inventory_open()
+    is_open = db.is_inventory_open()
     
     # 3. Логика открытия
     if current_day == start_day and not is_open:
-        await db.set_setting("inventory_open", "1")
+        cycle = await db.open_inventory_cycle(session)
+        cycle_id = cycle.id
         
         # Уведомляем админов
-        for admin_id in config.ADMIN_IDS:
-             try: await bot.send_message(admin_id, "⚙️ **Авто-планировщик:** Сбор отчетов ОТКРЫТ.")
-             except: pass
+        await db.enqueue_messages(session, [
+            outbox.text_message(admin_id, "⚙️ **Авто-планировщик:** Сбор отчетов ОТКРЫТ.", dedup_key=f"auto_open:{cycle_id}:{admin_id}")
+            for admin_id in config.ADMIN_IDS
+        ])
              
-        # Рассылка пользователям
-        users = await db.get_all_users()
+        # Рассылка пользователям - в той же транзакции, что и открытие сбора
+        users = await db.get_all_users(session)
+        messages = []
         for u in users:
-            try:
-                lang = u.language if u.language else "ru"
-                if lang == "kz":
-                    msg = "🔔 **Назар аударыңыз!**\n\nҚалдықтарды жинау басталды. Есеп тапсырыңыз."
-                else:
-                    msg = "🔔 **Внимание!**\n\nОткрыт сбор отчетов по остаткам. Пожалуйста, сдайте отчет."
-                await bot.send_message(u.telegram_id, msg)
-            except: pass
+            lang = u.language if u.language else "ru"
+            if lang == "kz":
+                msg = "🔔 **Назар аударыңыз!**\n\nҚалдықтарды жинау басталды. Есеп тапсырыңыз."
+            else:
+                msg = "🔔 **Внимание!**\n\nОткрыт сбор отчетов по остаткам. Пожалуйста, сдайте отчет."
+            messages.append(outbox.text_message(u.telegram_id, msg, dedup_key=f"cycle_open:{cycle_id}:{u.telegram_id}"))
+        batch_id = await db.create_outbox_batch(session, "Авто-открытие сбора")
+        await db.enqueue_messages(session, messages, batch_id)
             
     # 4. Логика закрытия
     elif current_day == end_day and is_open:
-        await db.set_setting("inventory_open", "0")
+        await db.close_inventory_cycle(session)
         
         # Уведомляем админов
-        for admin_id in config.ADMIN_IDS:
-             try: await bot.send_message(admin_id, "⚙️ **Авто-планировщик:** Сбор отчетов ЗАКРЫТ.")
-             except: pass
+        today = datetime.now().strftime("%Y-%m-%d")
+        await db.enqueue_messages(session, [
+            outbox.text_message(admin_id, "⚙️ **Авто-планировщик:** Сбор отчетов ЗАКРЫТ.", dedup_key=f"auto_close:{today}:{admin_id}")
+            for admin_id in config.ADMIN_IDS
+        ])
 
 async def send_daily_reminders(bot: Bot):
     """
@@ -63,28 +74,45 @@ async def send_daily_reminders(bot: Bot):
     """
     # Только если инвентаризация открыта?
     # Логично, что напоминать нужно только когда сбор открыт.
-    if not await db.is_inventory_open():
+    if not db.is_inventory_open():
         return
 
-    users = await db.get_users_pending_report()
-    
-    if not users:
-        return
+    async with async_session() as session:
+        users = await db.get_users_pending_report(session)
+        if not users:
+            return
 
-    for user in users:
-        lang = user.language if user.language else "ru"
-        
-        # Получаем текст напоминания
-        header = get_text(lang, "reminder_header")
-        body = get_text(lang, "reminder_body").format(date=datetime.now().strftime("%d.%m.%Y"))
-        
-        message_text = f"{header}\n\n{body}"
-        
-        try:
-            await bot.send_message(user.telegram_id, message_text)
-        except Exception as e:
-            # Пользователь мог заблокировать бота
-            print(f"Failed to send reminder to {user.telegram_id}: {e}")
+        today = datetime.now().strftime("%Y-%m-%d")
+        messages = []
+        for user in users:
+            lang = user.language if user.language else "ru"
+            
+            # Получаем текст напоминания
+            header = get_text(lang, "reminder_header")
+            body = get_text(lang, "reminder_body").format(date=datetime.now().strftime("%d.%m.%Y"))
+            
+            message_text = f"{header}\n\n{body}"
+            # Ключ на день: повторный запуск задачи (перезапуск бота в 09:00) не задублирует напоминания
+            messages.append(outbox.text_message(user.telegram_id, message_text, dedup_key=f"reminder:{today}:{user.telegram_id}"))
+
+        # Итог (сколько доставлено и сколько нет) пишется в лог воркером очереди
+        batch_id = await db.create_outbox_batch(session, "Ежедневное напоминание")
+        queued = await db.enqueue_messages(session, messages, batch_id)
+        await session.commit()
+    print(f"Reminders: queued {queued}")
+
+async def archive_old_data():
+    """Ночной перенос старых закрытых тикетов и отчетов в архив"""
+    tickets, reports = await archive_old_records()
+    if tickets or reports:
+        print(f"Archive: moved {tickets} tickets and {reports} reports")
+
+    # Заодно чистим очередь от давно обработанных сообщений
+    async with async_session() as session:
+        purged = await db.purge_outbox(session, config.OUTBOX_KEEP_DAYS)
+        await session.commit()
+    if purged:
+        print(f"Outbox: purged {purged} messages")
 
 def start_scheduler(bot: Bot):
     # Запускаем задачу каждый день в 09:00 - Reminder
@@ -93,5 +121,8 @@ def start_scheduler(bot: Bot):
     # ПРОВЕРКА АВТО-СТАТУСА:
     # Запускаем, например, в 08:00 утра.
     scheduler.add_job(check_auto_inventory_status, 'cron', hour=8, minute=0, args=[bot])
+
+    # Архивация - ночью, когда бот почти не занят
+    scheduler.add_job(archive_old_data, 'cron', hour=3, minute=0)
     
     scheduler.start()